@@ -0,0 +1,91 @@
+"""Benchmark: rebuild_combined_stock with 1 changed supplier out of 200
+
+Runs against an in-memory S3 (moto), so no AWS account is needed:
+
+    pip install "moto[s3]"
+    python benchmarks/bench_rebuild_combined_stock.py
+"""
+import os
+import sys
+import time
+import logging
+from io import BytesIO
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("AWS_BUCKET", "benchmark-bucket")
+os.environ.setdefault("AWS_REGION", "us-east-1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+from moto import mock_aws
+
+SUPPLIERS = 200
+STONES_PER_SUPPLIER = 50
+
+
+def make_supplier_stock(main, name: str, seed: int) -> bytes:
+    rng = np.random.default_rng(seed)
+    n = STONES_PER_SUPPLIER
+    df = pd.DataFrame({
+        "Stock #": [f"{name.upper()}-{i}" for i in range(n)],
+        "Shape": rng.choice(["Round", "Oval", "Princess", "Pear", "Emerald"], n),
+        "Weight": np.round(rng.uniform(0.3, 3.0, n), 2),
+        "Color": rng.choice(list("DEFGHIJ"), n),
+        "Clarity": rng.choice(["IF", "VVS1", "VVS2", "VS1", "VS2", "SI1"], n),
+        "Price Per Carat": rng.integers(2000, 15000, n),
+        "Lab": rng.choice(["GIA", "IGI", "HRD"], n),
+        "Report #": [str(10_000_000 + seed * 1000 + i) for i in range(n)],
+        "Diamond Type": rng.choice(["Natural", "LGD"], n),
+        "Description": "benchmark stone",
+    })
+    ok, cleaned, errors, _ = main.DiamondExcelValidator.validate_and_parse(df, f"supplier_{name}")
+    assert ok, errors
+    buffer = BytesIO()
+    cleaned.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def put_supplier(main, name: str, seed: int):
+    main.s3.put_object(
+        Bucket=main.CONFIG["AWS_BUCKET"],
+        Key=f"{main.SUPPLIER_STOCK_FOLDER}supplier_{name}.xlsx",
+        Body=make_supplier_stock(main, name, seed)
+    )
+
+
+def timed_rebuild(main) -> float:
+    start = time.perf_counter()
+    main.rebuild_combined_stock()
+    return time.perf_counter() - start
+
+
+def main_benchmark():
+    with mock_aws():
+        import main
+        logging.getLogger().setLevel(logging.WARNING)
+        main.s3.create_bucket(Bucket=main.CONFIG["AWS_BUCKET"])
+
+        for i in range(SUPPLIERS):
+            put_supplier(main, f"s{i:03d}", i)
+
+        cold = timed_rebuild(main)
+
+        put_supplier(main, "s042", 10_042)
+        incremental = timed_rebuild(main)
+
+        main.supplier_frame_cache.clear()
+        put_supplier(main, "s042", 20_042)
+        full = timed_rebuild(main)
+
+        print(f"{SUPPLIERS} suppliers x {STONES_PER_SUPPLIER} stones")
+        print(f"cold rebuild (empty cache):        {cold:7.2f} s")
+        print(f"full rebuild, 1 changed supplier:  {full:7.2f} s")
+        print(f"incremental, 1 changed supplier:   {incremental:7.2f} s")
+        print(f"speedup:                           {full / incremental:7.1f}x")
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,87 @@
+"""Benchmark: inverted search index vs. per-query string masks on 100k stones
+
+    python benchmarks/bench_search_index.py
+"""
+import os
+import sys
+import time
+import logging
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+STONES = 100_000
+QUERIES = 200
+
+SHAPES = ["Round", "Oval", "Princess", "Pear", "Emerald", "Cushion", "Marquise", "Heart"]
+COLORS = list("DEFGHIJKLM")
+CLARITIES = ["FL", "IF", "VVS1", "VVS2", "VS1", "VS2", "SI1", "SI2", "I1"]
+TYPES = ["Natural", "LGD", "HPHT", "CVD"]
+
+
+def make_stock(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(7)
+    return pd.DataFrame({
+        "Stock #": [f"S{i}" for i in range(n)],
+        "Shape": rng.choice(SHAPES, n),
+        "Weight": np.round(rng.uniform(0.3, 5.0, n), 2),
+        "Color": rng.choice(COLORS, n),
+        "Clarity": rng.choice(CLARITIES, n),
+        "Diamond Type": rng.choice(TYPES, n),
+        "Price Per Carat": rng.integers(1000, 20000, n),
+    })
+
+
+def make_queries(n: int):
+    rng = np.random.default_rng(11)
+    return [{
+        "Shape": list(rng.choice(SHAPES, 2, replace=False)),
+        "Color": list(rng.choice(COLORS, 3, replace=False)),
+        "Clarity": list(rng.choice(CLARITIES, 2, replace=False)),
+        "Diamond Type": list(rng.choice(TYPES, 1)),
+    } for _ in range(n)]
+
+
+def mask_path(df: pd.DataFrame, query) -> pd.DataFrame:
+    """The original handle_search_flow filtering"""
+    filtered_df = df.copy()
+    filtered_df = filtered_df[filtered_df["Shape"].str.lower().isin([s.lower() for s in query["Shape"]])]
+    filtered_df = filtered_df[filtered_df["Color"].str.upper().isin([c.upper() for c in query["Color"]])]
+    filtered_df = filtered_df[filtered_df["Clarity"].str.upper().isin([c.upper() for c in query["Clarity"]])]
+    filtered_df = filtered_df[filtered_df["Diamond Type"].str.lower().isin([t.lower() for t in query["Diamond Type"]])]
+    return filtered_df
+
+
+def main_benchmark():
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+
+    df = make_stock(STONES)
+    queries = make_queries(QUERIES)
+
+    start = time.perf_counter()
+    index = main.StockSearchIndex(df)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = [mask_path(df, q) for q in queries]
+    masks = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = [df[index.mask(q)] for q in queries]
+    indexed = time.perf_counter() - start
+
+    assert all(a.index.equals(b.index) for a, b in zip(expected, results))
+
+    print(f"{STONES:,} stones, {QUERIES} queries (4 filters each)")
+    print(f"index build (once per stock version): {build * 1000:8.1f} ms")
+    print(f"string mask path:   {masks / QUERIES * 1000:8.2f} ms/query")
+    print(f"inverted index:     {indexed / QUERIES * 1000:8.2f} ms/query")
+    print(f"speedup:            {masks / indexed:8.1f}x")
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -1,21 +1,28 @@
 import asyncio
 import pandas as pd
+import numpy as np
 import boto3
 import re
 import tempfile
 import os
 import json
+import gzip
+import openpyxl
 import pytz
 import uuid
 import time
+import random
 import unicodedata
 import uvicorn
 import threading
 import fcntl
+import zlib
+import weakref
 import botocore
+import botocore.config
 import requests
 from io import BytesIO
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 from aiogram import Bot, Dispatcher, types, F, Router
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, BufferedInputFile
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -24,9 +31,9 @@ from aiogram.enums import ParseMode
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Response
 from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
 from contextlib import asynccontextmanager
-from typing import Optional, Dict, Any, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Dict, Any, List, Tuple, NamedTuple, Callable, Iterable, Iterator, FrozenSet
 import logging
-from functools import wraps
 
 # -------- SETUP LOGGING --------
 logging.basicConfig(
@@ -60,6 +67,7 @@ def load_env_config():
         "AWS_SECRET_ACCESS_KEY": os.getenv("AWS_SECRET_ACCESS_KEY"),
         "AWS_REGION": os.getenv("AWS_REGION", "ap-south-1"),
         "AWS_BUCKET": os.getenv("AWS_BUCKET", "diamond-bucket-styleoflife987"),
+        "S3_ENDPOINT_URL": os.getenv("S3_ENDPOINT_URL", ""),
         "PORT": int(os.getenv("PORT", "10000")),
         "PYTHON_VERSION": os.getenv("PYTHON_VERSION", "3.11.0"),
         "SESSION_TIMEOUT": int(os.getenv("SESSION_TIMEOUT", "3600")),
@@ -95,7 +103,9 @@ CONFIG = load_env_config()
 AWS_CONFIG = {
     "aws_access_key_id": CONFIG["AWS_ACCESS_KEY_ID"],
     "aws_secret_access_key": CONFIG["AWS_SECRET_ACCESS_KEY"],
-    "region_name": CONFIG["AWS_REGION"]
+    "region_name": CONFIG["AWS_REGION"],
+    # Point at MinIO or another S3-compatible stand-in for local testing
+    "endpoint_url": CONFIG["S3_ENDPOINT_URL"]
 }
 
 # -------- S3 KEYS --------
@@ -103,43 +113,248 @@ ACCOUNTS_KEY = "users/accounts.xlsx"
 STOCK_KEY = "stock/diamonds.xlsx"
 SUPPLIER_STOCK_FOLDER = "stock/suppliers/"
 COMBINED_STOCK_KEY = "stock/combined/all_suppliers_stock.xlsx"
+COMBINED_STOCK_SNAPSHOT_KEY = "stock/combined/all_suppliers_stock.parquet"
+STOCK_SUMMARY_KEY = "stock/combined/stock_summary.json"
+LOCK_LEDGER_KEY = "stock/locks.json"
 ACTIVITY_LOG_FOLDER = "activity_logs/"
+ACTIVITY_DAY_CACHE_FOLDER = "activity_cache/days/"
+ACTIVITY_ROLLUP_FOLDER = "activity_cache/rollups/"
 DEALS_FOLDER = "deals/"
 DEAL_HISTORY_KEY = "deals/deal_history.xlsx"
+DEAL_INDEX_KEY = "deals/deal_index.json"
 NOTIFICATIONS_FOLDER = "notifications/"
+NOTIFICATION_CURSOR_FOLDER = "notification_cursors/"
 SESSION_KEY = "sessions/logged_in_users.json"
 
+# -------- COMBINED STOCK LAYOUT --------
+COMBINED_STOCK_COLUMNS = [
+    "Stock #", "Availability", "Shape", "Weight", "Color", "Clarity", "Cut", "Polish", "Symmetry",
+    "Fluorescence Color", "Measurements", "Shade", "Milky", "Eye Clean", "Lab", "Report #", "Location",
+    "Treatment", "Discount", "Price Per Carat", "Final Price", "Depth %", "Table %", "Girdle Thin",
+    "Girdle Thick", "Girdle %", "Girdle Condition", "Culet Size", "Culet Condition", "Crown Height",
+    "Crown Angle", "Pavilion Depth", "Pavilion Angle", "Inscription", "Cert comment", "KeyToSymbols",
+    "White Inclusion", "Black Inclusion", "Open Inclusion", "Fancy Color", "Fancy Color Intensity",
+    "Fancy Color Overtone", "Country", "State", "City", "CertFile", "Diamond Video", "Diamond Image",
+    "SUPPLIER", "LOCKED", "Diamond Type", "UPLOADED_AT", "Description",
+    "COLOR_CODE", "CLARITY_CODE", "CUT_CODE", "POLISH_CODE", "SYMMETRY_CODE"
+]
+
+# Columns stored as numbers in the columnar snapshot; everything else is text
+NUMERIC_STOCK_COLUMNS = ["Weight", "Price Per Carat"]
+
+# Columns the bot reads directly; kept in memory even when every cell is blank
+CORE_STOCK_COLUMNS = [
+    "Stock #", "Shape", "Weight", "Color", "Clarity", "Lab", "Price Per Carat",
+    "SUPPLIER", "LOCKED", "Diamond Type"
+]
+
+# Text columns with at most this share of distinct values are held as categoricals
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+# Decimals restored when float32 columns are written back out to Excel
+STOCK_EXPORT_DECIMALS = {"Weight": 4, "Price Per Carat": 2}
+
+# Ordinal grade code per graded column (see DIAMOND GRADING), stored as int8
+GRADE_CODE_COLUMNS = {
+    "Color": "COLOR_CODE",
+    "Clarity": "CLARITY_CODE",
+    "Cut": "CUT_CODE",
+    "Polish": "POLISH_CODE",
+    "Symmetry": "SYMMETRY_CODE"
+}
+
+# Layout of stock workbooks people receive: the grade codes stay in memory and
+# in the snapshot, never in Excel
+EXCEL_STOCK_COLUMNS = [col for col in COMBINED_STOCK_COLUMNS if col not in GRADE_CODE_COLUMNS.values()]
+
 # -------- DISTRIBUTED LOCK FOR STOCK UPDATES --------
+STONE_LOCK_STRIPES = 256
+STOCK_LOCK_TIMEOUT = 30.0
+LOCK_POLL_INTERVAL = 0.005
+LOCK_POLL_MAX_INTERVAL = 0.05
+
+class LockTimeout(TimeoutError):
+    """A lock could not be acquired within its timeout"""
+
+class LockMetrics:
+    """Contention counters per lock scope, shared by sync and async holders"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scopes: Dict[str, Dict[str, float]] = {}
+    
+    def _scope(self, scope: str) -> Dict[str, float]:
+        return self._scopes.setdefault(scope, {
+            "acquired": 0, "timeouts": 0, "waiting": 0,
+            "wait_total": 0.0, "wait_max": 0.0, "hold_total": 0.0, "hold_max": 0.0
+        })
+    
+    def waiting(self, scope: str, delta: int):
+        with self._lock:
+            self._scope(scope)["waiting"] += delta
+    
+    def acquired(self, scope: str, waited: float):
+        with self._lock:
+            stats = self._scope(scope)
+            stats["acquired"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+    
+    def timed_out(self, scope: str):
+        with self._lock:
+            self._scope(scope)["timeouts"] += 1
+    
+    def released(self, scope: str, held: float):
+        with self._lock:
+            stats = self._scope(scope)
+            stats["hold_total"] += held
+            stats["hold_max"] = max(stats["hold_max"], held)
+    
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            report = {}
+            for scope, stats in self._scopes.items():
+                acquired = stats["acquired"] or 1
+                report[scope] = {
+                    "acquired": stats["acquired"],
+                    "timeouts": stats["timeouts"],
+                    "waiting": stats["waiting"],
+                    "avg_wait_ms": round(stats["wait_total"] / acquired * 1000, 2),
+                    "max_wait_ms": round(stats["wait_max"] * 1000, 2),
+                    "avg_hold_ms": round(stats["hold_total"] / acquired * 1000, 2),
+                    "max_hold_ms": round(stats["hold_max"] * 1000, 2)
+                }
+            return report
+
+lock_metrics = LockMetrics()
+
 class DistributedLock:
-    """File-based distributed lock for stock operations"""
-    def __init__(self, lock_key: str):
+    """File-based lock shared by every process on this host
+    
+    From the event loop use `async with`: the wait polls a non-blocking
+    flock and sleeps in between, so other updates keep being served, and
+    waiters in this process get the lock in arrival order. Plain `with`
+    blocks the calling thread and belongs in worker threads only.
+    """
+    # Per event loop, since asyncio.Lock binds to the loop it first waits on
+    _queues = weakref.WeakKeyDictionary()
+    
+    def __init__(self, lock_key: str, scope: Optional[str] = None, timeout: Optional[float] = None):
         self.lock_key = lock_key
+        self.scope = scope or lock_key
+        self.timeout = timeout
         self.lock_file = f"/tmp/lock_{lock_key.replace('/', '_')}"
         self.fd = None
+        self._queue: Optional[asyncio.Lock] = None
+        self._acquired_at = 0.0
     
-    def __enter__(self):
-        self.fd = open(self.lock_file, 'w')
-        fcntl.flock(self.fd, fcntl.LOCK_EX)
+    def _try_flock(self) -> bool:
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+    
+    def _acquired(self, started: float):
+        self._acquired_at = time.monotonic()
+        lock_metrics.acquired(self.scope, self._acquired_at - started)
         logger.debug(f"🔒 Lock acquired: {self.lock_key}")
+    
+    def _abandon(self):
+        """Drop a half-acquired lock after a timeout or cancellation"""
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+        if self._queue is not None:
+            self._queue.release()
+            self._queue = None
+    
+    def _timeout_error(self) -> LockTimeout:
+        lock_metrics.timed_out(self.scope)
+        return LockTimeout(f"Timed out after {self.timeout}s waiting for lock {self.lock_key}")
+    
+    def __enter__(self):
+        started = time.monotonic()
+        lock_metrics.waiting(self.scope, 1)
+        try:
+            self.fd = open(self.lock_file, 'w')
+            if self.timeout is None:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            else:
+                interval = LOCK_POLL_INTERVAL
+                while not self._try_flock():
+                    if time.monotonic() - started >= self.timeout:
+                        self._abandon()
+                        raise self._timeout_error()
+                    time.sleep(interval)
+                    interval = min(interval * 2, LOCK_POLL_MAX_INTERVAL)
+        finally:
+            lock_metrics.waiting(self.scope, -1)
+        self._acquired(started)
+        return self
+    
+    async def __aenter__(self):
+        started = time.monotonic()
+        queues = self._queues.setdefault(asyncio.get_running_loop(), {})
+        queue = queues.setdefault(self.lock_key, asyncio.Lock())
+        lock_metrics.waiting(self.scope, 1)
+        try:
+            async with asyncio.timeout(self.timeout):
+                await queue.acquire()
+                self._queue = queue
+                self.fd = open(self.lock_file, 'w')
+                interval = LOCK_POLL_INTERVAL
+                while not self._try_flock():
+                    await asyncio.sleep(interval)
+                    interval = min(interval * 2, LOCK_POLL_MAX_INTERVAL)
+        except TimeoutError:
+            self._abandon()
+            raise self._timeout_error() from None
+        except BaseException:
+            self._abandon()
+            raise
+        finally:
+            lock_metrics.waiting(self.scope, -1)
+        self._acquired(started)
         return self
     
     def __exit__(self, *args):
         if self.fd:
+            # The lock file stays: deleting it lets a waiter holding the old
+            # inode and a newcomer on a fresh file both "own" the lock
             fcntl.flock(self.fd, fcntl.LOCK_UN)
             self.fd.close()
-            try:
-                os.remove(self.lock_file)
-            except:
-                pass
+            self.fd = None
+            lock_metrics.released(self.scope, time.monotonic() - self._acquired_at)
             logger.debug(f"🔓 Lock released: {self.lock_key}")
+        if self._queue is not None:
+            self._queue.release()
+            self._queue = None
+    
+    async def __aexit__(self, *args):
+        self.__exit__(*args)
+
+class StockLockManager:
+    """Lock scopes for stock writes
+    
+    Scopes are always taken in the order stone -> supplier -> publish, so
+    nested holders cannot deadlock. S3 conditional writes stay the source of
+    truth across hosts; these locks keep writers on one host from racing
+    into needless retries and keep publishes of the combined files ordered.
+    """
+    def stone(self, stone_id: str, timeout: Optional[float] = None) -> DistributedLock:
+        """Lock for one stone's deal/lock state (striped to bound lock files)"""
+        stripe = zlib.crc32(str(stone_id).encode("utf-8")) % STONE_LOCK_STRIPES
+        return DistributedLock(f"stock_stone_{stripe}", scope="stone", timeout=timeout)
+    
+    def supplier(self, supplier: str, timeout: Optional[float] = None) -> DistributedLock:
+        """Lock for one supplier's workbook"""
+        return DistributedLock(f"stock_supplier_{str(supplier).lower()}", scope="supplier", timeout=timeout)
+    
+    def publish(self, timeout: Optional[float] = None) -> DistributedLock:
+        """Short exclusive section for writing the combined snapshot and exports"""
+        return DistributedLock("stock_publish", scope="publish", timeout=timeout)
 
-def atomic_stock_operation(operation_func):
-    """Decorator for atomic stock operations"""
-    @wraps(operation_func)
-    def wrapper(*args, **kwargs):
-        with DistributedLock("stock_update"):
-            return operation_func(*args, **kwargs)
-    return wrapper
+stock_locks = StockLockManager()
 
 # -------- SAFE S3 OPERATIONS WITH RETRY --------
 def safe_s3_operation(operation, fallback=None, max_retries=3):
@@ -157,14 +372,176 @@ def safe_s3_operation(operation, fallback=None, max_retries=3):
             time.sleep(2 ** attempt)  # Exponential backoff: 1, 2, 4 seconds
     return fallback
 
+# -------- CONDITIONAL S3 WRITES --------
+# Read-modify-write of shared objects uses ETag preconditions instead of a
+# host-local lock: a PUT only lands if the object is still the version that
+# was read, otherwise the change is re-applied to a fresh read.
+CAS_MAX_ATTEMPTS = 5
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+class WriteConflict(Exception):
+    """Another writer replaced the object since it was read"""
+
+def is_write_conflict(e: Exception) -> bool:
+    """Check if an S3 error means a conditional write lost the race"""
+    if not isinstance(e, botocore.exceptions.ClientError):
+        return False
+    error = e.response.get("Error", {})
+    status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return error.get("Code") in ("PreconditionFailed", "ConditionalRequestConflict") or status in (409, 412)
+
+def conditional_put(key: str, body: Any, expected_etag: Optional[str], content_type: str) -> str:
+    """PUT only if the object still has expected_etag (None = must not exist yet)
+    
+    Returns the new ETag and raises WriteConflict if someone else wrote first.
+    """
+    precondition = {"IfMatch": expected_etag} if expected_etag else {"IfNoneMatch": "*"}
+    try:
+        response = s3.put_object(
+            Bucket=CONFIG["AWS_BUCKET"],
+            Key=key,
+            Body=body,
+            ContentType=content_type,
+            **precondition
+        )
+    except botocore.exceptions.ClientError as e:
+        if is_write_conflict(e):
+            raise WriteConflict(f"{key} was modified by another writer") from e
+        raise
+    return response["ETag"]
+
+def wait_after_conflict(key: str, attempt: int):
+    """Jittered backoff before re-reading an object that changed under us"""
+    logger.warning(f"⚠️ Write conflict on {key}, retrying ({attempt + 1}/{CAS_MAX_ATTEMPTS})")
+    time.sleep(min(0.05 * 2 ** attempt, 1.0) * random.uniform(0.5, 1.5))
+
+def compare_and_swap(key: str, read: Callable, mutate: Callable, serialize: Callable,
+                     content_type: str = "application/json") -> Optional[Tuple[Any, str]]:
+    """Read-modify-write one object with optimistic concurrency
+    
+    `read()` returns (value, etag) with etag None if the object is missing.
+    `mutate(value)` returns the new value, or None to leave the object as is;
+    it is re-run on a fresh read after every conflict. Returns
+    (new_value, new_etag), or None when mutate declined to write.
+    """
+    for attempt in range(CAS_MAX_ATTEMPTS):
+        value, etag = read()
+        new_value = mutate(value)
+        if new_value is None:
+            return None
+        try:
+            return new_value, conditional_put(key, serialize(new_value), etag, content_type)
+        except WriteConflict:
+            wait_after_conflict(key, attempt)
+    raise WriteConflict(f"{key} kept changing, gave up after {CAS_MAX_ATTEMPTS} attempts")
+
 # -------- INITIALIZE AWS CLIENTS --------
+# Connections shared by the fetch pool and the worker threads writing deals,
+# notifications and stock; botocore's default of 10 would make them queue
+S3_MAX_POOL_CONNECTIONS = 32
+S3_FETCH_CONCURRENCY = 16
+
 try:
-    s3 = boto3.client("s3", **{k: v for k, v in AWS_CONFIG.items() if v})
+    s3 = boto3.client(
+        "s3",
+        config=botocore.config.Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+        **{k: v for k, v in AWS_CONFIG.items() if v}
+    )
     logger.info("✅ AWS S3 client initialized")
 except Exception as e:
     logger.error(f"❌ Failed to initialize S3 client: {e}")
     s3 = None
 
+# -------- S3 FETCH POOL --------
+class S3FetchPool:
+    """Bounded thread pool for reading many S3 objects at once
+    
+    Sized below the client's connection pool, so parallel reads reuse
+    connections instead of waiting for one. Must not be used from inside
+    its own workers.
+    """
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="s3-fetch")
+            return self._executor
+    
+    def _fetch_one(self, key: str, parse: Callable[[bytes], Any]) -> Tuple[Any, bool]:
+        """(parsed object or None, whether the read itself failed)"""
+        def _get_object():
+            try:
+                return s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=key)["Body"].read()
+            except botocore.exceptions.ClientError as e:
+                if is_missing_key_error(e):
+                    return None
+                raise
+        
+        # Transient errors are retried per key by safe_s3_operation
+        body = safe_s3_operation(_get_object, fallback=False)
+        if body is False:
+            return None, True
+        if body is None:
+            return None, False
+        try:
+            return parse(body), False
+        except Exception as e:
+            logger.error(f"Failed to parse {key}: {e}")
+            return None, False
+    
+    def fetch(self, keys: Iterable[str], parse: Callable[[bytes], Any] = bytes,
+              failed: Optional[List[str]] = None) -> Iterator[Tuple[str, Any]]:
+        """Yield (key, parsed object) as each read completes
+        
+        The parsed value is None when the object is missing or unreadable.
+        Keys whose read failed even after retries (not missing, not corrupt)
+        are also appended to `failed`, for callers that must not mistake an
+        outage for an absent object.
+        """
+        futures = {self.executor.submit(self._fetch_one, key, parse): key for key in keys}
+        for future in as_completed(futures):
+            value, read_failed = future.result()
+            if read_failed and failed is not None:
+                failed.append(futures[future])
+            yield futures[future], value
+    
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+s3_fetch_pool = S3FetchPool(S3_FETCH_CONCURRENCY)
+
+def iter_s3_pages(prefix: str, suffix: Optional[str] = None, start_after: Optional[str] = None,
+                  end_before: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+    """Stream a prefix listing one page (up to 1000 objects) at a time
+    
+    Keys arrive in lexicographic order, so date-partitioned prefixes such as
+    activity_logs/YYYY-MM-DD/ can be pruned: `start_after` skips every key
+    up to and including it, and listing stops at the first key >= `end_before`.
+    """
+    params = {"Bucket": CONFIG["AWS_BUCKET"], "Prefix": prefix}
+    if start_after:
+        params["StartAfter"] = start_after
+    
+    for page in s3.get_paginator("list_objects_v2").paginate(**params):
+        objects = page.get("Contents", [])
+        finished = end_before is not None and bool(objects) and objects[-1]["Key"] >= end_before
+        if finished:
+            objects = [obj for obj in objects if obj["Key"] < end_before]
+        if suffix:
+            objects = [obj for obj in objects if obj["Key"].endswith(suffix)]
+        if objects:
+            yield objects
+        if finished:
+            return
+
 # -------- INITIALIZE BOT --------
 bot = Bot(token=CONFIG["BOT_TOKEN"], parse_mode=ParseMode.HTML)
 dp = Dispatcher()
@@ -185,6 +562,7 @@ admin_kb = ReplyKeyboardMarkup(
         [KeyboardButton(text="🏆 Supplier Leaderboard")],
         [KeyboardButton(text="🤝 View Deals")],
         [KeyboardButton(text="📑 User Activity Report")],
+        [KeyboardButton(text="📊 Activity Summary")],
         [KeyboardButton(text="🗑 Delete Supplier Stock")],
         [KeyboardButton(text="🚪 Logout")]
     ],
@@ -298,26 +676,63 @@ def get_logged_user(uid: int) -> Optional[Dict[str, Any]]:
     user["last_active"] = time.time()
     return user
 
-def touch_session(uid: int):
-    """Update user's last active time"""
+def touch_session(uid: int) -> bool:
+    """Update user's last active time; True when the sessions are due a save
+    
+    Activity alone is saved at most every SESSION_TOUCH_SAVE_INTERVAL, so
+    ordinary messages do not each cost an S3 read and write.
+    """
     if uid in logged_in_users:
         logged_in_users[uid]["last_active"] = time.time()
-        save_sessions()
+        return time.time() - sessions_saved_at >= SESSION_TOUCH_SAVE_INTERVAL
+    return False
 
 # -------- SESSION MANAGEMENT --------
+# Well below SESSION_TIMEOUT, so a saved session is never mistaken for an expired one
+SESSION_TOUCH_SAVE_INTERVAL = 60  # seconds
+# Session keys this process last wrote, so sessions it ended can be told
+# apart from sessions another instance created
+saved_session_keys = set()
+sessions_saved_at = 0.0
+
 def save_sessions():
-    """Save sessions to S3"""
-    def _save():
-        if s3:
-            s3.put_object(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Key=SESSION_KEY,
-                Body=json.dumps(logged_in_users, default=str),
-                ContentType="application/json"
-            )
-            logger.info(f"✅ Saved {len(logged_in_users)} active sessions")
+    """Save sessions to S3, merged with sessions saved by other instances"""
+    global sessions_saved_at
+    if not s3:
+        return
+    
+    # Runs in worker threads too: copy before the loop changes the dict
+    local = {str(uid): dict(data) for uid, data in list(logged_in_users.items())}
+    ended = saved_session_keys - set(local)
+    
+    def _read():
+        def _get_sessions():
+            try:
+                obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=SESSION_KEY)
+                return json.loads(obj["Body"].read()), obj["ETag"]
+            except botocore.exceptions.ClientError as e:
+                if is_missing_key_error(e):
+                    return {}, None
+                raise
+        
+        return safe_s3_operation(_get_sessions, fallback=({}, None))
+    
+    def _merge(remote: Dict[str, Dict]) -> Dict[str, Dict]:
+        merged = {key: data for key, data in remote.items() if key not in ended}
+        for key, data in local.items():
+            theirs = merged.get(key)
+            if theirs is None or theirs.get("last_active", 0) <= data.get("last_active", 0):
+                merged[key] = data
+        return merged
     
-    safe_s3_operation(_save)
+    try:
+        merged, _ = compare_and_swap(SESSION_KEY, _read, _merge, lambda data: json.dumps(data, default=str))
+        saved_session_keys.clear()
+        saved_session_keys.update(local)
+        sessions_saved_at = time.time()
+        logger.info(f"✅ Saved {len(merged)} active sessions")
+    except Exception as e:
+        logger.error(f"❌ Failed to save sessions: {e}")
 
 def load_sessions():
     """Load sessions from S3"""
@@ -331,6 +746,7 @@ def load_sessions():
             raw = safe_s3_operation(_load, fallback={})
             if raw:
                 logged_in_users = {int(k) if k.isdigit() else k: v for k, v in raw.items()}
+                saved_session_keys.update(raw)
                 logger.info(f"✅ Loaded {len(logged_in_users)} sessions from S3")
     except Exception as e:
         logger.warning(f"⚠️ No existing sessions or error loading: {e}")
@@ -371,68 +787,356 @@ def is_rate_limited(uid: int) -> bool:
     user_rate_limit[uid] = history[-10:]
     return False
 
+# -------- STOCK CACHE --------
+class StockCache:
+    """Process-wide cache of the parsed combined stock, keyed by the S3 ETag"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.df = None
+        self.etag = None
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.raw_bytes = None
+        self.view = None
+        self.locks_etag = None
+        self._derived = {}
+    
+    def get(self, etag: str) -> Optional[pd.DataFrame]:
+        """Return the cached frame if it was loaded from this ETag"""
+        with self._lock:
+            if self.df is not None and self.etag == etag:
+                self.hits += 1
+                return self.df
+            self.misses += 1
+            return None
+    
+    def store(self, df: pd.DataFrame, etag: Optional[str], raw_bytes: Optional[int] = None):
+        """Cache a freshly parsed frame; raw_bytes is its size before compaction"""
+        with self._lock:
+            self.df = df
+            self.etag = etag
+            self.raw_bytes = raw_bytes
+            self.view = None
+            self.locks_etag = None
+            self.version += 1
+            self._derived.clear()
+    
+    def invalidate(self):
+        """Drop the cached frame after a local write"""
+        with self._lock:
+            self.df = None
+            self.etag = None
+            self.raw_bytes = None
+            self.view = None
+            self.locks_etag = None
+            self.version += 1
+            self.invalidations += 1
+            self._derived.clear()
+    
+    def get_view(self, df: pd.DataFrame, locks_etag: Optional[str]) -> Optional[pd.DataFrame]:
+        """Return the lock-ledger view of `df` if it was built from this ledger ETag"""
+        with self._lock:
+            if self.view is not None and self.df is df and self.locks_etag == locks_etag:
+                return self.view
+            return None
+    
+    def store_view(self, df: pd.DataFrame, view: pd.DataFrame, locks_etag: Optional[str]):
+        """Cache the lock-ledger view of the cached frame"""
+        with self._lock:
+            if self.df is df:
+                self.view = view
+                self.locks_etag = locks_etag
+    
+    def derived(self, name: str, df: pd.DataFrame, builder):
+        """Memoize a structure built from the cached frame (indexes, aggregates)
+        
+        Results are kept only while `df` is the cached frame or its lock-ledger
+        view, so they are rebuilt exactly once per stock version. Builders
+        must therefore not depend on LOCKED.
+        """
+        with self._lock:
+            current = df is self.df or (df is self.view and self.view is not None)
+            if current and name in self._derived:
+                return self._derived[name]
+        
+        value = builder(df)
+        
+        with self._lock:
+            if df is self.df or (df is self.view and self.view is not None):
+                self._derived.setdefault(name, value)
+        return value
+    
+    def stats(self) -> Dict[str, Any]:
+        """Counters for /status"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "cached": self.df is not None,
+                "rows": len(self.df) if self.df is not None else 0,
+                "etag": self.etag,
+                "locks_etag": self.locks_etag,
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "derived": sorted(self._derived),
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None
+            }
+    
+    def memory_report(self) -> Dict[str, Any]:
+        """Memory of the cached frame as parsed vs. after compaction, for /debug/memory"""
+        with self._lock:
+            df, raw_bytes, version = self.df, self.raw_bytes, self.version
+        if df is None:
+            return {"cached": False, "version": version}
+        
+        usage = df.memory_usage(deep=True, index=False)
+        compact_bytes = int(usage.sum())
+        return {
+            "cached": True,
+            "version": version,
+            "rows": len(df),
+            "columns": len(df.columns),
+            "raw_bytes": raw_bytes,
+            "compact_bytes": compact_bytes,
+            "saved_pct": round(100 * (1 - compact_bytes / raw_bytes), 1) if raw_bytes else None,
+            "by_column": {
+                col: {"dtype": str(df[col].dtype), "bytes": int(usage[col])}
+                for col in df.columns
+            }
+        }
+
+stock_cache = StockCache()
+
 # -------- DATA LOADING/SAVING --------
-def load_accounts() -> pd.DataFrame:
-    """Load accounts from Excel file in S3"""
+def load_accounts_with_etag() -> Tuple[pd.DataFrame, Optional[str]]:
+    """Load accounts from Excel file in S3, with the ETag they were read at"""
     try:
         if not s3:
-            return pd.DataFrame(columns=["USERNAME", "PASSWORD", "ROLE", "APPROVED"])
+            return pd.DataFrame(columns=["USERNAME", "PASSWORD", "ROLE", "APPROVED"]), None
         
-        with TempFileManager(suffix=".xlsx") as local_path:
-            def _download():
-                s3.download_file(CONFIG["AWS_BUCKET"], ACCOUNTS_KEY, local_path)
-                return True
-            
-            if not safe_s3_operation(_download, fallback=False):
-                return pd.DataFrame(columns=["USERNAME", "PASSWORD", "ROLE", "APPROVED"])
-            
-            df = pd.read_excel(local_path, dtype=str)
-            
-            required_cols = ["USERNAME", "PASSWORD", "ROLE", "APPROVED"]
-            for col in required_cols:
-                if col not in df.columns:
-                    raise ValueError(f"Missing required column: {col}")
-                
-                df[col] = df[col].fillna("").astype(str).apply(clean_text)
-            
-            df["PASSWORD"] = df["PASSWORD"].apply(clean_password)
-            
-            logger.info(f"✅ Loaded {len(df)} accounts from S3")
+        def _download():
+            try:
+                obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=ACCOUNTS_KEY)
+                return obj["Body"].read(), obj["ETag"]
+            except botocore.exceptions.ClientError as e:
+                if is_missing_key_error(e):
+                    return None, None
+                raise
+        
+        raw, etag = safe_s3_operation(_download, fallback=(None, None))
+        if raw is None:
+            return pd.DataFrame(columns=["USERNAME", "PASSWORD", "ROLE", "APPROVED"]), None
+        
+        df = pd.read_excel(BytesIO(raw), dtype=str)
+        
+        required_cols = ["USERNAME", "PASSWORD", "ROLE", "APPROVED"]
+        for col in required_cols:
+            if col not in df.columns:
+                raise ValueError(f"Missing required column: {col}")
             
-            return df
+            df[col] = df[col].fillna("").astype(str).apply(clean_text)
+        
+        df["PASSWORD"] = df["PASSWORD"].apply(clean_password)
+        
+        logger.info(f"✅ Loaded {len(df)} accounts from S3")
+        
+        return df, etag
         
     except Exception as e:
         logger.error(f"❌ Failed to load accounts: {e}")
-        return pd.DataFrame(columns=["USERNAME", "PASSWORD", "ROLE", "APPROVED"])
+        return pd.DataFrame(columns=["USERNAME", "PASSWORD", "ROLE", "APPROVED"]), None
+
+def load_accounts() -> pd.DataFrame:
+    """Load accounts from Excel file in S3"""
+    return load_accounts_with_etag()[0]
 
-def save_accounts(df: pd.DataFrame):
-    """Save accounts to Excel file in S3"""
+def update_accounts(mutate: Callable[[pd.DataFrame], Optional[pd.DataFrame]]) -> bool:
+    """Read-modify-write accounts, re-applying `mutate` if another writer saved first
+    
+    `mutate(df)` returns the accounts to save, or None to leave them as is.
+    """
     if READ_ONLY_ACCOUNTS:
         logger.warning("⚠️ Accounts file is READ ONLY. Skipping save.")
-        return
+        return False
+    
+    if not s3:
+        logger.error("❌ S3 client not available")
+        return False
+    
+    def _serialize(df: pd.DataFrame) -> bytes:
+        buffer = BytesIO()
+        df.to_excel(buffer, index=False)
+        return buffer.getvalue()
     
     try:
-        if not s3:
-            logger.error("❌ S3 client not available")
-            return
-        
-        with TempFileManager(suffix=".xlsx") as local_path:
-            df.to_excel(local_path, index=False)
-            
-            def _upload():
-                s3.upload_file(local_path, CONFIG["AWS_BUCKET"], ACCOUNTS_KEY)
-            
-            safe_s3_operation(_upload)
-            logger.info(f"✅ Saved {len(df)} accounts to S3")
+        result = compare_and_swap(ACCOUNTS_KEY, load_accounts_with_etag, mutate, _serialize, XLSX_CONTENT_TYPE)
     except Exception as e:
         logger.error(f"❌ Failed to save accounts: {e}")
+        return False
+    
+    if result is None:
+        return False
+    logger.info(f"✅ Saved {len(result[0])} accounts to S3")
+    return True
+
+def is_missing_key_error(e: Exception) -> bool:
+    """Check if an S3 error means the object does not exist"""
+    if not isinstance(e, botocore.exceptions.ClientError):
+        return False
+    return e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+def to_stock_snapshot_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Coerce stock columns to stable types for the columnar snapshot"""
+    df = df.copy()
+    for col in df.columns:
+        if col in NUMERIC_STOCK_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+        elif col in GRADE_CODE_COLUMNS.values():
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(UNGRADED).astype("int8")
+        elif df[col].dtype == object:
+            # Mixed str/int cells (e.g. Report #) are not valid Arrow columns
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def is_empty_column(values: pd.Series) -> bool:
+    """Check if a column holds nothing but NaN and blank strings"""
+    present = values.dropna()
+    if present.dtype == object or isinstance(present.dtype, pd.CategoricalDtype):
+        present = present[present.astype(str).str.strip() != ""]
+    return present.empty
+
+def narrow_price_column(values: pd.Series) -> pd.Series:
+    """Prices as int32 when they are all whole numbers, float32 otherwise"""
+    prices = pd.to_numeric(values, errors="coerce")
+    if len(prices) and prices.notna().all() and (prices % 1 == 0).all() and prices.abs().max() < 2 ** 31:
+        return prices.astype("int32")
+    return prices.astype("float32")
+
+def compact_stock_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """In-memory stock schema: categoricals, narrow numerics and no all-blank columns
+    
+    Excel writers and message formatting go through widen_stock_frame,
+    which restores float64 numbers and the full column layout.
+    """
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if col == "Weight":
+            columns[col] = pd.to_numeric(values, errors="coerce").astype("float32")
+        elif col in NUMERIC_STOCK_COLUMNS:
+            columns[col] = narrow_price_column(values)
+        elif col in GRADE_CODE_COLUMNS.values():
+            columns[col] = pd.to_numeric(values, errors="coerce").fillna(UNGRADED).astype("int8")
+        elif col not in CORE_STOCK_COLUMNS and is_empty_column(values):
+            continue
+        elif values.dtype == object and (
+            col == "LOCKED" or values.nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(values)
+        ):
+            # Categories must be one type (mixed str/int cells come from Excel)
+            text = values.where(values.isna(), values.astype(str)).astype("category")
+            if col == "LOCKED":
+                # Lock/unlock assign in place, so both flags must always be valid
+                missing = [flag for flag in ("NO", "YES") if flag not in text.cat.categories]
+                text = text.cat.add_categories(missing)
+            columns[col] = text
+        else:
+            columns[col] = values
+    return pd.DataFrame(columns, index=df.index)
+
+def widen_stock_frame(df: pd.DataFrame, layout: Optional[List[str]] = None) -> pd.DataFrame:
+    """Undo compact_stock_frame for display, totals and Excel output
+    
+    float32 columns go back to float64 rounded to their usual precision, and
+    columns dropped as blank are restored as empty when a layout is given.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == np.float32:
+            df[col] = df[col].astype("float64").round(STOCK_EXPORT_DECIMALS.get(col, 4))
+    if layout:
+        df = df.reindex(columns=layout + [c for c in df.columns if c not in layout], fill_value="")
+    return df
+
+def excel_stock_frame(df: pd.DataFrame, layout: Optional[List[str]] = EXCEL_STOCK_COLUMNS) -> pd.DataFrame:
+    """widen_stock_frame for Excel output, without the internal grade code columns"""
+    internal = [col for col in GRADE_CODE_COLUMNS.values() if col in df.columns]
+    return widen_stock_frame(df.drop(columns=internal), layout)
+
+def cache_stock_frame(df: pd.DataFrame, etag: Optional[str]) -> pd.DataFrame:
+    """Compact a freshly parsed frame and make it the cached stock version"""
+    raw_bytes = int(df.memory_usage(deep=True).sum())
+    df = compact_stock_frame(df)
+    stock_cache.store(df, etag, raw_bytes=raw_bytes)
+    return df
 
-def load_stock() -> pd.DataFrame:
-    """Load combined stock from S3"""
+def get_object_etag(key: str) -> Optional[str]:
+    """HEAD an S3 object and return its ETag, None if it does not exist"""
+    def _head():
+        try:
+            return s3.head_object(Bucket=CONFIG["AWS_BUCKET"], Key=key)["ETag"]
+        except botocore.exceptions.ClientError as e:
+            if is_missing_key_error(e):
+                return None
+            raise
+    
+    return safe_s3_operation(_head, fallback=None)
+
+def load_stock_snapshot() -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """Load combined stock from the columnar snapshot, (None, None) if unavailable"""
+    def _get_snapshot():
+        try:
+            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=COMBINED_STOCK_SNAPSHOT_KEY)
+            return obj["Body"].read(), obj.get("ETag")
+        except botocore.exceptions.ClientError as e:
+            if is_missing_key_error(e):
+                return None
+            raise
+    
+    result = safe_s3_operation(_get_snapshot, fallback=None)
+    if not result:
+        return None, None
+    
+    raw, etag = result
+    try:
+        return pd.read_parquet(BytesIO(raw)), etag
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to read stock snapshot, falling back to Excel: {e}")
+        return None, None
+
+def load_stock(copy: bool = True) -> pd.DataFrame:
+    """Load combined stock, served from the in-process cache while the S3 ETag is unchanged
+    
+    Returns a copy, so callers are free to add or overwrite columns. With
+    copy=False the cached frame itself is returned and must not be modified.
+    """
     try:
         if not s3:
             return pd.DataFrame()
         
+        # One HEAD decides whether the cached frame is still current
+        etag = get_object_etag(COMBINED_STOCK_SNAPSHOT_KEY)
+        use_snapshot = etag is not None
+        if not use_snapshot:
+            etag = get_object_etag(COMBINED_STOCK_KEY)
+            if etag is None:
+                stock_cache.invalidate()
+                return pd.DataFrame()
+        
+        cached = stock_cache.get(etag)
+        if cached is not None:
+            df = with_lock_ledger(cached)
+            return df.copy() if copy else df
+        
+        if use_snapshot:
+            df, snapshot_etag = load_stock_snapshot()
+            if df is not None:
+                df = with_lock_ledger(cache_stock_frame(df, snapshot_etag or etag))
+                logger.info(f"✅ Loaded {len(df)} stock items from snapshot")
+                return df.copy() if copy else df
+        
         with TempFileManager(suffix=".xlsx") as local_path:
             def _download():
                 s3.download_file(CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY, local_path)
@@ -442,21 +1146,274 @@ def load_stock() -> pd.DataFrame:
                 return pd.DataFrame()
             
             df = pd.read_excel(local_path)
+            if use_snapshot:
+                df = compact_stock_frame(df)
+            else:
+                df = cache_stock_frame(df, etag)
+            df = with_lock_ledger(df)
             logger.info(f"✅ Loaded {len(df)} stock items from S3")
-            return df
+            return df.copy() if copy else df
     except Exception as e:
         logger.warning(f"⚠️ Failed to load stock: {e}")
         return pd.DataFrame()
 
+def build_stock_summary(df: pd.DataFrame) -> Dict[str, Any]:
+    """Totals, shape counts and per-supplier stats behind the admin stock screens"""
+    weights = pd.to_numeric(df["Weight"], errors="coerce").astype("float64").round(4)
+    prices = pd.to_numeric(df["Price Per Carat"], errors="coerce").astype("float64")
+    values = weights * prices
+    
+    supplier_stats = pd.DataFrame({
+        "Weight": weights, "Price": prices, "Value": values
+    }).groupby(df["SUPPLIER"], observed=True).agg(
+        Stones=("Weight", "size"),
+        Total_Carats=("Weight", "sum"),
+        Avg_Price_Per_Carat=("Price", "mean"),
+        Total_Value=("Value", "sum")
+    ).fillna(0).round(2).sort_values("Stones", ascending=False, kind="stable")
+    
+    shape_counts = df["Shape"].value_counts()
+    
+    return {
+        "generated_at": datetime.now(IST).isoformat(),
+        "total_diamonds": len(df),
+        "total_carats": round(float(weights.sum()), 4),
+        "total_value": round(float(values.sum()), 2),
+        "supplier_count": int(df["SUPPLIER"].nunique()),
+        "shape_counts": {str(shape): int(count) for shape, count in shape_counts[shape_counts > 0].items()},
+        "suppliers": [
+            {"SUPPLIER": str(supplier), **{k: (int(v) if k == "Stones" else float(v)) for k, v in stats.items()}}
+            for supplier, stats in supplier_stats.iterrows()
+        ]
+    }
+
+def save_stock_summary(df: pd.DataFrame, snapshot_etag: str) -> Optional[Dict[str, Any]]:
+    """Publish the stock summary, tagged with the snapshot ETag it describes
+    
+    Two publishers may write their summaries in either order; the tag lets
+    readers notice one that does not match the winning snapshot.
+    """
+    try:
+        summary = {**build_stock_summary(df), "snapshot_etag": snapshot_etag}
+        body = json.dumps(summary, indent=2)
+    except Exception as e:
+        logger.error(f"❌ Failed to build stock summary: {e}")
+        return None
+    
+    def _upload():
+        return s3.put_object(
+            Bucket=CONFIG["AWS_BUCKET"],
+            Key=STOCK_SUMMARY_KEY,
+            Body=body,
+            ContentType="application/json"
+        )
+    
+    if not safe_s3_operation(_upload, fallback=None):
+        logger.error("❌ Failed to upload stock summary")
+    return summary
+
+def load_stock_summary() -> Optional[Dict[str, Any]]:
+    """Load the published stock summary, recomputing it if it does not describe the current snapshot"""
+    if not s3:
+        return None
+    
+    # Taken before any load, so a publish in between leaves an outdated tag, never a wrong one
+    snapshot_etag = get_object_etag(COMBINED_STOCK_SNAPSHOT_KEY)
+    
+    def _get_summary():
+        try:
+            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=STOCK_SUMMARY_KEY)
+            return json.loads(obj["Body"].read())
+        except botocore.exceptions.ClientError as e:
+            if is_missing_key_error(e):
+                return None
+            raise
+    
+    summary = safe_s3_operation(_get_summary, fallback=None)
+    if summary is not None and (snapshot_etag is None or summary.get("snapshot_etag") == snapshot_etag):
+        return summary
+    
+    df = load_stock(copy=False)
+    if df.empty:
+        return None
+    if snapshot_etag is None:
+        return build_stock_summary(df)
+    return save_stock_summary(df, snapshot_etag)
+
+def save_combined_stock(df: pd.DataFrame, expected_etag: Optional[str] = None, conditional: bool = False) -> bool:
+    """Publish combined stock as a Parquet snapshot plus its summary
+    
+    The Excel workbook is not written here; export_combined_stock produces
+    it on demand. With conditional=True the snapshot is only replaced if it
+    still has expected_etag (None = not created yet); otherwise
+    WriteConflict is raised before anything has been written.
+    """
+    if not s3:
+        return False
+    
+    buffer = BytesIO()
+    to_stock_snapshot_frame(df).to_parquet(buffer, index=False, compression="zstd")
+    snapshot = buffer.getvalue()
+    
+    if conditional:
+        snapshot_etag = conditional_put(
+            COMBINED_STOCK_SNAPSHOT_KEY, snapshot, expected_etag, "application/vnd.apache.parquet"
+        )
+    else:
+        def _upload_snapshot():
+            return s3.put_object(
+                Bucket=CONFIG["AWS_BUCKET"],
+                Key=COMBINED_STOCK_SNAPSHOT_KEY,
+                Body=snapshot,
+                ContentType="application/vnd.apache.parquet"
+            )
+        
+        response = safe_s3_operation(_upload_snapshot, fallback=None)
+        snapshot_etag = response.get("ETag") if response else None
+    
+    # Whatever happens below, the cached frame no longer reflects S3
+    stock_cache.invalidate()
+    
+    if snapshot_etag is None:
+        return False
+    
+    save_stock_summary(df, snapshot_etag)
+    
+    # Prime the cache with exactly what other readers will parse
+    cache_stock_frame(pd.read_parquet(BytesIO(snapshot)), snapshot_etag)
+    return True
+
+def update_combined_stock(mutate: Callable[[pd.DataFrame], Optional[pd.DataFrame]]) -> bool:
+    """Read-modify-publish combined stock with optimistic concurrency
+    
+    `mutate(df)` receives the current (read-only) stock and returns the frame
+    to publish, or None to leave stock unchanged. It is re-run on a fresh
+    read whenever another writer published in between.
+    """
+    for attempt in range(CAS_MAX_ATTEMPTS):
+        # Taken before the read, so a publish in between always fails the precondition
+        etag = get_object_etag(COMBINED_STOCK_SNAPSHOT_KEY)
+        new_df = mutate(load_stock(copy=False))
+        if new_df is None:
+            return False
+        try:
+            with stock_locks.publish():
+                return save_combined_stock(new_df, expected_etag=etag, conditional=True)
+        except WriteConflict:
+            wait_after_conflict(COMBINED_STOCK_SNAPSHOT_KEY, attempt)
+    logger.error("❌ Gave up publishing combined stock after repeated conflicts")
+    return False
+
 # -------- ACTIVITY LOGGING --------
+ACTIVITY_FLUSH_INTERVAL = 30  # seconds
+ACTIVITY_FLUSH_MAX_ENTRIES = 500
+# Entries kept while S3 is unreachable before the oldest are dropped
+ACTIVITY_BUFFER_LIMIT = 10 * ACTIVITY_FLUSH_MAX_ENTRIES
+# Legacy per-user daily files and the append-only segments written now
+ACTIVITY_LOG_SUFFIXES = (".json", ".jsonl.gz")
+ACTIVITY_REPORT_DAYS = 30
+# Cached days read in parallel while a range is iterated; bounds the entries held at once
+ACTIVITY_CACHE_BATCH_DAYS = 7
+# A day's partition is treated as final this long after it ends (late flushes)
+ACTIVITY_DAY_CLOSE_GRACE = timedelta(hours=1)
+ACTIVITY_REPORT_COLUMNS = ["Date", "Time", "Login ID", "Role", "Action", "Details"]
+ACTIVITY_SUMMARY_DAYS = 30
+ACTIVITY_ROLLUP_INTERVAL = 3600  # seconds
+# Actions the summary reports as their own totals
+DEAL_REQUEST_ACTIONS = ("REQUEST_DEAL", "BULK_DEAL_REQUEST")
+UPLOAD_ACTIONS = ("UPLOAD_STOCK", "API_UPLOAD_STOCK")
+
+class ActivityLogBuffer:
+    """Write-behind buffer for activity entries
+    
+    Logging only appends in memory. Flushes write immutable gzipped JSON
+    Lines segments, activity_logs/<date>/<flush id>.jsonl.gz, so events are
+    never lost to concurrent read-modify-writes of a shared file.
+    """
+    def __init__(self, max_entries: int, limit: int):
+        self.max_entries = max_entries
+        self.limit = limit
+        self._entries: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_pending = False
+        self.segments_written = 0
+        self.dropped = 0
+    
+    def add(self, entry: Dict[str, Any]):
+        with self._lock:
+            self._entries.append(entry)
+            start_flush = len(self._entries) >= self.max_entries and not self._flush_pending
+            if start_flush:
+                self._flush_pending = True
+        if start_flush:
+            threading.Thread(target=self.flush, name="activity-flush", daemon=True).start()
+    
+    def flush(self) -> int:
+        """Write buffered entries to S3; returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                entries, self._entries = self._entries, []
+                self._flush_pending = False
+            if not entries or not s3:
+                return 0
+            
+            by_date: Dict[str, List[Dict[str, Any]]] = {}
+            for entry in entries:
+                by_date.setdefault(entry["date"], []).append(entry)
+            
+            written = 0
+            failed: List[Dict[str, Any]] = []
+            # time_ns first, so segments list in the order they were flushed
+            flush_id = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+            for day, day_entries in by_date.items():
+                body = gzip.compress("\n".join(json.dumps(entry) for entry in day_entries).encode("utf-8"))
+                
+                def _put_segment():
+                    s3.put_object(
+                        Bucket=CONFIG["AWS_BUCKET"],
+                        Key=f"{ACTIVITY_LOG_FOLDER}{day}/{flush_id}.jsonl.gz",
+                        Body=body,
+                        ContentType="application/x-ndjson"
+                    )
+                    return True
+                
+                if safe_s3_operation(_put_segment, fallback=False):
+                    written += len(day_entries)
+                    self.segments_written += 1
+                else:
+                    failed.extend(day_entries)
+            
+            if failed:
+                self._requeue(failed)
+            if written:
+                logger.info(f"📝 Flushed {written} activity entries")
+            return written
+    
+    def _requeue(self, entries: List[Dict[str, Any]]):
+        """Put unwritten entries back in front, dropping the oldest past the limit"""
+        with self._lock:
+            self._entries = entries + self._entries
+            overflow = len(self._entries) - self.limit
+            if overflow > 0:
+                self._entries = self._entries[overflow:]
+                self.dropped += overflow
+                logger.warning(f"⚠️ Activity buffer full, dropped {overflow} oldest entries")
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"buffered": len(self._entries), "segments_written": self.segments_written, "dropped": self.dropped}
+
+activity_log = ActivityLogBuffer(ACTIVITY_FLUSH_MAX_ENTRIES, ACTIVITY_BUFFER_LIMIT)
+
 def log_activity(user: Dict[str, Any], action: str, details: Optional[Dict] = None):
-    """Log user activity to S3"""
+    """Buffer a user activity entry; it reaches S3 with the next flush"""
     try:
         if not s3:
             return
             
         ist_time = datetime.now(IST)
-        log_entry = {
+        activity_log.add({
             "date": ist_time.strftime("%Y-%m-%d"),
             "time": ist_time.strftime("%H:%M:%S"),
             "login_id": user.get("USERNAME"),
@@ -464,167 +1421,739 @@ def log_activity(user: Dict[str, Any], action: str, details: Optional[Dict] = No
             "action": action,
             "details": details or {},
             "telegram_id": user.get("TELEGRAM_ID", "N/A")
-        }
-        
-        key = f"{ACTIVITY_LOG_FOLDER}{log_entry['date']}/{log_entry['login_id']}.json"
-        
-        def _get_log():
-            try:
-                obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=key)
-                return json.loads(obj["Body"].read())
-            except:
-                return []
-        
-        data = safe_s3_operation(_get_log, fallback=[])
-        
-        data.append(log_entry)
-        
-        def _save_log():
-            s3.put_object(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Key=key,
-                Body=json.dumps(data, indent=2),
-                ContentType="application/json"
-            )
-        
-        safe_s3_operation(_save_log)
+        })
         logger.info(f"📝 Logged activity: {user.get('USERNAME')} - {action}")
         
     except Exception as e:
         logger.error(f"❌ Failed to log activity: {e}")
 
-def generate_activity_excel() -> Optional[str]:
-    """Generate Excel report of all activities"""
+def parse_activity_log(body: bytes) -> List[Dict[str, Any]]:
+    """Entries from a gzipped JSON Lines segment or a legacy JSON array file"""
+    if body[:2] == b"\x1f\x8b":
+        return [json.loads(line) for line in gzip.decompress(body).splitlines() if line.strip()]
+    return json.loads(body)
+
+def is_activity_day_closed(day: date) -> bool:
+    """True once no more segments can land in the day's partition"""
+    day_end = IST.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return datetime.now(IST) >= day_end + ACTIVITY_DAY_CLOSE_GRACE
+
+def first_activity_day() -> Optional[date]:
+    """Oldest day with a raw activity partition (keys list in date order)"""
+    for page in iter_s3_pages(ACTIVITY_LOG_FOLDER):
+        for obj in page:
+            try:
+                return date.fromisoformat(obj["Key"][len(ACTIVITY_LOG_FOLDER):].split("/", 1)[0])
+            except ValueError:
+                continue
+    return None
+
+def read_activity_day(day: date, failed: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """All entries of one day's partition, in time order
+    
+    Segments that could not be read are appended to `failed`; their entries
+    are missing from the result.
+    """
+    entries = []
+    for page in iter_s3_pages(f"{ACTIVITY_LOG_FOLDER}{day.isoformat()}/"):
+        keys = [obj["Key"] for obj in page if obj["Key"].endswith(ACTIVITY_LOG_SUFFIXES)]
+        for key, data in s3_fetch_pool.fetch(keys, parse_activity_log, failed):
+            entries.extend(data or [])
+    entries.sort(key=lambda entry: entry.get("time") or "")
+    return entries
+
+def cache_activity_day(day: date, entries: List[Dict[str, Any]]):
+    """Store a closed day's entries as one object for later reports"""
+    body = gzip.compress("\n".join(json.dumps(entry) for entry in entries).encode("utf-8"))
+    
+    def _put_day():
+        s3.put_object(
+            Bucket=CONFIG["AWS_BUCKET"],
+            Key=f"{ACTIVITY_DAY_CACHE_FOLDER}{day.isoformat()}.jsonl.gz",
+            Body=body,
+            ContentType="application/x-ndjson"
+        )
+    
+    safe_s3_operation(_put_day)
+
+def iter_activity_days(start_date: date, end_date: date,
+                       failed: Optional[List[str]] = None) -> Iterator[Tuple[date, List[Dict[str, Any]]]]:
+    """Yield (day, entries) for each day in the range, oldest first
+    
+    Closed days come from their cached object when one exists; the rest
+    are read from their own date partition, and closed ones get cached
+    unless a segment could not be read. Those segment keys are appended
+    to `failed`.
+    """
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+    cached: Dict[date, List[Dict[str, Any]]] = {}
+    for position, day in enumerate(days):
+        if position % ACTIVITY_CACHE_BATCH_DAYS == 0:
+            # Cached days are fetched a batch ahead, never the whole range at once
+            cache_keys = {
+                f"{ACTIVITY_DAY_CACHE_FOLDER}{batch_day.isoformat()}.jsonl.gz": batch_day
+                for batch_day in days[position:position + ACTIVITY_CACHE_BATCH_DAYS]
+                if is_activity_day_closed(batch_day)
+            }
+            cached = {cache_keys[key]: entries for key, entries in s3_fetch_pool.fetch(cache_keys, parse_activity_log)}
+        
+        entries = cached.pop(day, None)
+        if entries is None:
+            day_failed: List[str] = []
+            entries = read_activity_day(day, day_failed)
+            if day_failed:
+                # A cached day is never re-read, so an incomplete one is not stored
+                logger.warning(f"⚠️ {len(day_failed)} activity segment(s) for {day} could not be read")
+                if failed is not None:
+                    failed.extend(day_failed)
+            elif is_activity_day_closed(day):
+                cache_activity_day(day, entries)
+        yield day, entries
+
+def parse_report_range(text: str, today: date) -> Tuple[Optional[date], date]:
+    """(start, end) from "YYYY-MM-DD to YYYY-MM-DD", one date, a number of days or "all"
+    
+    "all" gives a start of None (from the first recorded day). Raises
+    ValueError for anything else.
+    """
+    text = text.strip().lower()
+    if text == "all":
+        return None, today
+    if text.isdigit():
+        days = int(text)
+        if days < 1:
+            raise ValueError("number of days must be at least 1")
+        return today - timedelta(days=days - 1), today
+    
+    parts = [part for part in re.split(r"\s*(?:to|\.\.|,|\s)\s*", text) if part]
+    if len(parts) not in (1, 2):
+        raise ValueError(f"unrecognised range: {text}")
+    start_date, end_date = date.fromisoformat(parts[0]), date.fromisoformat(parts[-1])
+    if start_date > end_date:
+        raise ValueError("start date is after end date")
+    return start_date, min(end_date, today)
+
+def generate_activity_excel(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                            failed: Optional[List[str]] = None) -> Optional[str]:
+    """Generate Excel report of activities between two dates (inclusive)
+    
+    Defaults to the last ACTIVITY_REPORT_DAYS days. Segments that could not
+    be read are appended to `failed`. The file is not temporary-managed: the
+    caller removes it once it has been sent.
+    """
     try:
         if not s3:
             return None
         
-        def _list_objects():
-            return s3.list_objects_v2(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Prefix=ACTIVITY_LOG_FOLDER
-            )
+        end_date = end_date or datetime.now(IST).date()
+        start_date = start_date or end_date - timedelta(days=ACTIVITY_REPORT_DAYS - 1)
+        
+        # Entries still in the buffer belong in the report too
+        activity_log.flush()
+        
+        # Rows go straight to disk, so a long range never sits in memory as one frame.
+        # The workbook is opened with the first row: an unsaved one cannot be discarded
+        workbook = sheet = None
+        count = 0
+        for _, entries in iter_activity_days(start_date, end_date, failed):
+            for entry in entries:
+                if workbook is None:
+                    workbook = openpyxl.Workbook(write_only=True)
+                    sheet = workbook.create_sheet("Activity")
+                    sheet.append(ACTIVITY_REPORT_COLUMNS)
+                sheet.append([safe_excel(value) for value in (
+                    entry.get("date"),
+                    entry.get("time"),
+                    entry.get("login_id"),
+                    entry.get("role"),
+                    entry.get("action"),
+                    json.dumps(entry.get("details", {}))
+                )])
+                count += 1
+        
+        if workbook is None:
+            return None
         
-        objs = safe_s3_operation(_list_objects, fallback={})
+        with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as f:
+            path = f.name
+        workbook.save(path)
+        logger.info(f"✅ Generated activity report with {count} entries ({start_date} to {end_date})")
+        return path
+    
+    except Exception as e:
+        logger.error(f"❌ Activity report error: {e}")
+        return None
 
-        if "Contents" not in objs or not objs["Contents"]:
-            return None
+# -------- ACTIVITY ROLLUPS --------
+def build_activity_rollup(day: date, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Aggregate one day's events: action x role x user counts and search filter frequencies"""
+    counts: Dict[Tuple[str, str, str], int] = {}
+    search_filters: Dict[str, Dict[str, int]] = {}
+    for entry in entries:
+        key = (str(entry.get("action")), str(entry.get("role")), str(entry.get("login_id")))
+        counts[key] = counts.get(key, 0) + 1
+        
+        if entry.get("action") == "SEARCH":
+            for name, value in ((entry.get("details") or {}).get("filters") or {}).items():
+                # "round, oval" counts once for each shape
+                for token in str(value).lower().split(","):
+                    token = token.strip()
+                    if token and token != "any":
+                        values = search_filters.setdefault(name, {})
+                        values[token] = values.get(token, 0) + 1
+    
+    return {
+        "date": day.isoformat(),
+        "events": len(entries),
+        "counts": [
+            {"action": action, "role": role, "user": user, "count": count}
+            for (action, role, user), count in sorted(counts.items())
+        ],
+        "search_filters": search_filters
+    }
 
-        rows = []
+def save_activity_rollup(rollup: Dict[str, Any]):
+    def _put_rollup():
+        s3.put_object(
+            Bucket=CONFIG["AWS_BUCKET"],
+            Key=f"{ACTIVITY_ROLLUP_FOLDER}{rollup['date']}.json",
+            Body=json.dumps(rollup, separators=(",", ":")),
+            ContentType="application/json"
+        )
+    
+    safe_s3_operation(_put_rollup)
 
-        for obj in objs["Contents"]:
-            if not obj["Key"].endswith(".json"):
-                continue
+def load_activity_rollups(start_date: date, end_date: date,
+                          failed: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """One rollup per day in the range, oldest first
+    
+    Closed days read their stored rollup (one small object each) and build
+    it on first use; open days are aggregated from their raw events. A
+    rollup built while some segment could not be read is returned but not
+    stored, and those segment keys are appended to `failed`.
+    """
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+    rollup_keys = {
+        f"{ACTIVITY_ROLLUP_FOLDER}{day.isoformat()}.json": day
+        for day in days if is_activity_day_closed(day)
+    }
+    stored = {rollup_keys[key]: rollup for key, rollup in s3_fetch_pool.fetch(rollup_keys, json.loads)}
+    
+    rollups = []
+    for day in days:
+        rollup = stored.get(day)
+        if rollup is None:
+            day_failed: List[str] = []
+            _, entries = next(iter_activity_days(day, day, day_failed))
+            rollup = build_activity_rollup(day, entries)
+            if day_failed:
+                # Stored rollups are never rebuilt, so a short one would undercount for good
+                if failed is not None:
+                    failed.extend(day_failed)
+            elif is_activity_day_closed(day):
+                save_activity_rollup(rollup)
+        rollups.append(rollup)
+    return rollups
 
-            try:
-                def _get_object():
-                    return s3.get_object(
-                        Bucket=CONFIG["AWS_BUCKET"],
-                        Key=obj["Key"]
-                    )["Body"].read().decode("utf-8")
-                
-                raw = safe_s3_operation(_get_object, fallback="")
-                if not raw:
-                    continue
-                
-                data = json.loads(raw)
-                for entry in data:
-                    rows.append({
-                        "Date": entry.get("date"),
-                        "Time": entry.get("time"),
-                        "Login ID": entry.get("login_id"),
-                        "Role": entry.get("role"),
-                        "Action": entry.get("action"),
-                        "Details": json.dumps(entry.get("details", {}))
-                    })
-            except Exception as e:
-                logger.error(f"Failed to read activity file {obj['Key']}: {e}")
-                continue
+def ensure_recent_activity_rollups():
+    """Store rollups for days that closed recently, so summaries find them ready"""
+    today = datetime.now(IST).date()
+    load_activity_rollups(today - timedelta(days=2), today - timedelta(days=1))
 
-        if not rows:
-            return None
+def summarize_activity(rollups: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Totals across daily rollups for the admin summary"""
+    per_day = []
+    actions: Dict[str, int] = {}
+    searches_by_user: Dict[str, int] = {}
+    search_filters: Dict[str, Dict[str, int]] = {}
+    
+    for rollup in rollups:
+        day = {"date": rollup["date"], "events": rollup["events"], "logins": 0, "searches": 0, "deal_requests": 0, "uploads": 0}
+        for row in rollup["counts"]:
+            action, count = row["action"], row["count"]
+            actions[action] = actions.get(action, 0) + count
+            if action == "LOGIN":
+                day["logins"] += count
+            elif action == "SEARCH":
+                day["searches"] += count
+                searches_by_user[row["user"]] = searches_by_user.get(row["user"], 0) + count
+            elif action in DEAL_REQUEST_ACTIONS:
+                day["deal_requests"] += count
+            elif action in UPLOAD_ACTIONS:
+                day["uploads"] += count
+        for name, values in rollup.get("search_filters", {}).items():
+            merged = search_filters.setdefault(name, {})
+            for value, count in values.items():
+                merged[value] = merged.get(value, 0) + count
+        per_day.append(day)
+    
+    return {
+        "per_day": per_day,
+        "actions": actions,
+        "searches_by_user": searches_by_user,
+        "search_filters": search_filters
+    }
+
+# -------- NOTIFICATION SYSTEM --------
+# Each inbox is a folder of immutable segments, notifications/<role>_<user>/
+# <time_ns>-<id>.json, plus a read cursor holding the time_ns up to which
+# every segment was shown. Nothing is rewritten on send or on login.
+# Messages for a whole role go once to its shared inbox, notifications/@<role>/,
+# which every member reads with the same cursor as their own inbox.
+# A segment is stamped before it is stored, so one stamped earlier can land
+# after a later one was read: the cursor only settles NOTIFICATION_CURSOR_OVERLAP
+# behind the newest segment shown, and records the keys shown since
+NOTIFICATION_CURSOR_OVERLAP = 5 * 60 * 10**9  # ns, longest a segment may take to land
+NOTIFICATION_COMPACT_INTERVAL = 24 * 3600  # seconds
+# Read segments an inbox may hold before they are merged into one
+NOTIFICATION_COMPACT_MIN_SEGMENTS = 20
+NOTIFICATION_RETENTION_DAYS = 90
+
+def notification_inbox(username: str, role: str) -> str:
+    return f"{role}_{username}"
+
+def role_inbox(role: str) -> str:
+    return f"@{role}"
+
+def notification_segment_key(inbox: str, sent_ns: int, segment_id: Optional[str] = None) -> str:
+    # Zero-padded, so keys sort by time and a cursor can bound a listing
+    return f"{NOTIFICATIONS_FOLDER}{inbox}/{sent_ns:019d}-{segment_id or uuid.uuid4().hex[:8]}.json"
+
+def notification_segment_time(key: str) -> int:
+    return int(key.rsplit("/", 1)[-1].split("-", 1)[0])
 
-        df = pd.DataFrame(rows)
-        with TempFileManager(suffix=".xlsx") as path:
-            df.to_excel(path, index=False)
-            logger.info(f"✅ Generated activity report with {len(rows)} entries")
-            return path
+def notification_cursor_key(inbox: str) -> str:
+    return f"{NOTIFICATION_CURSOR_FOLDER}{inbox}.txt"
 
+def write_notification_segment(inbox: str, notes: List[Dict[str, str]],
+                               sent_ns: Optional[int] = None, segment_id: Optional[str] = None) -> bool:
+    """Write one immutable segment, by default stamped with the current time"""
+    key = notification_segment_key(inbox, time.time_ns() if sent_ns is None else sent_ns, segment_id)
+    
+    def _put_segment():
+        s3.put_object(
+            Bucket=CONFIG["AWS_BUCKET"],
+            Key=key,
+            Body=json.dumps(notes),
+            ContentType="application/json"
+        )
+        return True
+    
+    return safe_s3_operation(_put_segment, fallback=False)
+
+class NotificationCursor(NamedTuple):
+    """Read position of a user's inboxes
+    
+    Every segment at or before `settled_ns` was shown, and listings start
+    after it. `recent` holds the keys already shown after it, which lie
+    within NOTIFICATION_CURSOR_OVERLAP of the newest one.
+    """
+    settled_ns: int
+    recent: FrozenSet[str] = frozenset()
+
+def format_notification_cursor(cursor: NotificationCursor) -> str:
+    # The first line alone is how cursors were originally stored
+    return "\n".join([str(cursor.settled_ns), *sorted(cursor.recent)])
+
+def load_notification_cursor(inbox: str) -> Tuple[Optional[NotificationCursor], Optional[str]]:
+    """Read cursor and its ETag
+    
+    Position 0 with ETag None for an inbox that was never read, and
+    (None, None) when the cursor could not be read.
+    """
+    def _get_cursor():
+        try:
+            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=notification_cursor_key(inbox))
+            lines = obj["Body"].read().decode("utf-8").splitlines()
+            return NotificationCursor(int(lines[0] or 0) if lines else 0, frozenset(lines[1:])), obj["ETag"]
+        except botocore.exceptions.ClientError as e:
+            if is_missing_key_error(e):
+                return NotificationCursor(0), None
+            raise
+    
+    return safe_s3_operation(_get_cursor, fallback=(None, None))
+
+def start_notification_cursor(inbox: str):
+    """Begin a new account's cursor now, behind which its role's earlier messages stay"""
+    try:
+        conditional_put(
+            notification_cursor_key(inbox),
+            format_notification_cursor(NotificationCursor(time.time_ns())),
+            None,
+            "text/plain"
+        )
+    except WriteConflict:
+        # The name was used before; its cursor already covers the old messages
+        pass
     except Exception as e:
-        logger.error(f"❌ Activity report error: {e}")
-        return None
+        # The first read then starts the cursor instead
+        logger.error(f"❌ Failed to start notification cursor for {inbox}: {e}")
 
-# -------- NOTIFICATION SYSTEM --------
-def save_notification(username: str, role: str, message: str):
-    """Save notification for user"""
+def start_missing_notification_cursors():
+    """Start a cursor now for every account that has none yet
+    
+    Run at startup, before legacy inboxes are migrated, so an existing
+    admin still sees role messages sent after the deploy but before their
+    next login. Accounts added later start theirs on first read.
+    """
+    accounts = load_accounts()
+    existing = {
+        obj["Key"]
+        for page in iter_s3_pages(NOTIFICATION_CURSOR_FOLDER)
+        for obj in page
+    }
+    started = 0
+    for username, role in zip(accounts["USERNAME"], accounts["ROLE"].str.lower()):
+        inbox = notification_inbox(username, role)
+        if username and notification_cursor_key(inbox) not in existing:
+            start_notification_cursor(inbox)
+            started += 1
+    if started:
+        logger.info(f"✅ Started notification cursors for {started} accounts")
+
+def advance_notification_cursor(inbox: str, shown: List[str],
+                                seen: Tuple[NotificationCursor, Optional[str]]):
+    """Record segment keys as shown; the position never moves back
+    
+    A cursor seen without an ETag is written even when nothing was shown.
+    """
+    def _advance(cursor: Optional[NotificationCursor]) -> Optional[NotificationCursor]:
+        if cursor is None:
+            return None
+        # Anything stamped an overlap before the newest shown segment has landed by now
+        newest_ns = max((notification_segment_time(key) for key in shown), default=0)
+        settled_ns = max(cursor.settled_ns, newest_ns - NOTIFICATION_CURSOR_OVERLAP)
+        recent = frozenset(
+            key for key in cursor.recent | set(shown)
+            if notification_segment_time(key) > settled_ns
+        )
+        advanced = NotificationCursor(settled_ns, recent)
+        return None if advanced == cursor else advanced
+    
+    key = notification_cursor_key(inbox)
+    advanced = _advance(seen[0])
+    if advanced is None:
+        if seen[1] is not None:
+            return
+        advanced = seen[0]
+    try:
+        conditional_put(key, format_notification_cursor(advanced), seen[1], "text/plain")
+    except WriteConflict:
+        # Another session read the inbox meanwhile, merge both positions
+        compare_and_swap(
+            key,
+            lambda: load_notification_cursor(inbox),
+            _advance,
+            format_notification_cursor,
+            "text/plain"
+        )
+
+def list_notification_segments(inbox: str, after_ns: Optional[int] = None,
+                               upto_ns: Optional[int] = None) -> List[str]:
+    """Segment keys of an inbox, oldest first, bounded by read positions"""
+    prefix = f"{NOTIFICATIONS_FOLDER}{inbox}/"
+    # "~" sorts after every segment id, so a bound covers the whole time_ns
+    start_after = f"{prefix}{after_ns:019d}~" if after_ns is not None else None
+    end_before = f"{prefix}{upto_ns:019d}~" if upto_ns is not None else None
+    return [
+        obj["Key"]
+        for page in iter_s3_pages(prefix, suffix=".json", start_after=start_after, end_before=end_before)
+        for obj in page
+    ]
+
+def save_notification(username: Optional[str], role: str, message: str):
+    """Save notification for user (None: every user of the role)"""
+    save_notifications(username, role, [message])
+
+def save_notifications(username: Optional[str], role: str, messages: List[str]):
+    """Append several notifications for one user as a single new segment
+    
+    With username None the segment goes to the role's shared inbox and
+    reaches every user of that role.
+    """
     try:
         if not s3:
             return
-            
-        key = f"{NOTIFICATIONS_FOLDER}{role}_{username}.json"
-        
-        def _get_notifications():
-            try:
-                obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=key)
-                return json.loads(obj["Body"].read())
-            except:
-                return []
-        
-        data = safe_s3_operation(_get_notifications, fallback=[])
-        
-        data.append({
-            "message": message,
-            "time": datetime.now(IST).strftime("%Y-%m-%d %H:%M"),
-            "read": False
-        })
-        
-        def _save_notifications():
-            s3.put_object(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Key=key,
-                Body=json.dumps(data, indent=2),
-                ContentType="application/json"
-            )
         
-        safe_s3_operation(_save_notifications)
+        sent_at = datetime.now(IST).strftime("%Y-%m-%d %H:%M")
+        write_notification_segment(
+            notification_inbox(username, role) if username is not None else role_inbox(role),
+            [{"message": message, "time": sent_at} for message in messages]
+        )
         
     except Exception as e:
         logger.error(f"❌ Failed to save notification: {e}")
 
 def fetch_unread_notifications(username: str, role: str) -> List[Dict]:
-    """Fetch unread notifications for user"""
+    """Fetch notifications after the user's read cursor and mark them read
+    
+    Covers the user's own inbox and their role's shared inbox; segment times
+    are comparable across both, so one cursor tracks them together.
+    """
     try:
         if not s3:
             return []
-            
-        key = f"{NOTIFICATIONS_FOLDER}{role}_{username}.json"
-        
-        def _get_notifications():
-            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=key)
-            return json.loads(obj["Body"].read())
-        
-        data = safe_s3_operation(_get_notifications, fallback=[])
         
-        unread = [n for n in data if not n.get("read")]
+        inbox = notification_inbox(username, role)
+        seen = load_notification_cursor(inbox)
+        cursor = seen[0]
+        if cursor is None:
+            # Tried again at the next login
+            return []
         
-        for n in data:
-            n["read"] = True
+        own_keys = list_notification_segments(inbox, after_ns=cursor.settled_ns)
+        role_keys = list_notification_segments(role_inbox(role), after_ns=cursor.settled_ns)
+        if seen[1] is None:
+            # No cursor yet: an account added to the accounts sheet (or given a new
+            # role there) since startup. The role's earlier messages predate it
+            started_ns = time.time_ns()
+            skipped = [key for key in role_keys if notification_segment_time(key) <= started_ns]
+            role_keys = role_keys[len(skipped):]
+            settled_ns = max(started_ns - NOTIFICATION_CURSOR_OVERLAP, 0)
+            cursor = NotificationCursor(settled_ns, frozenset(
+                key for key in skipped if notification_segment_time(key) > settled_ns
+            ))
+            seen = (cursor, None)
+        
+        keys = sorted(
+            (key for key in own_keys + role_keys if key not in cursor.recent),
+            key=notification_segment_time
+        )
         
-        def _save_notifications():
-            s3.put_object(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Key=key,
-                Body=json.dumps(data, indent=2),
-                ContentType="application/json"
-            )
+        # A segment that could not be read stays unread, with everything after it
+        failed: List[str] = []
+        segments = dict(s3_fetch_pool.fetch(keys, json.loads, failed))
+        if failed:
+            keys = keys[:min(keys.index(key) for key in failed)]
+        unread = [note for key in keys for note in segments.get(key) or []]
         
-        safe_s3_operation(_save_notifications)
+        try:
+            advance_notification_cursor(inbox, keys, seen)
+        except Exception as e:
+            # Shown again on the next login rather than lost
+            logger.error(f"❌ Failed to mark notifications read for {inbox}: {e}")
         
         return unread
         
     except Exception:
         return []
 
+def compact_notification_inbox(inbox: str, keys: List[str]) -> int:
+    """Merge an inbox's read segments into one, dropping expired messages
+    
+    `keys` is the inbox's listing; only segments at or before the read
+    cursor are touched. Returns the number of segments removed.
+    """
+    cursor, _ = load_notification_cursor(inbox)
+    if cursor is None:
+        return 0
+    # Segments after the settled position stay put: the cursor names them as shown
+    read_keys = [key for key in keys if notification_segment_time(key) <= cursor.settled_ns]
+    if len(read_keys) < NOTIFICATION_COMPACT_MIN_SEGMENTS:
+        return 0
+    
+    cutoff_ns = time.time_ns() - NOTIFICATION_RETENTION_DAYS * 24 * 3600 * 10**9
+    kept = [key for key in read_keys if notification_segment_time(key) >= cutoff_ns]
+    # Each note keeps its own send time, so it still expires once merged into
+    # a segment stamped with a newer note's time
+    failed: List[str] = []
+    segments = dict(s3_fetch_pool.fetch(kept, json.loads, failed))
+    if failed:
+        # Deleting the originals would lose what could not be merged
+        return 0
+    notes = [
+        {**note, "sent_ns": note.get("sent_ns", notification_segment_time(key))}
+        for key in kept for note in segments.get(key) or []
+    ]
+    notes = [note for note in notes if note["sent_ns"] >= cutoff_ns]
+    merged_key = None
+    if notes:
+        # Written before the originals go, at a time the cursor already covers
+        merged_ns = notification_segment_time(kept[-1])
+        merged_key = notification_segment_key(inbox, merged_ns, "compacted")
+        if not write_notification_segment(inbox, notes, merged_ns, "compacted"):
+            return 0
+    
+    stale = [key for key in read_keys if key != merged_key]
+    for start in range(0, len(stale), 1000):
+        s3.delete_objects(
+            Bucket=CONFIG["AWS_BUCKET"],
+            Delete={"Objects": [{"Key": key} for key in stale[start:start + 1000]], "Quiet": True}
+        )
+    return len(stale)
+
+def prune_role_inbox(keys: List[str]) -> int:
+    """Drop a shared inbox's expired segments; it has no single cursor to compact by"""
+    cutoff_ns = time.time_ns() - NOTIFICATION_RETENTION_DAYS * 24 * 3600 * 10**9
+    expired = [key for key in keys if notification_segment_time(key) < cutoff_ns]
+    for start in range(0, len(expired), 1000):
+        s3.delete_objects(
+            Bucket=CONFIG["AWS_BUCKET"],
+            Delete={"Objects": [{"Key": key} for key in expired[start:start + 1000]], "Quiet": True}
+        )
+    return len(expired)
+
+def compact_notifications():
+    """Compact every inbox holding enough read segments"""
+    inboxes: Dict[str, List[str]] = {}
+    for page in iter_s3_pages(NOTIFICATIONS_FOLDER, suffix=".json"):
+        for obj in page:
+            inbox, _, segment = obj["Key"][len(NOTIFICATIONS_FOLDER):].partition("/")
+            if segment:
+                inboxes.setdefault(inbox, []).append(obj["Key"])
+    
+    removed = 0
+    for inbox, keys in inboxes.items():
+        if len(keys) >= NOTIFICATION_COMPACT_MIN_SEGMENTS or inbox.startswith("@"):
+            try:
+                if inbox.startswith("@"):
+                    removed += prune_role_inbox(keys)
+                else:
+                    removed += compact_notification_inbox(inbox, keys)
+            except Exception as e:
+                logger.error(f"❌ Failed to compact notifications for {inbox}: {e}")
+    if removed:
+        logger.info(f"✅ Compacted notifications: {removed} segments removed")
+
+def migrate_legacy_notifications():
+    """Move notifications/<role>_<user>.json files into segment inboxes
+    
+    Read messages land in a segment at time 0, behind any cursor, and unread
+    ones in a new segment, so they show at the next login.
+    """
+    legacy_keys = [
+        obj["Key"]
+        for page in iter_s3_pages(NOTIFICATIONS_FOLDER, suffix=".json")
+        for obj in page
+        if "/" not in obj["Key"][len(NOTIFICATIONS_FOLDER):]
+    ]
+    
+    for key, data in s3_fetch_pool.fetch(legacy_keys, json.loads):
+        if data is None:
+            continue
+        inbox = key[len(NOTIFICATIONS_FOLDER):-len(".json")]
+        read = [{"message": n.get("message"), "time": n.get("time")} for n in data if n.get("read")]
+        unread = [{"message": n.get("message"), "time": n.get("time")} for n in data if not n.get("read")]
+        # The legacy file is only removed once its messages are safely written
+        written = (not read or write_notification_segment(inbox, read, sent_ns=0, segment_id="legacy")) and \
+                  (not unread or write_notification_segment(inbox, unread, segment_id="legacy"))
+        if written:
+            safe_s3_operation(lambda: s3.delete_object(Bucket=CONFIG["AWS_BUCKET"], Key=key))
+    
+    if legacy_keys:
+        logger.info(f"✅ Migrated {len(legacy_keys)} legacy notification files")
+
+# -------- DIAMOND GRADING --------
+# Lower code = better grade; UNGRADED marks blanks and values off the scale
+UNGRADED = -1
+
+COLOR_SCALE = {letter: code for code, letter in enumerate("DEFGHIJKLMNOPQRSTUVWXYZ")}
+FANCY_COLOR_CODE = len(COLOR_SCALE)
+
+CLARITY_SCALE = {
+    "FL": 0, "IF": 1, "VVS1": 2, "VVS2": 3, "VS1": 4, "VS2": 5,
+    "SI1": 6, "SI2": 7, "SI3": 8, "I1": 9, "I2": 10, "I3": 11
+}
+
+# Clarity families a buyer may type instead of a single grade
+CLARITY_FAMILIES = {
+    "VVS": ("VVS1", "VVS2"),
+    "VS": ("VS1", "VS2"),
+    "SI": ("SI1", "SI3"),
+    "I": ("I1", "I3")
+}
+
+# Cut, Polish and Symmetry share one finish scale
+FINISH_SCALE = {
+    "ID": 0, "EX": 0, "EXCELLENT": 0,
+    "VG": 1, "VERYGOOD": 1,
+    "G": 2, "GD": 2, "GOOD": 2,
+    "F": 3, "FR": 3, "FAIR": 3,
+    "P": 4, "PR": 4, "POOR": 4
+}
+
+GRADE_SCALES = {
+    "Color": COLOR_SCALE,
+    "Clarity": CLARITY_SCALE,
+    "Cut": FINISH_SCALE,
+    "Polish": FINISH_SCALE,
+    "Symmetry": FINISH_SCALE
+}
+
+def normalize_grade(value: Any) -> str:
+    """Upper-case a grade and drop whitespace ("vs 1" -> "VS1")"""
+    return re.sub(r"\s+", "", clean_text(value)).upper()
+
+def is_fancy_color(value: Any) -> bool:
+    return normalize_grade(value).startswith("FANCY")
+
+def grade_code(column: str, value: Any) -> int:
+    """Ordinal code of a single grade value"""
+    grade = normalize_grade(value)
+    if column == "Color" and is_fancy_color(grade):
+        return FANCY_COLOR_CODE
+    return GRADE_SCALES[column].get(grade, UNGRADED)
+
+def grade_codes(column: str, values: pd.Series) -> np.ndarray:
+    """Vectorized grade_code for a whole column, as compact int8"""
+    grades = values.astype(object).fillna("").astype(str).str.replace(r"\s+", "", regex=True).str.upper()
+    codes = grades.map(GRADE_SCALES[column])
+    if column == "Color":
+        codes = codes.mask(grades.str.startswith("FANCY"), FANCY_COLOR_CODE)
+    return codes.fillna(UNGRADED).to_numpy(dtype=np.int8)
+
+def add_grade_codes(df: pd.DataFrame) -> pd.DataFrame:
+    """Add the *_CODE columns derived from Color/Clarity/Cut/Polish/Symmetry"""
+    for column, code_column in GRADE_CODE_COLUMNS.items():
+        source = df[column] if column in df.columns else df.get(column.upper())
+        if source is None:
+            df[code_column] = np.full(len(df), UNGRADED, dtype=np.int8)
+        else:
+            df[code_column] = grade_codes(column, source)
+    return df
+
+def ensure_grade_codes(df: pd.DataFrame) -> pd.DataFrame:
+    """Add grade codes to stock published before grading existed"""
+    if all(col in df.columns for col in GRADE_CODE_COLUMNS.values()):
+        return df
+    return add_grade_codes(df)
+
+def parse_grade_filter(column: str, text: str) -> Optional[List[Tuple[int, int]]]:
+    """Parse a buyer's grade filter into inclusive code ranges
+    
+    Accepts single grades ("e"), ranges ("d-f"), "and better" ("vs2+") and,
+    for clarity, families ("vs" = VS1-VS2). Returns None when any part is
+    not on the scale, so the caller can fall back to exact text matching.
+    Fancy colors all share one code, so they are never part of a range.
+    """
+    ranges = []
+    for part in text.split(","):
+        grade = normalize_grade(part)
+        if not grade:
+            continue
+        if column == "Color" and "FANCY" in grade:
+            return None
+        
+        if grade.endswith("+"):
+            code = grade_code(column, grade[:-1])
+            if code == UNGRADED:
+                return None
+            ranges.append((0, code))
+        elif "-" in grade:
+            low, high = (grade_code(column, g) for g in grade.split("-", 1))
+            if UNGRADED in (low, high):
+                return None
+            ranges.append((min(low, high), max(low, high)))
+        elif column == "Clarity" and grade in CLARITY_FAMILIES:
+            first, last = CLARITY_FAMILIES[grade]
+            ranges.append((CLARITY_SCALE[first], CLARITY_SCALE[last]))
+        else:
+            code = grade_code(column, grade)
+            if code == UNGRADED:
+                return None
+            ranges.append((code, code))
+    return ranges or None
+
 # -------- EXCEL VALIDATION & PARSING --------
 class DiamondExcelValidator:
     """Validate diamond stock Excel files with flexible optional columns"""
@@ -740,6 +2269,10 @@ class DiamondExcelValidator:
             df['LOCKED'] = 'NO'
             df['UPLOADED_AT'] = datetime.now(IST).strftime('%Y-%m-%d %H:%M:%S')
             
+            # Template uses CUT; the stock layout uses Cut
+            if 'CUT' in df.columns and 'Cut' not in df.columns:
+                df['Cut'] = df['CUT']
+            
             # Ensure all columns are present
             for col in DiamondExcelValidator.ALL_COLUMNS:
                 if col not in df.columns:
@@ -782,151 +2315,702 @@ class DiamondExcelValidator:
             errors.append(f'Validation error: {str(e)}')
             return False, pd.DataFrame(), errors, warnings
 
-# -------- STOCK MANAGEMENT --------
-@atomic_stock_operation
+# -------- STOCK INDEXES --------
+class StoneLocation(NamedTuple):
+    """Where a stone lives, resolved from the combined stock"""
+    supplier: str
+    supplier_key: str
+    combined_row: int
+
+def build_stone_index(df: pd.DataFrame) -> Dict[str, StoneLocation]:
+    """Map Stock # to its supplier workbook and combined row position"""
+    if df.empty or "Stock #" not in df.columns or "SUPPLIER" not in df.columns:
+        return {}
+    
+    stock_ids = df["Stock #"].astype(str).to_numpy()
+    suppliers = df["SUPPLIER"].astype(str).to_numpy()
+    
+    index = {}
+    for pos, (stone_id, supplier) in enumerate(zip(stock_ids, suppliers)):
+        if stone_id not in index:
+            index[stone_id] = StoneLocation(
+                supplier=supplier,
+                supplier_key=f"{SUPPLIER_STOCK_FOLDER}{supplier}.xlsx",
+                combined_row=pos
+            )
+    return index
+
+def get_stone_index(df: pd.DataFrame) -> Dict[str, StoneLocation]:
+    """Stone index for a frame returned by load_stock(copy=False)"""
+    return stock_cache.derived("stone_index", df, build_stone_index)
+
+# Columns served by the inverted search index
+SEARCH_INDEX_COLUMNS = ["Shape", "Color", "Clarity", "Diamond Type"]
+
+class CategoryIndex:
+    """Inverted index from a normalized category value to a boolean row mask"""
+    def __init__(self, values: pd.Series):
+        self.size = len(values)
+        values = values.astype(object)
+        normalized = values.where(values.isna(), values.astype(str).str.strip().str.lower())
+        codes, uniques = pd.factorize(normalized)
+        self.bitmaps = {value: codes == i for i, value in enumerate(uniques)}
+    
+    def match(self, wanted: List[str]) -> np.ndarray:
+        """OR together the bitmaps of all wanted values"""
+        mask = np.zeros(self.size, dtype=bool)
+        for value in wanted:
+            bitmap = self.bitmaps.get(value.strip().lower())
+            if bitmap is not None:
+                mask |= bitmap
+        return mask
+
+class StockSearchIndex:
+    """Per-version categorical bitmaps and sorted weights for the search filters"""
+    def __init__(self, df: pd.DataFrame):
+        self.size = len(df)
+        self.columns = {
+            col: CategoryIndex(df[col]) for col in SEARCH_INDEX_COLUMNS if col in df.columns
+        }
+        if "Weight" in df.columns:
+            # float32 weights are widened and rounded so 0.77 still matches "0.77-1"
+            weights = pd.to_numeric(df["Weight"], errors="coerce").to_numpy(dtype=float).round(4)
+        else:
+            weights = np.full(self.size, np.nan)
+        # Color/Clarity as int8 grade codes for range filters ("d-f", "vs2+")
+        self.grades = {}
+        for col in ("Color", "Clarity"):
+            code_col = GRADE_CODE_COLUMNS[col]
+            if code_col in df.columns:
+                self.grades[col] = pd.to_numeric(df[code_col], errors="coerce").fillna(UNGRADED).to_numpy(dtype=np.int8)
+            elif col in df.columns:
+                self.grades[col] = grade_codes(col, df[col])
+        # NaN weights sort last and never fall inside a finite range
+        self.weight_order = np.argsort(weights, kind="stable")
+        self.sorted_weights = weights[self.weight_order]
+    
+    def carat_rows(self, min_carat: float, max_carat: float) -> np.ndarray:
+        """Row positions with min_carat <= Weight <= max_carat, by binary search"""
+        lo = np.searchsorted(self.sorted_weights, min_carat, side="left")
+        hi = np.searchsorted(self.sorted_weights, max_carat, side="right")
+        return self.weight_order[lo:hi]
+    
+    def grade_mask(self, col: str, ranges: List[Tuple[int, int]]) -> np.ndarray:
+        """Rows whose grade code falls in any of the inclusive ranges"""
+        codes = self.grades[col]
+        mask = np.zeros(self.size, dtype=bool)
+        for low, high in ranges:
+            mask |= (codes >= low) & (codes <= high)
+        return mask
+    
+    def mask(self, filters: Dict[str, List[str]]) -> np.ndarray:
+        """AND across columns, OR within each column's wanted values"""
+        mask = np.ones(self.size, dtype=bool)
+        for col, wanted in filters.items():
+            if col in self.grades:
+                # Fancy colors match by their text; D-Z grades by code range
+                exact = [value for value in wanted if col == "Color" and is_fancy_color(value)]
+                graded = [value for value in wanted if value not in exact]
+                ranges = parse_grade_filter(col, ",".join(graded)) if graded else []
+                if ranges is not None and (ranges or exact):
+                    col_mask = self.grade_mask(col, ranges)
+                    if exact and col in self.columns:
+                        col_mask |= self.columns[col].match(exact)
+                    mask &= col_mask
+                    continue
+            
+            index = self.columns.get(col)
+            if index is None:
+                return np.zeros(self.size, dtype=bool)
+            mask &= index.match(wanted)
+        return mask
+    
+    def search(self, filters: Dict[str, List[str]], carat_range: Optional[Tuple[float, float]] = None) -> np.ndarray:
+        """Row positions (in stock order) matching the carat range and category filters"""
+        if carat_range is None:
+            return np.flatnonzero(self.mask(filters)) if filters else np.arange(self.size)
+        
+        rows = self.carat_rows(*carat_range)
+        if filters:
+            rows = rows[self.mask(filters)[rows]]
+        return np.sort(rows)
+
+def get_search_index(df: pd.DataFrame) -> StockSearchIndex:
+    """Search index for a frame returned by load_stock(copy=False)"""
+    return stock_cache.derived("search_index", df, StockSearchIndex)
+
+# Stones are compared within these groups; Smart Deals are this far below the group median.
+# Color and Clarity group by their normalized text, not the grade codes: every
+# fancy color shares one code, and off-scale grades still have a market
+MARKET_GROUP_COLUMNS = ["Shape", "Color", "Clarity", "Diamond Type"]
+MARKET_NORMALIZED_COLUMNS = ("Color", "Clarity")
+SMART_DEAL_MIN_DISCOUNT = 10
+
+# Comparable stones for supplier analytics: same group, weight within this many carats
+COMPARABLE_WEIGHT_WINDOW = 0.2
+# Weights are compared as integers in this unit (1/10000 ct), so window edges are exact
+WEIGHT_UNITS_PER_CARAT = 10000
+
+class MarketTable:
+    """Per-version market reference: price stats per comparable group and each stone's discount"""
+    def __init__(self, df: pd.DataFrame):
+        prices = pd.to_numeric(df["Price Per Carat"], errors="coerce").astype("float64")
+        keys = [
+            df[col].astype(object).fillna("").astype(str).str.replace(r"\s+", "", regex=True).str.upper()
+            if col in MARKET_NORMALIZED_COLUMNS else df[col]
+            for col in MARKET_GROUP_COLUMNS
+        ]
+        grouped = prices.groupby(keys, observed=True)
+        
+        stats = grouped.describe(percentiles=[0.25, 0.75])
+        self.groups = stats.rename(columns={"25%": "p25", "50%": "median", "75%": "p75"})[
+            ["count", "median", "p25", "p75", "min", "max"]
+        ]
+        
+        self.market_median = grouped.transform("median").reindex(df.index).to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.discount = ((self.market_median - prices.to_numpy()) / self.market_median * 100).round(1)
+        
+        # Best deal first; the stable sort keeps stock order among equal discounts
+        deals = np.flatnonzero(self.discount >= SMART_DEAL_MIN_DISCOUNT)
+        self.deal_rows = deals[np.argsort(-self.discount[deals], kind="stable")]
+        
+        self._build_comparables(df, grouped.ngroup(), prices.to_numpy())
+    
+    def _build_comparables(self, df: pd.DataFrame, group_ids: pd.Series, prices: np.ndarray):
+        """Sort the market by (group, weight) as one integer key, with price prefix sums"""
+        weights = pd.to_numeric(df["Weight"], errors="coerce").to_numpy(dtype=float)
+        units = np.round(weights * WEIGHT_UNITS_PER_CARAT)
+        
+        # Rows with a missing group key (no shape or type) have no market
+        groups = group_ids.fillna(-1).to_numpy(dtype=np.int64)
+        self._comparable = (groups >= 0) & ~np.isnan(units)
+        
+        units = np.where(self._comparable, units, 0).astype(np.int64)
+        self._window = int(round(COMPARABLE_WEIGHT_WINDOW * WEIGHT_UNITS_PER_CARAT))
+        # Groups are spaced further apart than any weight window can reach
+        span = (units.max() if len(units) else 0) + self._window + 1
+        self._keys = np.where(self._comparable, groups * span + units, -1)
+        
+        market = np.flatnonzero(self._comparable)
+        order = market[np.argsort(self._keys[market], kind="stable")]
+        self._sorted_keys = self._keys[order]
+        sorted_prices = prices[order]
+        priced = ~np.isnan(sorted_prices)
+        self._price_sums = np.concatenate(([0.0], np.cumsum(np.where(priced, sorted_prices, 0.0))))
+        self._price_counts = np.concatenate(([0], np.cumsum(priced)))
+    
+    def comparables(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Number of comparable stones and their mean price for each row, the stone itself included
+        
+        One pair of binary searches per row over the (group, weight) keys
+        replaces a full-market filter per stone.
+        """
+        keys = self._keys[rows]
+        lo = np.searchsorted(self._sorted_keys, keys - self._window, side="left")
+        hi = np.searchsorted(self._sorted_keys, keys + self._window, side="right")
+        
+        comparable = self._comparable[rows]
+        counts = np.where(comparable, hi - lo, 0)
+        priced = self._price_counts[hi] - self._price_counts[lo]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = (self._price_sums[hi] - self._price_sums[lo]) / priced
+        return counts, np.where(comparable & (priced > 0), means, np.nan)
+    
+    def top_deals(self, k: Optional[int] = None) -> np.ndarray:
+        """Row positions of the k deepest discounts (all deals if k is None)"""
+        return self.deal_rows if k is None else self.deal_rows[:k]
+
+def get_market_table(df: pd.DataFrame) -> MarketTable:
+    """Market table for a frame returned by load_stock(copy=False)"""
+    return stock_cache.derived("market_table", df, MarketTable)
+
+def warm_stock_indexes():
+    """Build the per-version lookup structures right after a publish"""
+    df = load_stock(copy=False)
+    if not df.empty:
+        get_stone_index(df)
+        get_search_index(df)
+        get_market_table(df)
+
+def update_supplier_workbook(supplier: str, supplier_key: str, mutate: Callable[[pd.DataFrame], Optional[pd.DataFrame]]) -> bool:
+    """Rewrite one supplier workbook with optimistic concurrency
+    
+    `mutate(supplier_df)` returns the frame to save, or None to leave the
+    file alone. The upload is conditional on the version that was read, so
+    a supplier re-uploading meanwhile is never overwritten with stale rows.
+    """
+    if not s3:
+        return False
+    
+    def _read():
+        def _get_supplier():
+            try:
+                obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=supplier_key)
+                return pd.read_excel(BytesIO(obj["Body"].read())), obj["ETag"]
+            except botocore.exceptions.ClientError as e:
+                if is_missing_key_error(e):
+                    return None, None
+                raise
+        
+        return safe_s3_operation(_get_supplier, fallback=(None, None))
+    
+    def _mutate(supplier_df: Optional[pd.DataFrame]) -> Optional[pd.DataFrame]:
+        if supplier_df is None or "Stock #" not in supplier_df.columns:
+            return None
+        
+        supplier_df = mutate(supplier_df)
+        if supplier_df is None:
+            return None
+        
+        for col in supplier_df.select_dtypes(include="object"):
+            supplier_df[col] = supplier_df[col].map(safe_excel)
+        return supplier_df
+    
+    def _serialize(supplier_df: pd.DataFrame) -> bytes:
+        buffer = BytesIO()
+        # Workbooks saved while uploads still carried grade codes lose them here
+        excel_stock_frame(supplier_df, layout=None).to_excel(buffer, index=False)
+        return buffer.getvalue()
+    
+    with stock_locks.supplier(supplier):
+        result = compare_and_swap(
+            supplier_key, _read, _mutate, _serialize,
+            content_type=XLSX_CONTENT_TYPE
+        )
+    return result is not None
+
+def drop_supplier_stones(location: StoneLocation, stone_ids: List[str]) -> bool:
+    """Remove several stones from one supplier workbook in a single write"""
+    wanted = set(stone_ids)
+    
+    def _mutate(supplier_df: pd.DataFrame) -> Optional[pd.DataFrame]:
+        # First occurrence per Stock #, matching how the stone index resolves rows
+        stock_ids = supplier_df["Stock #"].astype(str)
+        drop = stock_ids.isin(wanted) & ~stock_ids.duplicated()
+        if not drop.any():
+            return None
+        return supplier_df.drop(supplier_df.index[drop.to_numpy()])
+    
+    return update_supplier_workbook(location.supplier, location.supplier_key, _mutate)
+
+# -------- LOCK LEDGER --------
+# Lock state lives in one small JSON document keyed by Stock #, not in the
+# workbooks; LOCKED in loaded stock is derived from it at read time.
+def load_lock_ledger() -> Tuple[Optional[Dict[str, Dict]], Optional[str]]:
+    """Read the lock ledger and its ETag, (None, None) if it has never been written"""
+    def _get_ledger():
+        try:
+            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=LOCK_LEDGER_KEY)
+            return json.loads(obj["Body"].read()).get("locks", {}), obj.get("ETag")
+        except botocore.exceptions.ClientError as e:
+            if is_missing_key_error(e):
+                return None, None
+            raise
+    
+    result = safe_s3_operation(_get_ledger, fallback=False)
+    if result is False:
+        # Never treat an unreadable ledger as empty, that would unlock everything
+        raise RuntimeError("lock ledger unavailable")
+    return result
+
+def serialize_lock_ledger(locks: Dict[str, Dict]) -> str:
+    """Lock ledger document body"""
+    return json.dumps({"locks": locks, "updated_at": datetime.now(IST).isoformat()}, indent=2)
+
+def current_locks(df: pd.DataFrame) -> Tuple[Dict[str, Dict], Optional[str]]:
+    """Current ledger; the first call seeds it from LOCKED=YES rows of workbook-locked stock"""
+    locks, etag = load_lock_ledger()
+    if locks is not None:
+        return locks, etag
+    
+    locks = {}
+    if "LOCKED" in df.columns and "Stock #" in df.columns:
+        legacy = df.loc[df["LOCKED"].astype(str).str.upper() == "YES", "Stock #"].astype(str)
+        locked_at = datetime.now(IST).isoformat()
+        locks = {stone_id: {"locked_at": locked_at, "migrated": True} for stone_id in legacy}
+    
+    try:
+        etag = conditional_put(LOCK_LEDGER_KEY, serialize_lock_ledger(locks), None, "application/json")
+    except WriteConflict:
+        # Another instance seeded it first; theirs wins
+        return load_lock_ledger()
+    logger.info(f"✅ Created lock ledger with {len(locks)} locked stones")
+    return locks, etag
+
+def lock_flags(stock_ids: pd.Series, locks: Dict[str, Dict]) -> pd.Categorical:
+    """LOCKED column (YES/NO) for the given stones according to the ledger"""
+    locked = stock_ids.astype(str).isin(locks.keys()).to_numpy()
+    return pd.Categorical(np.where(locked, "YES", "NO"), categories=["NO", "YES"])
+
+def apply_ledger_locks(df: pd.DataFrame) -> pd.DataFrame:
+    """Copy of a workbook frame with LOCKED as the ledger has it
+    
+    Workbooks keep the flags they were uploaded with, so every workbook
+    handed to a person goes through this. Before the ledger exists the
+    workbook flags are still the truth.
+    """
+    locks, _ = load_lock_ledger()
+    if locks is None or "Stock #" not in df.columns:
+        return df
+    df = df.copy()
+    df["LOCKED"] = lock_flags(df["Stock #"], locks)
+    return df
+
+def with_lock_ledger(df: pd.DataFrame) -> pd.DataFrame:
+    """Overlay the ledger onto LOCKED, cached per stock version and ledger ETag
+    
+    Only the LOCKED column is replaced (shallow copy), so locking a stone
+    keeps the cached frame and its indexes.
+    """
+    if df.empty or "Stock #" not in df.columns:
+        return df
+    
+    try:
+        view = stock_cache.get_view(df, get_object_etag(LOCK_LEDGER_KEY))
+        if view is not None:
+            return view
+        
+        locks, etag = current_locks(df)
+        view = df.copy(deep=False)
+        view["LOCKED"] = lock_flags(df["Stock #"], locks)
+        stock_cache.store_view(df, view, etag)
+        return view
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to apply lock ledger, using workbook LOCKED: {e}")
+        return df
+
+def set_stone_locks(df: pd.DataFrame, stones: Dict[str, Optional[str]], locked: bool) -> List[str]:
+    """Lock or unlock many stones (Stock # -> supplier) in one ledger write
+    
+    Returns the stones whose state actually changed; stones already in the
+    requested state are left out. The write is conditional on the version
+    read, so two instances can never both lock the same stone.
+    """
+    changed: List[str] = []
+    
+    def _mutate(locks: Dict[str, Dict]) -> Optional[Dict[str, Dict]]:
+        # Re-run on every conflict retry, so start from a clean slate
+        changed.clear()
+        locked_at = datetime.now(IST).isoformat()
+        for stone_id, supplier in stones.items():
+            if (stone_id in locks) == locked:
+                continue
+            if locked:
+                locks[stone_id] = {"supplier": supplier, "locked_at": locked_at}
+            else:
+                locks.pop(stone_id)
+            changed.append(stone_id)
+        return locks if changed else None
+    
+    if not stones:
+        return []
+    if compare_and_swap(LOCK_LEDGER_KEY, lambda: current_locks(df), _mutate, serialize_lock_ledger) is None:
+        return []
+    return list(changed)
+
+def set_stone_lock(df: pd.DataFrame, stone_id: str, locked: bool, supplier: Optional[str] = None) -> bool:
+    """Lock or unlock one stone in the ledger; False if it already was in that state"""
+    return bool(set_stone_locks(df, {stone_id: supplier}, locked))
+
+# -------- STOCK MANAGEMENT --------
+# Parsed supplier frames kept between rebuilds; suppliers past the budget are re-read
+SUPPLIER_FRAME_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+class SupplierFrameCache:
+    """Parsed supplier workbooks keyed by S3 key, least recently used evicted first
+    
+    An entry is reused while the listing still shows the ETag/LastModified
+    it was parsed from.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._bytes = 0
+        self.evictions = 0
+    
+    def get(self, key: str, fingerprint: Tuple) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["fingerprint"] != fingerprint:
+                return None
+            # Re-inserted, so dict order stays least recently used first
+            self._entries[key] = self._entries.pop(key)
+            return entry["df"]
+    
+    def put(self, key: str, fingerprint: Tuple, df: pd.DataFrame):
+        size = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            self._drop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = {"fingerprint": fingerprint, "df": df, "bytes": size}
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def retain(self, keys: Iterable[str]):
+        """Forget suppliers whose files are no longer listed"""
+        keys = set(keys)
+        with self._lock:
+            for key in [key for key in self._entries if key not in keys]:
+                self._drop(key)
+    
+    def pop(self, key: str):
+        with self._lock:
+            self._drop(key)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry["bytes"]
+    
+    def stats(self) -> Dict[str, Any]:
+        """Counters for /status"""
+        with self._lock:
+            return {
+                "suppliers": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions
+            }
+
+supplier_frame_cache = SupplierFrameCache(SUPPLIER_FRAME_CACHE_MAX_BYTES)
+
+def build_combined_stock() -> Optional[Tuple[pd.DataFrame, int, int]]:
+    """Concatenate all supplier files, re-reading only changed ones
+    
+    Returns (combined frame, supplier count, files re-read), or None when
+    there is no supplier stock. Raises if a supplier file could not be read,
+    rather than publishing stock without that supplier.
+    """
+    listed = {}
+    failed: List[str] = []
+    # This build's frames; the cache may evict some of them before the concat
+    frames: Dict[str, pd.DataFrame] = {}
+    reparsed = 0
+    
+    for page in iter_s3_pages(SUPPLIER_STOCK_FOLDER, suffix=".xlsx"):
+        changed = []
+        for obj in page:
+            fingerprint = (obj.get("ETag"), str(obj.get("LastModified")))
+            listed[obj["Key"]] = fingerprint
+            cached = supplier_frame_cache.get(obj["Key"], fingerprint)
+            if cached is None:
+                changed.append(obj["Key"])
+            else:
+                frames[obj["Key"]] = cached
+        
+        for key, df in s3_fetch_pool.fetch(changed, lambda body: pd.read_excel(BytesIO(body)), failed):
+            if df is None:
+                logger.error(f"Failed to process {key}")
+                supplier_frame_cache.pop(key)
+                continue
+            df["SUPPLIER"] = key.split("/")[-1].replace(".xlsx", "").lower()
+            supplier_frame_cache.put(key, listed[key], df)
+            frames[key] = df
+            reparsed += 1
+    
+    if failed:
+        raise RuntimeError(f"{len(failed)} supplier file(s) could not be read, e.g. {failed[0]}; not publishing")
+    
+    # Listing order, so the combined file is stable whichever read finished first
+    dfs = [frames[key] for key in listed if key in frames]
+    
+    # Suppliers whose files were deleted drop out of the cache too
+    supplier_frame_cache.retain(listed)
+    
+    if not dfs:
+        return None
+    
+    final_df = pd.concat(dfs, ignore_index=True)
+    
+    # Recomputed here so workbooks uploaded before grading existed get codes too
+    final_df = add_grade_codes(final_df)
+    
+    for col in COMBINED_STOCK_COLUMNS:
+        if col not in final_df.columns:
+            final_df[col] = ""
+    
+    if "Diamond Type" not in final_df.columns:
+        final_df["Diamond Type"] = "Unknown"
+    
+    final_df["LOCKED"] = final_df.get("LOCKED", "NO")
+    try:
+        # Lock state as of this rebuild, used only when the ledger cannot be read later
+        final_df["LOCKED"] = lock_flags(final_df["Stock #"], current_locks(final_df)[0])
+    except Exception as e:
+        logger.warning(f"⚠️ Could not read lock ledger during rebuild: {e}")
+    final_df = final_df[COMBINED_STOCK_COLUMNS]
+    return final_df, len(dfs), reparsed
+
+def export_combined_stock(local_path: str) -> bool:
+    """Write current combined stock, with live lock state, as an Excel workbook
+    
+    The workbook is published lazily: the copy in S3 is tagged with the
+    snapshot and lock ledger ETags it was built from and reused while both
+    are unchanged, so a rebuild only pays for the Parquet snapshot.
+    """
+    # Taken before the load, so a publish in between leaves an outdated tag, never a wrong one
+    versions = {
+        "snapshot-etag": get_object_etag(COMBINED_STOCK_SNAPSHOT_KEY) or "",
+        "locks-etag": get_object_etag(LOCK_LEDGER_KEY) or ""
+    }
+    
+    def _published_versions():
+        try:
+            return s3.head_object(Bucket=CONFIG["AWS_BUCKET"], Key=COMBINED_STOCK_KEY).get("Metadata", {})
+        except botocore.exceptions.ClientError as e:
+            if is_missing_key_error(e):
+                return {}
+            raise
+    
+    # Without a snapshot the workbook is legacy stock itself, never overwritten
+    current = versions["snapshot-etag"] and safe_s3_operation(_published_versions, fallback={}) == versions
+    if current:
+        def _download():
+            s3.download_file(CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY, local_path)
+            return True
+        
+        if safe_s3_operation(_download, fallback=False):
+            return True
+    
+    df = load_stock(copy=False)
+    if df.empty:
+        return False
+    excel_stock_frame(df).to_excel(local_path, index=False)
+    
+    if versions["snapshot-etag"] and not current:
+        def _upload():
+            s3.upload_file(local_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY, ExtraArgs={"Metadata": versions})
+            return True
+        
+        safe_s3_operation(_upload, fallback=False)
+    return True
+
 def rebuild_combined_stock():
-    """Rebuild combined stock from all supplier files"""
+    """Rebuild combined stock from all supplier files
+    
+    Reading and merging supplier files runs unlocked; only the publish is
+    exclusive, so deal locks and other uploads are not held up by a rebuild.
+    """
     try:
         if not s3:
             return
         
-        def _list_objects():
-            return s3.list_objects_v2(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Prefix=SUPPLIER_STOCK_FOLDER
-            )
-        
-        objs = safe_s3_operation(_list_objects, fallback={})
-        
-        if "Contents" not in objs:
-            return
-        
-        dfs = []
-        
-        for obj in objs.get("Contents", []):
-            key = obj["Key"]
-            if not key.endswith(".xlsx"):
-                continue
+        for attempt in range(CAS_MAX_ATTEMPTS):
+            # A publish after this point (e.g. a removal) fails our precondition,
+            # and the rebuild starts over from the supplier files it changed
+            etag = get_object_etag(COMBINED_STOCK_SNAPSHOT_KEY)
+            built = build_combined_stock()
+            if built is None:
+                return
+            final_df, suppliers, reparsed = built
             
             try:
-                with TempFileManager(suffix=".xlsx") as local_path:
-                    def _download():
-                        s3.download_file(CONFIG["AWS_BUCKET"], key, local_path)
-                    
-                    if not safe_s3_operation(_download, fallback=False):
-                        continue
-                    
-                    df = pd.read_excel(local_path)
-                    df["SUPPLIER"] = key.split("/")[-1].replace(".xlsx", "").lower()
-                    dfs.append(df)
-                    
-            except Exception as e:
-                logger.error(f"Failed to process {key}: {e}")
+                with stock_locks.publish():
+                    published = save_combined_stock(final_df, expected_etag=etag, conditional=True)
+            except WriteConflict:
+                wait_after_conflict(COMBINED_STOCK_SNAPSHOT_KEY, attempt)
                 continue
-        
-        if not dfs:
-            return
-        
-        final_df = pd.concat(dfs, ignore_index=True)
-        
-        desired_columns = [
-            "Stock #", "Availability", "Shape", "Weight", "Color", "Clarity", "Cut", "Polish", "Symmetry",
-            "Fluorescence Color", "Measurements", "Shade", "Milky", "Eye Clean", "Lab", "Report #", "Location",
-            "Treatment", "Discount", "Price Per Carat", "Final Price", "Depth %", "Table %", "Girdle Thin",
-            "Girdle Thick", "Girdle %", "Girdle Condition", "Culet Size", "Culet Condition", "Crown Height",
-            "Crown Angle", "Pavilion Depth", "Pavilion Angle", "Inscription", "Cert comment", "KeyToSymbols",
-            "White Inclusion", "Black Inclusion", "Open Inclusion", "Fancy Color", "Fancy Color Intensity",
-            "Fancy Color Overtone", "Country", "State", "City", "CertFile", "Diamond Video", "Diamond Image",
-            "SUPPLIER", "LOCKED", "Diamond Type", "UPLOADED_AT", "Description"
-        ]
-        
-        for col in desired_columns:
-            if col not in final_df.columns:
-                final_df[col] = ""
-        
-        if "Diamond Type" not in final_df.columns:
-            final_df["Diamond Type"] = "Unknown"
-        
-        final_df["LOCKED"] = final_df.get("LOCKED", "NO")
-        final_df = final_df[desired_columns]
-        
-        with TempFileManager(suffix=".xlsx") as local_path:
-            final_df.to_excel(local_path, index=False)
             
-            def _upload():
-                s3.upload_file(local_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
+            if not published:
+                logger.error("❌ Failed to publish combined stock")
+                return
+            
+            warm_stock_indexes()
             
-            safe_s3_operation(_upload)
+            logger.info(
+                f"✅ Rebuilt combined stock with {len(final_df)} items from {suppliers} suppliers "
+                f"({reparsed} re-read, {suppliers - reparsed} cached)"
+            )
+            return
         
-        logger.info(f"✅ Rebuilt combined stock with {len(final_df)} items from {len(dfs)} suppliers")
+        logger.error("❌ Gave up rebuilding combined stock after repeated conflicts")
             
     except Exception as e:
         logger.error(f"❌ Error rebuilding combined stock: {e}")
 
-@atomic_stock_operation
-def atomic_lock_stone(stone_id: str) -> bool:
+def apply_stone_lock(stone_id: str) -> bool:
+    """Lock a stone in the ledger; the caller holds the stone's lock"""
+    if not s3:
+        return False
+    
+    df = load_stock(copy=False)
+    location = get_stone_index(df).get(stone_id) if not df.empty else None
+    if location is None:
+        return False
+    
+    return set_stone_lock(df, stone_id, True, location.supplier)
+
+def apply_stone_unlock(stone_id: str) -> bool:
+    """Unlock a stone in the ledger; the caller holds the stone's lock"""
+    return set_stone_lock(load_stock(copy=False), stone_id, False)
+
+def apply_stone_removal(stone_id: str) -> bool:
+    """Remove a stone from its supplier file and combined stock; the caller holds the stone's lock"""
+    return bool(apply_stone_removals([stone_id]))
+
+def apply_stone_removals(stone_ids: List[str]) -> List[str]:
+    """Remove stones from their supplier files, combined stock and the lock ledger
+    
+    One conditional write per affected supplier workbook, one combined
+    publish and one ledger write, however many stones there are. Returns
+    the stones that were found and removed.
+    """
+    df = load_stock(copy=False)
+    stone_index = get_stone_index(df) if not df.empty else {}
+    
+    by_supplier: Dict[str, List[str]] = {}
+    supplier_locations: Dict[str, StoneLocation] = {}
+    for stone_id in dict.fromkeys(stone_ids):
+        location = stone_index.get(stone_id)
+        if location is None:
+            logger.warning(f"⚠️ Stone {stone_id} not found in combined stock")
+            continue
+        by_supplier.setdefault(location.supplier, []).append(stone_id)
+        supplier_locations[location.supplier] = location
+    
+    if not by_supplier:
+        return []
+    
+    # Supplier files first: a rebuild racing with this publish re-reads them
+    for supplier, supplier_stones in by_supplier.items():
+        if not drop_supplier_stones(supplier_locations[supplier], supplier_stones):
+            logger.warning(f"⚠️ Stones {', '.join(supplier_stones)} not found in {supplier_locations[supplier].supplier_key}")
+    
+    removed = [stone_id for supplier_stones in by_supplier.values() for stone_id in supplier_stones]
+    
+    def _drop(current: pd.DataFrame) -> Optional[pd.DataFrame]:
+        # Positions shift when other writers publish, so look the stones up again
+        current_index = get_stone_index(current) if not current.empty else {}
+        rows = [current_index[stone_id].combined_row for stone_id in removed if stone_id in current_index]
+        if not rows:
+            return None
+        return current.drop(current.index[rows])
+    
+    update_combined_stock(_drop)
+    set_stone_locks(df, dict.fromkeys(removed), False)
+    return removed
+
+async def run_under_stone_lock(stone_id: str, func: Callable[[str], bool]) -> bool:
+    """Wait for a stone's lock without blocking the loop, then run `func` in a worker thread"""
+    async with stock_locks.stone(stone_id, timeout=STOCK_LOCK_TIMEOUT):
+        return await asyncio.to_thread(func, stone_id)
+
+async def atomic_lock_stone(stone_id: str) -> bool:
     """Atomically lock a stone to prevent race conditions"""
     try:
-        if not s3:
+        if not await run_under_stone_lock(stone_id, apply_stone_lock):
             return False
         
-        with TempFileManager(suffix=".xlsx") as local_path:
-            def _download():
-                s3.download_file(CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY, local_path)
-            
-            if not safe_s3_operation(_download, fallback=False):
-                return False
-            
-            df = pd.read_excel(local_path)
-            
-            if df.empty or "Stock #" not in df.columns or "LOCKED" not in df.columns:
-                return False
-            
-            mask = (df["Stock #"] == stone_id) & (df["LOCKED"] != "YES")
-            if not mask.any():
-                return False
-            
-            df.loc[mask, "LOCKED"] = "YES"
-            
-            for col in df.select_dtypes(include="object"):
-                df[col] = df[col].map(safe_excel)
-            
-            df.to_excel(local_path, index=False)
-            
-            def _upload():
-                s3.upload_file(local_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
-            
-            if not safe_s3_operation(_upload, fallback=False):
-                return False
-            
-            stone_row = df[df["Stock #"] == stone_id].iloc[0]
-            supplier = stone_row.get("SUPPLIER", "")
-            
-            if supplier:
-                supplier_file = f"{SUPPLIER_STOCK_FOLDER}{supplier}.xlsx"
-                try:
-                    with TempFileManager(suffix=".xlsx") as supplier_path:
-                        def _download_supplier():
-                            s3.download_file(CONFIG["AWS_BUCKET"], supplier_file, supplier_path)
-                        
-                        if safe_s3_operation(_download_supplier, fallback=False):
-                            supplier_df = pd.read_excel(supplier_path)
-                            
-                            if "Stock #" in supplier_df.columns and "LOCKED" in supplier_df.columns:
-                                supplier_df.loc[supplier_df["Stock #"] == stone_id, "LOCKED"] = "YES"
-                                
-                                for col in supplier_df.select_dtypes(include="object"):
-                                    supplier_df[col] = supplier_df[col].map(safe_excel)
-                                
-                                supplier_df.to_excel(supplier_path, index=False)
-                                
-                                def _upload_supplier():
-                                    s3.upload_file(supplier_path, CONFIG["AWS_BUCKET"], supplier_file)
-                                
-                                safe_s3_operation(_upload_supplier)
-                except Exception as e:
-                    logger.error(f"Failed to update supplier file: {e}")
-        
         logger.info(f"✅ Locked stone: {stone_id}")
         return True
         
@@ -934,160 +3018,452 @@ def atomic_lock_stone(stone_id: str) -> bool:
         logger.error(f"❌ Atomic lock failed for stone {stone_id}: {e}")
         return False
 
-@atomic_stock_operation
-def unlock_stone(stone_id: str):
+async def unlock_stone(stone_id: str):
     """Unlock a stone"""
     try:
-        df = load_stock()
-        if df.empty:
-            return
-        
-        if "Stock #" not in df.columns or "LOCKED" not in df.columns:
-            return
-        
-        df.loc[df["Stock #"] == stone_id, "LOCKED"] = "NO"
-        
-        with TempFileManager(suffix=".xlsx") as temp_path:
-            for col in df.select_dtypes(include="object"):
-                df[col] = df[col].map(safe_excel)
-            
-            df.to_excel(temp_path, index=False)
-            
-            if s3:
-                def _upload():
-                    s3.upload_file(temp_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
-                
-                safe_s3_operation(_upload)
-            
-            stone_row = df[df["Stock #"] == stone_id].iloc[0]
-            supplier = stone_row.get("SUPPLIER", "")
-            
-            if supplier and s3:
-                supplier_file = f"{SUPPLIER_STOCK_FOLDER}{supplier}.xlsx"
-                try:
-                    with TempFileManager(suffix=".xlsx") as supplier_path:
-                        def _download_supplier():
-                            s3.download_file(CONFIG["AWS_BUCKET"], supplier_file, supplier_path)
-                        
-                        if safe_s3_operation(_download_supplier, fallback=False):
-                            supplier_df = pd.read_excel(supplier_path)
-                            
-                            if "Stock #" in supplier_df.columns and "LOCKED" in supplier_df.columns:
-                                supplier_df.loc[supplier_df["Stock #"] == stone_id, "LOCKED"] = "NO"
-                                supplier_df.to_excel(supplier_path, index=False)
-                                
-                                def _upload_supplier():
-                                    s3.upload_file(supplier_path, CONFIG["AWS_BUCKET"], supplier_file)
-                                
-                                safe_s3_operation(_upload_supplier)
-                except:
-                    pass
-        
-        logger.info(f"✅ Unlocked stone: {stone_id}")
+        if await run_under_stone_lock(stone_id, apply_stone_unlock):
+            logger.info(f"✅ Unlocked stone: {stone_id}")
         
     except Exception as e:
         logger.error(f"❌ Failed to unlock stone {stone_id}: {e}")
 
-@atomic_stock_operation
-def remove_stone_from_supplier_and_combined(stone_id: str):
+async def remove_stone_from_supplier_and_combined(stone_id: str):
     """Remove stone from both supplier and combined stock"""
     try:
-        df = load_stock()
-        if not df.empty and "Stock #" in df.columns:
-            df = df[df["Stock #"] != stone_id]
-            
-            with TempFileManager(suffix=".xlsx") as temp_path:
-                df.to_excel(temp_path, index=False)
-                
-                if s3:
-                    def _upload():
-                        s3.upload_file(temp_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
-                    
-                    safe_s3_operation(_upload)
-        
-        if s3:
-            def _list_objects():
-                return s3.list_objects_v2(
-                    Bucket=CONFIG["AWS_BUCKET"],
-                    Prefix=SUPPLIER_STOCK_FOLDER
-                )
-            
-            objs = safe_s3_operation(_list_objects, fallback={})
-            
-            for obj in objs.get("Contents", []):
-                key = obj["Key"]
-                if not key.endswith(".xlsx"):
-                    continue
-                
-                with TempFileManager(suffix=".xlsx") as local_path:
-                    def _download():
-                        s3.download_file(CONFIG["AWS_BUCKET"], key, local_path)
-                    
-                    if not safe_s3_operation(_download, fallback=False):
-                        continue
-                    
-                    sdf = pd.read_excel(local_path)
-                    
-                    if "Stock #" in sdf.columns and stone_id in sdf["Stock #"].values:
-                        sdf = sdf[sdf["Stock #"] != stone_id]
-                        sdf.to_excel(local_path, index=False)
-                        
-                        def _upload():
-                            s3.upload_file(local_path, CONFIG["AWS_BUCKET"], key)
-                        
-                        safe_s3_operation(_upload)
-                        break
-        
-        logger.info(f"✅ Removed stone {stone_id} from all stock files")
+        if await run_under_stone_lock(stone_id, apply_stone_removal):
+            logger.info(f"✅ Removed stone {stone_id} from all stock files")
         
     except Exception as e:
         logger.error(f"❌ Failed to remove stone {stone_id}: {e}")
 
 # -------- DEAL MANAGEMENT --------
+def load_deal(deal_id: str) -> Tuple[Optional[Dict], Optional[str]]:
+    """Read a deal and its ETag, (None, None) if it does not exist"""
+    def _get_deal():
+        try:
+            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=f"{DEALS_FOLDER}{deal_id}.json")
+            return json.loads(obj["Body"].read()), obj["ETag"]
+        except botocore.exceptions.ClientError as e:
+            if is_missing_key_error(e):
+                return None, None
+            raise
+    
+    return safe_s3_operation(_get_deal, fallback=(None, None))
+
+def create_deal(deal: Dict[str, Any]) -> bool:
+    """Write a new deal; never overwrites an existing one"""
+    try:
+        conditional_put(
+            f"{DEALS_FOLDER}{deal['deal_id']}.json", json.dumps(deal, indent=2), None, "application/json"
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ Failed to save deal {deal['deal_id']}: {e}")
+        return False
+
+def update_deal(deal_id: str, mutate: Callable[[Optional[Dict]], Optional[Dict]]) -> Optional[Dict]:
+    """Apply a state change to a deal with optimistic concurrency
+    
+    `mutate(deal)` returns the updated deal, or None if the change no longer
+    applies (e.g. the deal was closed meanwhile). Returns the saved deal.
+    """
+    result = compare_and_swap(
+        f"{DEALS_FOLDER}{deal_id}.json",
+        lambda: load_deal(deal_id),
+        mutate,
+        lambda deal: json.dumps(deal, indent=2)
+    )
+    return result[0] if result else None
+
 def log_deal_history(deal: Dict[str, Any]):
     """Log deal to history file"""
+    log_deals_history([deal])
+
+def log_deals_history(deals: List[Dict[str, Any]]):
+    """Append several deals to the history file in one write"""
     try:
-        if not s3:
+        if not s3 or not deals:
             return
         
-        with TempFileManager(suffix=".xlsx") as local_path:
-            def _download():
-                s3.download_file(CONFIG["AWS_BUCKET"], DEAL_HISTORY_KEY, local_path)
-            
-            if safe_s3_operation(_download, fallback=False):
-                df = pd.read_excel(local_path)
-            else:
-                df = pd.DataFrame(columns=[
-                    "Deal ID", "Stone ID", "Supplier", "Client", "Actual Price",
-                    "Offer Price", "Supplier Action", "Admin Action", "Final Status", "Created At"
-                ])
-            
-            new_row = pd.DataFrame([{
-                "Deal ID": deal.get("deal_id"),
-                "Stone ID": deal.get("stone_id"),
-                "Supplier": deal.get("supplier_username"),
-                "Client": deal.get("client_username"),
-                "Actual Price": deal.get("actual_stock_price"),
-                "Offer Price": deal.get("client_offer_price"),
-                "Supplier Action": deal.get("supplier_action"),
-                "Admin Action": deal.get("admin_action"),
-                "Final Status": deal.get("final_status"),
-                "Created At": deal.get("created_at"),
-            }])
-            
-            df = pd.concat([df, new_row], ignore_index=True)
-            df.to_excel(local_path, index=False)
-            
-            def _upload():
-                s3.upload_file(local_path, CONFIG["AWS_BUCKET"], DEAL_HISTORY_KEY)
-            
-            safe_s3_operation(_upload)
+        def _read():
+            try:
+                obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=DEAL_HISTORY_KEY)
+                return pd.read_excel(BytesIO(obj["Body"].read())), obj["ETag"]
+            except botocore.exceptions.ClientError as e:
+                if not is_missing_key_error(e):
+                    raise
+            return pd.DataFrame(columns=[
+                "Deal ID", "Stone ID", "Supplier", "Client", "Actual Price",
+                "Offer Price", "Supplier Action", "Admin Action", "Final Status", "Created At"
+            ]), None
+        
+        new_rows = pd.DataFrame([{
+            "Deal ID": deal.get("deal_id"),
+            "Stone ID": deal.get("stone_id"),
+            "Supplier": deal.get("supplier_username"),
+            "Client": deal.get("client_username"),
+            "Actual Price": deal.get("actual_stock_price"),
+            "Offer Price": deal.get("client_offer_price"),
+            "Supplier Action": deal.get("supplier_action"),
+            "Admin Action": deal.get("admin_action"),
+            "Final Status": deal.get("final_status"),
+            "Created At": deal.get("created_at"),
+        } for deal in deals])
+        
+        def _serialize(df: pd.DataFrame) -> bytes:
+            buffer = BytesIO()
+            df.to_excel(buffer, index=False)
+            return buffer.getvalue()
+        
+        # Concurrent appends re-read the history instead of overwriting each other
+        compare_and_swap(
+            DEAL_HISTORY_KEY,
+            _read,
+            lambda df: pd.concat([df, new_rows], ignore_index=True),
+            _serialize,
+            XLSX_CONTENT_TYPE
+        )
         
-        logger.info(f"✅ Logged deal to history: {deal.get('deal_id')}")
+        logger.info(f"✅ Logged {len(deals)} deal(s) to history: {', '.join(str(d.get('deal_id')) for d in deals[:5])}")
         
     except Exception as e:
         logger.error(f"❌ Failed to log deal history: {e}")
 
+async def request_deals_bulk(user: Dict, offers: List[Tuple[str, Any]]) -> List[Dict[str, Any]]:
+    """Open deals for many (Stock #, offer $/ct) pairs at once
+    
+    All stones are locked with one ledger write and the deal objects are
+    written in parallel; history gets one append and each supplier one
+    notification. Returns one result per offer, in order, with `ok`,
+    `deal_id` and `error`.
+    """
+    stock_df = await asyncio.to_thread(load_stock, False)
+    stone_index = get_stone_index(stock_df)
+    results: List[Dict[str, Any]] = []
+    candidates: Dict[str, Dict[str, Any]] = {}
+    
+    for stone_id, raw_price in offers:
+        result = {"stone_id": stone_id, "ok": False, "deal_id": None, "error": None}
+        results.append(result)
+        
+        try:
+            offer_price = float(raw_price)
+        except (TypeError, ValueError):
+            result["error"] = "Invalid price format"
+            continue
+        if offer_price <= 0:
+            result["error"] = "Invalid price"
+            continue
+        
+        location = stone_index.get(stone_id)
+        if location is None:
+            result["error"] = "Not found"
+            continue
+        
+        stone_data = stock_df.iloc[location.combined_row]
+        if stone_data.get("LOCKED") == "YES":
+            result["error"] = "Already locked"
+            continue
+        if stone_id in candidates:
+            result["error"] = "Duplicate offer"
+            continue
+        
+        candidates[stone_id] = {
+            "result": result,
+            "supplier": location.supplier,
+            "deal": {
+                "deal_id": f"DEAL-{uuid.uuid4().hex[:10].upper()}",
+                "stone_id": stone_id,
+                "supplier_username": str(stone_data.get("SUPPLIER", "")).replace("supplier_", ""),
+                "client_username": user["USERNAME"],
+                "actual_stock_price": float(stone_data.get("Price Per Carat", 0)),
+                "client_offer_price": offer_price,
+                "supplier_action": "PENDING",
+                "admin_action": "PENDING",
+                "final_status": "OPEN",
+                "created_at": datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
+            }
+        }
+    
+    if not candidates or not s3:
+        for entry in candidates.values():
+            entry["result"]["error"] = "Lock failed"
+        return results
+    
+    # The conditional ledger write decides every stone at once; stones
+    # another client locked meanwhile simply do not come back as changed
+    try:
+        locked = set(await asyncio.to_thread(
+            set_stone_locks, stock_df, {stone_id: entry["supplier"] for stone_id, entry in candidates.items()}, True
+        ))
+    except Exception as e:
+        logger.error(f"❌ Bulk lock failed for {len(candidates)} stones: {e}")
+        locked = set()
+    
+    for stone_id, entry in candidates.items():
+        if stone_id not in locked:
+            entry["result"]["error"] = "Lock failed"
+    
+    pending = [candidates[stone_id] for stone_id in candidates if stone_id in locked]
+    saved = await asyncio.gather(*(asyncio.to_thread(create_deal, entry["deal"]) for entry in pending))
+    
+    deals = []
+    unsaved: Dict[str, Optional[str]] = {}
+    for entry, ok in zip(pending, saved):
+        deal = entry["deal"]
+        if ok:
+            entry["result"].update(ok=True, deal_id=deal["deal_id"])
+            deals.append(deal)
+        else:
+            entry["result"]["error"] = "Could not save deal"
+            unsaved[deal["stone_id"]] = None
+    
+    if unsaved:
+        # Give back stones whose deal never got written
+        try:
+            await asyncio.to_thread(set_stone_locks, stock_df, unsaved, False)
+        except Exception as e:
+            logger.error(f"❌ Failed to release {len(unsaved)} bulk locks: {e}")
+    
+    if deals:
+        by_supplier: Dict[str, List[Dict]] = {}
+        for deal in deals:
+            by_supplier.setdefault(deal["supplier_username"], []).append(deal)
+        
+        def _notify(supplier: str, supplier_deals: List[Dict]):
+            lines = [f"• {d['stone_id']}: ${d['client_offer_price']}/ct" for d in supplier_deals[:20]]
+            if len(supplier_deals) > 20:
+                lines.append(f"... and {len(supplier_deals) - 20} more")
+            save_notification(
+                supplier,
+                "supplier",
+                f"📩 {len(supplier_deals)} new bulk deal offer(s)\n" + "\n".join(lines)
+            )
+        
+        await asyncio.gather(
+            asyncio.to_thread(log_deals_history, deals),
+            asyncio.to_thread(index_deals, deals),
+            *(asyncio.to_thread(_notify, supplier, supplier_deals) for supplier, supplier_deals in by_supplier.items())
+        )
+    
+    return results
+
+async def update_deals_batch(updates: Dict[str, Callable[[Optional[Dict]], Optional[Dict]]]) -> List[Dict]:
+    """Apply state changes to many deals concurrently
+    
+    Each deal is read and conditionally rewritten in its own worker thread,
+    so a sheet of decisions costs about one round-trip instead of one per
+    row. Returns the deals whose change was saved, in input order.
+    """
+    deal_ids = list(updates)
+    saved = await asyncio.gather(
+        *(asyncio.to_thread(update_deal, deal_id, updates[deal_id]) for deal_id in deal_ids),
+        return_exceptions=True
+    )
+    
+    deals = []
+    for deal_id, deal in zip(deal_ids, saved):
+        if isinstance(deal, Exception):
+            logger.error(f"Failed to process deal {deal_id}: {deal}")
+        elif deal is not None:
+            deals.append(deal)
+    return deals
+
+async def settle_deal_stones(removed: List[str], unlocked: List[str]):
+    """Stock side of closed deals: remove sold stones and release the rest"""
+    def _settle():
+        if removed:
+            apply_stone_removals(removed)
+        if unlocked:
+            set_stone_locks(load_stock(copy=False), dict.fromkeys(unlocked), False)
+    
+    if not removed and not unlocked:
+        return
+    try:
+        await asyncio.to_thread(_settle)
+        logger.info(f"✅ Settled deal stones: {len(removed)} removed, {len(unlocked)} unlocked")
+    except Exception as e:
+        logger.error(f"❌ Failed to settle deal stones: {e}")
+
+async def send_notifications(notifications: List[Tuple[Optional[str], str, str]]):
+    """Send (username, role, message) notifications, one segment per recipient
+    
+    A username of None addresses every user of the role through its shared
+    inbox. Recipients are written concurrently; messages to the same
+    recipient are combined into a single segment.
+    """
+    inboxes: Dict[Tuple[Optional[str], str], List[str]] = {}
+    for username, role, message in notifications:
+        inboxes.setdefault((username, role), []).append(message)
+    await asyncio.gather(*(
+        asyncio.to_thread(save_notifications, username, role, messages)
+        for (username, role), messages in inboxes.items()
+    ))
+
+# -------- DEAL INDEX --------
+# One small document with the listing fields of every deal, so View Deals
+# reads a single object instead of every deals/*.json
+DEAL_INDEX_FIELDS = [
+    "deal_id", "stone_id", "supplier_username", "client_username", "actual_stock_price",
+    "client_offer_price", "supplier_action", "admin_action", "final_status", "created_at"
+]
+# How often the index is checked against the deals themselves, to pick up
+# upserts that failed after their deal was saved
+DEAL_INDEX_RECONCILE_INTERVAL = 3600  # seconds
+
+def deal_progress(deal: Dict[str, Any]) -> int:
+    """How far a deal has moved from its initial state; deals only move forward"""
+    return (
+        (deal.get("supplier_action", "PENDING") != "PENDING")
+        + (deal.get("admin_action", "PENDING") != "PENDING")
+        + (deal.get("final_status", "OPEN") != "OPEN")
+    )
+
+def load_deal_index() -> Tuple[Optional[Dict[str, Dict]], Optional[str]]:
+    """Read the deal index and its ETag, (None, None) if it was never built"""
+    def _get_index():
+        try:
+            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=DEAL_INDEX_KEY)
+            return json.loads(obj["Body"].read()).get("deals", {}), obj["ETag"]
+        except botocore.exceptions.ClientError as e:
+            if is_missing_key_error(e):
+                return None, None
+            raise
+    
+    return safe_s3_operation(_get_index, fallback=(None, None))
+
+def serialize_deal_index(entries: Dict[str, Dict]) -> str:
+    return json.dumps({"deals": entries, "updated_at": datetime.now(IST).isoformat()})
+
+def scan_deals() -> Dict[str, Dict]:
+    """Index entries for every deal JSON in S3 (used once, to build the index)
+    
+    Raises if any deal could not be read: a partial index would hide those
+    deals for good, while an aborted build is simply retried by the next
+    writer or listing.
+    """
+    entries = {}
+    failed: List[str] = []
+    for page in iter_s3_pages(DEALS_FOLDER, suffix=".json"):
+        keys = [obj["Key"] for obj in page if obj["Key"] != DEAL_INDEX_KEY]
+        for key, deal in s3_fetch_pool.fetch(keys, json.loads, failed):
+            if deal:
+                deal_id = deal.get("deal_id", key[len(DEALS_FOLDER):-len(".json")])
+                entries[deal_id] = {field: deal.get(field) for field in DEAL_INDEX_FIELDS}
+    if failed:
+        raise RuntimeError(f"{len(failed)} deal(s) could not be read, e.g. {failed[0]}; deal index not built")
+    return entries
+
+def index_deals(deals: List[Dict[str, Any]]):
+    """Upsert deals into the index after they were saved
+    
+    Writers can land in any order, so an entry is only replaced by a state
+    at least as far along as the one already indexed.
+    """
+    def _mutate(entries: Optional[Dict[str, Dict]]) -> Optional[Dict[str, Dict]]:
+        if entries is None:
+            # First write builds the index from the deals already in S3
+            entries = scan_deals()
+        for deal in deals:
+            current = entries.get(deal["deal_id"])
+            if current is None or deal_progress(deal) >= deal_progress(current):
+                entries[deal["deal_id"]] = {field: deal.get(field) for field in DEAL_INDEX_FIELDS}
+        return entries
+    
+    try:
+        if s3 and deals:
+            compare_and_swap(DEAL_INDEX_KEY, load_deal_index, _mutate, serialize_deal_index)
+    except Exception as e:
+        # deal_index_reconcile_loop picks them up from the deals themselves
+        logger.error(f"❌ Failed to index {len(deals)} deal(s): {e}")
+
+def reconcile_deal_index() -> int:
+    """Fold every deal in S3 into the index; returns the entries it fixed
+    
+    An entry is only replaced by a deal that has moved further along, so a
+    scan older than a concurrent upsert never rolls it back.
+    """
+    scanned = scan_deals()
+    fixed = 0
+    
+    def _mutate(entries: Optional[Dict[str, Dict]]) -> Optional[Dict[str, Dict]]:
+        nonlocal fixed
+        if entries is None:
+            fixed = len(scanned)
+            return dict(scanned)
+        stale = {
+            deal_id: entry for deal_id, entry in scanned.items()
+            if deal_id not in entries or deal_progress(entry) > deal_progress(entries[deal_id])
+        }
+        fixed = len(stale)
+        if not stale:
+            return None
+        entries.update(stale)
+        return entries
+    
+    compare_and_swap(DEAL_INDEX_KEY, load_deal_index, _mutate, serialize_deal_index)
+    return fixed
+
+def build_deal_index() -> Tuple[Dict[str, Dict], Optional[str]]:
+    """Create the index from the deals in S3 unless another writer already did"""
+    built = compare_and_swap(
+        DEAL_INDEX_KEY, load_deal_index,
+        lambda current: scan_deals() if current is None else None,
+        serialize_deal_index
+    )
+    if built:
+        return built
+    entries, etag = load_deal_index()
+    return entries or {}, etag
+
+class DealListing:
+    """Indexed deals grouped by participant, re-read only when the index changes"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.etag: Optional[str] = None
+        self.deals: List[Dict[str, Any]] = []
+        self.by_role: Dict[str, Dict[str, List[Dict[str, Any]]]] = {"supplier": {}, "client": {}}
+    
+    def _fetch(self) -> Tuple[str, Optional[Dict[str, Dict]], Optional[str]]:
+        """("unchanged" | "missing" | "changed", entries, etag)"""
+        def _get_index():
+            extra = {"IfNoneMatch": self.etag} if self.etag else {}
+            try:
+                obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=DEAL_INDEX_KEY, **extra)
+                return "changed", json.loads(obj["Body"].read()).get("deals", {}), obj["ETag"]
+            except botocore.exceptions.ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                    return "unchanged", None, self.etag
+                if is_missing_key_error(e):
+                    return "missing", None, None
+                raise
+        
+        return safe_s3_operation(_get_index, fallback=("unchanged", None, self.etag))
+    
+    def refresh(self):
+        with self._lock:
+            state, entries, etag = self._fetch()
+            if state == "unchanged":
+                return
+            if state == "missing":
+                entries, etag = build_deal_index()
+            
+            deals = sorted(entries.values(), key=lambda d: d.get("created_at") or "", reverse=True)
+            by_role = {"supplier": {}, "client": {}}
+            for deal in deals:
+                by_role["supplier"].setdefault(str(deal.get("supplier_username") or "").lower(), []).append(deal)
+                by_role["client"].setdefault(str(deal.get("client_username") or "").lower(), []).append(deal)
+            self.deals, self.by_role, self.etag = deals, by_role, etag
+    
+    def for_user(self, role: str, username: str) -> List[Dict[str, Any]]:
+        """Deals visible to a user, newest first; admins see all"""
+        self.refresh()
+        if role == "admin":
+            return list(self.deals)
+        return list(self.by_role.get(role, {}).get(username.lower(), []))
+
+deal_listing = DealListing()
+
 # -------- BACKGROUND TASKS --------
 async def session_cleanup_loop():
     """Background task to clean up expired sessions"""
@@ -1099,6 +3475,53 @@ async def session_cleanup_loop():
             logger.error(f"❌ Session cleanup error: {e}")
         await asyncio.sleep(600)
 
+async def activity_flush_loop():
+    """Background task to write buffered activity entries"""
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(activity_log.flush)
+        except Exception as e:
+            logger.error(f"❌ Activity flush error: {e}")
+
+async def activity_rollup_loop():
+    """Background task to roll up activity days once they close"""
+    while True:
+        try:
+            await asyncio.to_thread(ensure_recent_activity_rollups)
+        except Exception as e:
+            logger.error(f"❌ Activity rollup error: {e}")
+        await asyncio.sleep(ACTIVITY_ROLLUP_INTERVAL)
+
+async def deal_index_reconcile_loop():
+    """Background task to repair deal index entries whose upsert failed"""
+    while True:
+        await asyncio.sleep(DEAL_INDEX_RECONCILE_INTERVAL)
+        try:
+            fixed = await asyncio.to_thread(reconcile_deal_index)
+            if fixed:
+                logger.info(f"✅ Deal index reconciled: {fixed} entries updated")
+        except Exception as e:
+            logger.error(f"❌ Deal index reconcile error: {e}")
+
+async def notification_maintenance_loop():
+    """Background task to migrate legacy inboxes once, then compact read segments"""
+    try:
+        # Cursors first: unread legacy messages are migrated after them, so they still show
+        await asyncio.to_thread(start_missing_notification_cursors)
+    except Exception as e:
+        logger.error(f"❌ Notification cursor start error: {e}")
+    try:
+        await asyncio.to_thread(migrate_legacy_notifications)
+    except Exception as e:
+        logger.error(f"❌ Notification migration error: {e}")
+    while True:
+        try:
+            await asyncio.to_thread(compact_notifications)
+        except Exception as e:
+            logger.error(f"❌ Notification compaction error: {e}")
+        await asyncio.sleep(NOTIFICATION_COMPACT_INTERVAL)
+
 async def user_state_cleanup_loop():
     """Background task to clean up old user states"""
     while True:
@@ -1168,6 +3591,10 @@ async def lifespan(app: FastAPI):
     # Start background tasks
     asyncio.create_task(session_cleanup_loop())
     asyncio.create_task(user_state_cleanup_loop())
+    asyncio.create_task(activity_flush_loop())
+    asyncio.create_task(activity_rollup_loop())
+    asyncio.create_task(notification_maintenance_loop())
+    asyncio.create_task(deal_index_reconcile_loop())
     
     logger.info("✅ Bot startup complete")
     
@@ -1186,6 +3613,14 @@ async def lifespan(app: FastAPI):
     # Save sessions before shutdown
     save_sessions()
     
+    # Write whatever activity is still buffered
+    try:
+        await asyncio.to_thread(activity_log.flush)
+    except Exception as e:
+        logger.error(f"❌ Failed to flush activity log: {e}")
+    
+    s3_fetch_pool.shutdown()
+    
     # Close bot session
     try:
         await bot.session.close()
@@ -1344,6 +3779,14 @@ async def status_check():
             "bucket_accessible": None
         },
         
+        "stock_cache": stock_cache.stats(),
+        
+        "supplier_frame_cache": supplier_frame_cache.stats(),
+        
+        "locks": lock_metrics.snapshot(),
+        
+        "activity_log": activity_log.stats(),
+        
         "system": {
             "python_version": CONFIG.get("PYTHON_VERSION"),
             "port": CONFIG.get("PORT"),
@@ -1607,6 +4050,21 @@ async def get_sessions():
         "sessions": {str(k): v for k, v in logged_in_users.items()}
     }
 
+@app.get("/debug/memory")
+async def debug_memory():
+    """Memory of the cached stock frame before and after compaction"""
+    try:
+        import resource
+        max_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    except Exception:
+        max_rss_mb = None
+    
+    return {
+        "process_max_rss_mb": max_rss_mb,
+        "stock": stock_cache.memory_report(),
+        "timestamp": datetime.now(IST).isoformat()
+    }
+
 @app.get("/webhook-info")
 async def get_webhook_info():
     """Get current webhook information"""
@@ -1760,11 +4218,12 @@ async def api_upload_excel(
                 def _upload():
                     s3.upload_file(temp_path, CONFIG["AWS_BUCKET"], supplier_file)
                 
-                safe_s3_operation(_upload)
+                async with stock_locks.supplier(supplier_name, timeout=STOCK_LOCK_TIMEOUT):
+                    await asyncio.to_thread(safe_s3_operation, _upload)
                 logger.info(f"✅ Uploaded {len(cleaned_df)} diamonds for supplier {username}")
         
         # Rebuild combined stock
-        rebuild_combined_stock()
+        await asyncio.to_thread(rebuild_combined_stock)
         
         # Calculate statistics
         total_stones = len(cleaned_df)
@@ -2016,7 +4475,7 @@ async def logout_command(message: types.Message):
         
         logged_in_users.pop(uid, None)
         user_state.pop(uid, None)
-        save_sessions()
+        await asyncio.to_thread(save_sessions)
         
         await message.reply(
             "✅ Successfully logged out.\n"
@@ -2057,8 +4516,8 @@ async def handle_all_messages(message: types.Message):
         
         # Update session activity if logged in
         user = get_logged_user(uid)
-        if user:
-            touch_session(uid)
+        if user and touch_session(uid):
+            await asyncio.to_thread(save_sessions)
         
         # Handle state-based flows
         state = user_state.get(uid)
@@ -2092,13 +4551,18 @@ async def handle_all_messages(message: types.Message):
             elif state.get("step", "").startswith("deal_"):
                 await handle_deal_flow(message, state)
                 return
+            
+            # Activity report range
+            elif state.get("step") == "report_range":
+                await handle_report_range(message, state)
+                return
         
         # Handle button presses for logged in users
         if user:
             # Check if it's a menu button
             menu_buttons = [
                 "💎 View All Stock", "👥 View Users", "⏳ Pending Accounts", 
-                "🏆 Supplier Leaderboard", "🤝 View Deals", "📑 User Activity Report",
+                "🏆 Supplier Leaderboard", "🤝 View Deals", "📑 User Activity Report", "📊 Activity Summary",
                 "🗑 Delete Supplier Stock", "🚪 Logout", "📤 Upload Excel", 
                 "📦 My Stock", "📊 My Analytics", "📥 Download Sample Excel",
                 "💎 Search Diamonds", "🔥 Smart Deals", "🤝 Request Deal"
@@ -2180,7 +4644,6 @@ async def handle_create_password(message: types.Message, state: Dict):
         
         username = state["username"]
         
-        df = load_accounts()
         new_row = {
             "USERNAME": username,
             "PASSWORD": clean_password(password),
@@ -2188,10 +4651,19 @@ async def handle_create_password(message: types.Message, state: Dict):
             "APPROVED": "NO"
         }
         
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        save_accounts(df)
+        def _add_account(df: pd.DataFrame) -> Optional[pd.DataFrame]:
+            # Re-checked on every attempt: someone may have taken the name meanwhile
+            if not df[df["USERNAME"].str.lower() == username.lower()].empty:
+                return None
+            return pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+        
+        if not update_accounts(_add_account):
+            await message.reply("❌ Could not create account. The username may already be taken.")
+            user_state.pop(uid, None)
+            return
         
         user_state.pop(uid, None)
+        await asyncio.to_thread(start_notification_cursor, notification_inbox(username, "client"))
         
         await message.reply(
             "✅ Account created successfully!\n\n"
@@ -2200,13 +4672,9 @@ async def handle_create_password(message: types.Message, state: Dict):
             "Use /login after approval."
         )
         
-        admin_df = df[df["ROLE"].str.lower() == "admin"]
-        for _, admin in admin_df.iterrows():
-            save_notification(
-                admin["USERNAME"],
-                "admin",
-                f"📝 New account pending approval: {username}"
-            )
+        await asyncio.to_thread(
+            save_notification, None, "admin", f"📝 New account pending approval: {username}"
+        )
         
         log_activity({"USERNAME": username, "ROLE": "client", "TELEGRAM_ID": uid}, "ACCOUNT_CREATED")
         
@@ -2278,7 +4746,7 @@ async def handle_login_password(message: types.Message, state: Dict):
             "SUPPLIER_KEY": f"supplier_{user_data['USERNAME'].lower()}" if role == "supplier" else None,
             "last_active": time.time()
         }
-        save_sessions()
+        await asyncio.to_thread(save_sessions)
         
         log_activity(logged_in_users[uid], "LOGIN")
         
@@ -2294,7 +4762,7 @@ async def handle_login_password(message: types.Message, state: Dict):
         
         await message.reply(welcome_msg, reply_markup=kb)
         
-        notifications = fetch_unread_notifications(user_data["USERNAME"], role)
+        notifications = await asyncio.to_thread(fetch_unread_notifications, user_data["USERNAME"], role)
         if notifications:
             note_msg = "🔔 **Unread Notifications**\n\n"
             for note in notifications[:5]:
@@ -2329,15 +4797,20 @@ async def handle_search_flow(message: types.Message, state: Dict):
         elif current_step == "search_shape":
             search["shape"] = text
             state["step"] = "search_color"
-            await message.reply("Enter Color(s) (e.g., d, e, f) or 'any':")
+            await message.reply("Enter Color(s) (e.g., d, e, f or d-f) or 'any':")
             
         elif current_step == "search_color":
             search["color"] = text
             state["step"] = "search_clarity"
-            await message.reply("Enter Clarity(ies) (e.g., vs, vvs) or 'any':")
+            await message.reply("Enter Clarity(ies) (e.g., vs, vvs or vs2+ for VS2 and better) or 'any':")
             
         elif current_step == "search_clarity":
             search["clarity"] = text
+            state["step"] = "search_type"
+            await message.reply("Enter Diamond Type(s) (e.g., natural, lgd) or 'any':")
+        
+        elif current_step == "search_type":
+            search["type"] = text
             
             user = get_logged_user(uid)
             if not user:
@@ -2345,54 +4818,35 @@ async def handle_search_flow(message: types.Message, state: Dict):
                 user_state.pop(uid, None)
                 return
             
-            df = load_stock()
+            df = load_stock(copy=False)
             if df.empty:
                 await message.reply("❌ No diamonds available in stock.")
                 user_state.pop(uid, None)
                 return
             
-            filtered_df = df.copy()
-            
             # Carat filter
+            carat_range = None
             if search["carat"] != "any":
                 try:
                     if "-" in search["carat"]:
                         min_carat, max_carat = map(float, search["carat"].split("-"))
-                        filtered_df = filtered_df[
-                            (filtered_df["Weight"] >= min_carat) & 
-                            (filtered_df["Weight"] <= max_carat)
-                        ]
                     else:
                         target_carat = float(search["carat"])
-                        filtered_df = filtered_df[
-                            (filtered_df["Weight"] >= target_carat * 0.9) & 
-                            (filtered_df["Weight"] <= target_carat * 1.1)
-                        ]
+                        min_carat, max_carat = target_carat * 0.9, target_carat * 1.1
+                    carat_range = (min_carat, max_carat)
                 except:
                     await message.reply("❌ Invalid carat format. Use like '1.5' or '1-2'")
                     user_state.pop(uid, None)
                     return
             
-            # Shape filter
-            if search["shape"] != "any":
-                shapes = [s.strip() for s in search["shape"].split(",")]
-                filtered_df = filtered_df[
-                    filtered_df["Shape"].str.lower().isin([s.lower() for s in shapes])
-                ]
-            
-            # Color filter
-            if search["color"] != "any":
-                colors = [c.strip().upper() for c in search["color"].split(",")]
-                filtered_df = filtered_df[
-                    filtered_df["Color"].str.upper().isin(colors)
-                ]
+            # Shape / Color / Clarity / Diamond Type filters via the inverted index
+            filters = {}
+            for col, key in (("Shape", "shape"), ("Color", "color"), ("Clarity", "clarity"), ("Diamond Type", "type")):
+                if search[key] != "any":
+                    filters[col] = [v.strip() for v in search[key].split(",")]
             
-            # Clarity filter
-            if search["clarity"] != "any":
-                clarities = [c.strip().upper() for c in search["clarity"].split(",")]
-                filtered_df = filtered_df[
-                    filtered_df["Clarity"].str.upper().isin(clarities)
-                ]
+            rows = get_search_index(df).search(filters, carat_range)
+            filtered_df = excel_stock_frame(df.iloc[rows])
             
             if filtered_df.empty:
                 await message.reply("❌ No diamonds match your search criteria.")
@@ -2415,7 +4869,8 @@ async def handle_search_flow(message: types.Message, state: Dict):
                             f"• Carat: {search['carat']}\n"
                             f"• Shape: {search['shape']}\n"
                             f"• Color: {search['color']}\n"
-                            f"• Clarity: {search['clarity']}"
+                            f"• Clarity: {search['clarity']}\n"
+                            f"• Type: {search['type']}"
                         )
                     )
             else:
@@ -2475,7 +4930,7 @@ async def handle_deal_flow(message: types.Message, state: Dict):
             
             stone_id = state["stone_id"]
             
-            df = load_stock()
+            df = await asyncio.to_thread(load_stock, False)
             stone_row = df[df["Stock #"] == stone_id]
             
             if stone_row.empty:
@@ -2504,27 +4959,29 @@ async def handle_deal_flow(message: types.Message, state: Dict):
                 "created_at": datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
             }
             
-            if not atomic_lock_stone(stone_id):
+            if not await atomic_lock_stone(stone_id):
                 await message.reply("🔒 Stone is no longer available.")
                 user_state.pop(uid, None)
                 return
             
-            if s3:
-                deal_key = f"{DEALS_FOLDER}{deal_id}.json"
-                s3.put_object(
-                    Bucket=CONFIG["AWS_BUCKET"],
-                    Key=deal_key,
-                    Body=json.dumps(deal, indent=2),
-                    ContentType="application/json"
-                )
-            
-            log_deal_history(deal)
+            # S3 work runs in worker threads, like the bulk path, so the loop keeps serving
+            if not (s3 and await asyncio.to_thread(create_deal, deal)):
+                # Give the stone back: no deal exists that could release it later
+                await unlock_stone(stone_id)
+                await message.reply("❌ Could not save your deal request. Please try again.")
+                user_state.pop(uid, None)
+                return
             
-            save_notification(
-                deal["supplier_username"],
-                "supplier",
-                f"📩 New deal offer for Stone {stone_id}\n"
-                f"💰 Offer: ${offer_price}/ct"
+            await asyncio.gather(
+                asyncio.to_thread(index_deals, [deal]),
+                asyncio.to_thread(log_deal_history, deal),
+                asyncio.to_thread(
+                    save_notification,
+                    deal["supplier_username"],
+                    "supplier",
+                    f"📩 New deal offer for Stone {stone_id}\n"
+                    f"💰 Offer: ${offer_price}/ct"
+                )
             )
             
             log_activity(user, "REQUEST_DEAL", {
@@ -2573,6 +5030,8 @@ async def handle_logged_in_buttons(message: types.Message, user: Dict):
                 await view_deals(message, user)
             elif text == "📑 User Activity Report":
                 await user_activity_report(message, user)
+            elif text == "📊 Activity Summary":
+                await activity_summary(message, user)
             elif text == "🗑 Delete Supplier Stock":
                 await delete_supplier_stock(message, user)
             elif text == "🚪 Logout":
@@ -2618,38 +5077,35 @@ async def handle_logged_in_buttons(message: types.Message, user: Dict):
 async def view_all_stock(message: types.Message, user: Dict):
     """Admin: View all stock"""
     try:
-        df = load_stock()
+        summary = load_stock_summary()
         
-        if df.empty:
+        if not summary or not summary.get("total_diamonds"):
             await message.reply("❌ No stock available.")
             return
         
-        total_diamonds = len(df)
-        total_carats = df["Weight"].sum()
-        total_value = (df["Weight"] * df["Price Per Carat"]).sum()
+        total_diamonds = summary["total_diamonds"]
         
-        summary = (
+        summary_msg = (
             f"📊 **Stock Summary**\n\n"
             f"💎 Total Diamonds: {total_diamonds}\n"
-            f"⚖️ Total Carats: {total_carats:.2f}\n"
-            f"💰 Estimated Value: ${total_value:,.2f}\n"
-            f"👥 Suppliers: {df['SUPPLIER'].nunique()}\n\n"
+            f"⚖️ Total Carats: {summary['total_carats']:.2f}\n"
+            f"💰 Estimated Value: ${summary['total_value']:,.2f}\n"
+            f"👥 Suppliers: {summary['supplier_count']}\n\n"
             f"**Top Shapes:**\n"
         )
         
-        shape_counts = df["Shape"].value_counts().head(5)
-        for shape, count in shape_counts.items():
-            summary += f"• {shape}: {count}\n"
+        for shape, count in list(summary["shape_counts"].items())[:5]:
+            summary_msg += f"• {shape}: {count}\n"
         
-        await message.reply(summary, parse_mode=ParseMode.MARKDOWN, reply_markup=admin_kb)
+        await message.reply(summary_msg, parse_mode=ParseMode.MARKDOWN, reply_markup=admin_kb)
         
+        # Live lock state: the published workbook is reused only while stock and locks are unchanged
         with TempFileManager(suffix=".xlsx") as excel_path:
-            df.to_excel(excel_path, index=False)
-            
-            await message.reply_document(
-                types.FSInputFile(excel_path),
-                caption=f"📊 Complete Stock List ({total_diamonds} diamonds)"
-            )
+            if await asyncio.to_thread(export_combined_stock, excel_path):
+                await message.reply_document(
+                    types.FSInputFile(excel_path),
+                    caption=f"📊 Complete Stock List ({total_diamonds} diamonds)"
+                )
         
         log_activity(user, "VIEW_ALL_STOCK")
         
@@ -2732,20 +5188,13 @@ async def pending_accounts(message: types.Message, user: Dict):
 async def supplier_leaderboard(message: types.Message, user: Dict):
     """Admin: Supplier leaderboard"""
     try:
-        df = load_stock()
+        summary = load_stock_summary()
         
-        if df.empty or "SUPPLIER" not in df.columns:
+        if not summary or not summary.get("suppliers"):
             await message.reply("❌ No supplier data available.")
             return
         
-        supplier_stats = df.groupby("SUPPLIER").agg(
-            Stones=("SUPPLIER", "count"),
-            Total_Carats=("Weight", "sum"),
-            Avg_Price_Per_Carat=("Price Per Carat", "mean"),
-            Total_Value=("Weight", lambda x: (x * df.loc[x.index, "Price Per Carat"]).sum())
-        ).round(2)
-        
-        supplier_stats = supplier_stats.sort_values("Stones", ascending=False)
+        supplier_stats = pd.DataFrame(summary["suppliers"]).set_index("SUPPLIER")
         
         leaderboard_msg = "🏆 **Supplier Leaderboard**\n\n"
         
@@ -2753,7 +5202,7 @@ async def supplier_leaderboard(message: types.Message, user: Dict):
             supplier_name = supplier.replace("supplier_", "").title()
             leaderboard_msg += (
                 f"{i}. **{supplier_name}**\n"
-                f"   💎 Stones: {stats['Stones']}\n"
+                f"   💎 Stones: {int(stats['Stones'])}\n"
                 f"   ⚖️ Carats: {stats['Total_Carats']:.2f}\n"
                 f"   💰 Avg Price: ${stats['Avg_Price_Per_Carat']:,.2f}/ct\n"
                 f"   🏦 Total Value: ${stats['Total_Value']:,.2f}\n\n"
@@ -2776,24 +5225,143 @@ async def supplier_leaderboard(message: types.Message, user: Dict):
         await message.reply("❌ Failed to load supplier data.")
 
 async def user_activity_report(message: types.Message, user: Dict):
-    """Admin: Generate activity report"""
+    """Admin: Ask which days the activity report should cover"""
     try:
-        excel_path = generate_activity_excel()
+        user_state[message.from_user.id] = {
+            "step": "report_range",
+            "last_updated": time.time()
+        }
+        
+        await message.reply(
+            "📑 **User Activity Report**\n\n"
+            "Which days should the report cover?\n\n"
+            "**Examples:**\n"
+            "• 2024-01-01 to 2024-01-31\n"
+            "• 2024-01-15 (a single day)\n"
+            f"• {ACTIVITY_REPORT_DAYS} (the last {ACTIVITY_REPORT_DAYS} days, including today)\n"
+            "• all (everything recorded)",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    except Exception as e:
+        logger.error(f"❌ Error in user_activity_report: {e}")
+        await message.reply("❌ An error occurred. Please try again.")
+
+async def handle_report_range(message: types.Message, state: Dict):
+    """Admin: Generate the activity report for the range they entered"""
+    uid = message.from_user.id
+    excel_path = None
+    try:
+        user = get_logged_user(uid)
+        if not user or user.get("ROLE", "").lower() != "admin":
+            await message.reply("❌ Session expired. Please login again.")
+            user_state.pop(uid, None)
+            return
+        
+        end_date = datetime.now(IST).date()
+        try:
+            start_date, end_date = parse_report_range(message.text or "", end_date)
+        except ValueError:
+            await message.reply(
+                "❌ Enter dates as YYYY-MM-DD (e.g. 2024-01-01 to 2024-01-31), "
+                "a number of days, or 'all':"
+            )
+            return
+        user_state.pop(uid, None)
+        
+        if start_date is None:
+            start_date = await asyncio.to_thread(first_activity_day)
+            if start_date is None:
+                await message.reply("❌ No activity logs found.")
+                return
+        
+        failed: List[str] = []
+        excel_path = await asyncio.to_thread(generate_activity_excel, start_date, end_date, failed)
         
         if not excel_path:
-            await message.reply("❌ No activity logs found.")
+            await message.reply(f"❌ No activity logs found for {start_date} to {end_date}.")
             return
         
-        await message.reply_document(
-            types.FSInputFile(excel_path),
-            caption="📑 User Activity Report"
-        )
+        caption = f"📑 User Activity Report ({start_date} to {end_date})"
+        if failed:
+            caption += f"\n⚠️ Incomplete: {len(failed)} log segment(s) could not be read, try again later."
+        await message.reply_document(types.FSInputFile(excel_path), caption=caption)
         
-        log_activity(user, "DOWNLOAD_ACTIVITY_REPORT")
+        log_activity(user, "DOWNLOAD_ACTIVITY_REPORT", {"from": str(start_date), "to": str(end_date)})
         
     except Exception as e:
-        logger.error(f"❌ Error in user_activity_report: {e}")
+        logger.error(f"❌ Error in handle_report_range: {e}")
         await message.reply("❌ Failed to generate activity report.")
+        user_state.pop(uid, None)
+    finally:
+        if excel_path and os.path.exists(excel_path):
+            os.remove(excel_path)
+
+async def activity_summary(message: types.Message, user: Dict):
+    """Admin: Activity counts for the last ACTIVITY_SUMMARY_DAYS days from daily rollups"""
+    try:
+        if not s3:
+            await message.reply("❌ AWS connection not available.")
+            return
+        
+        end_date = datetime.now(IST).date()
+        start_date = end_date - timedelta(days=ACTIVITY_SUMMARY_DAYS - 1)
+        
+        # Today's rollup is built from raw events, so include what is still buffered
+        await asyncio.to_thread(activity_log.flush)
+        failed: List[str] = []
+        rollups = await asyncio.to_thread(load_activity_rollups, start_date, end_date, failed)
+        summary = summarize_activity(rollups)
+        
+        per_day = summary["per_day"]
+        if not any(day["events"] for day in per_day):
+            await message.reply(f"ℹ️ No activity between {start_date} and {end_date}.", reply_markup=admin_kb)
+            return
+        
+        def _top(counts: Dict[str, int], n: int = 5) -> str:
+            ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+            return ", ".join(f"{name} ({count})" for name, count in ranked) or "-"
+        
+        msg = f"📊 **Activity Summary** ({start_date} to {end_date})\n\n"
+        msg += f"📈 Events: {sum(day['events'] for day in per_day)}\n"
+        msg += f"🔑 Logins: {sum(day['logins'] for day in per_day)}\n"
+        msg += f"🔍 Searches: {sum(day['searches'] for day in per_day)}\n"
+        msg += f"🤝 Deal requests: {sum(day['deal_requests'] for day in per_day)}\n"
+        msg += f"📤 Uploads: {sum(day['uploads'] for day in per_day)}\n\n"
+        msg += f"**Top searchers:** {_top(summary['searches_by_user'])}\n"
+        for name, values in sorted(summary["search_filters"].items()):
+            msg += f"**{name.title()}:** {_top(values, 3)}\n"
+        if failed:
+            msg += f"\n⚠️ Incomplete: {len(failed)} log segment(s) could not be read, try again later.\n"
+        
+        await message.reply(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=admin_kb)
+        
+        counts_df = pd.DataFrame([
+            {"Date": rollup["date"], "Action": row["action"], "Role": row["role"], "User": row["user"], "Count": row["count"]}
+            for rollup in rollups for row in rollup["counts"]
+        ])
+        filters_df = pd.DataFrame([
+            {"Filter": name, "Value": value, "Searches": count}
+            for name, values in summary["search_filters"].items() for value, count in values.items()
+        ], columns=["Filter", "Value", "Searches"])
+        
+        buffer = BytesIO()
+        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+            pd.DataFrame(per_day).to_excel(writer, sheet_name="Daily", index=False)
+            counts_df.to_excel(writer, sheet_name="Counts", index=False)
+            filters_df.sort_values("Searches", ascending=False).to_excel(writer, sheet_name="Search Filters", index=False)
+        buffer.seek(0)
+        
+        await message.reply_document(
+            BufferedInputFile(buffer.read(), filename=f"activity_summary_{start_date}_{end_date}.xlsx"),
+            caption=f"📊 Activity Summary ({start_date} to {end_date})"
+        )
+        
+        log_activity(user, "VIEW_ACTIVITY_SUMMARY")
+    
+    except Exception as e:
+        logger.error(f"❌ Error in activity_summary: {e}")
+        await message.reply("❌ Failed to build activity summary.")
 
 async def delete_supplier_stock(message: types.Message, user: Dict):
     """Admin: Delete all supplier stock (with confirmation)"""
@@ -2859,12 +5427,19 @@ async def supplier_my_stock(message: types.Message, user: Dict):
             with TempFileManager(suffix=".xlsx") as local_path:
                 def _download():
                     s3.download_file(CONFIG["AWS_BUCKET"], stock_key, local_path)
+                    return True
                 
                 if not safe_s3_operation(_download, fallback=False):
                     await message.reply("❌ You haven't uploaded any stock yet.")
                     return
                 
-                df = pd.read_excel(local_path)
+                def _with_live_locks() -> pd.DataFrame:
+                    # LOCKED in the workbook is as uploaded; the ledger has the live state
+                    df = apply_ledger_locks(pd.read_excel(local_path))
+                    excel_stock_frame(df, layout=None).to_excel(local_path, index=False)
+                    return df
+                
+                df = await asyncio.to_thread(_with_live_locks)
                 
                 total_stones = len(df)
                 total_carats = df["Weight"].sum() if "Weight" in df.columns else 0
@@ -2907,53 +5482,46 @@ async def supplier_analytics(message: types.Message, user: Dict):
     try:
         supplier_key = user.get("SUPPLIER_KEY", f"supplier_{user['USERNAME'].lower()}")
         
-        df = load_stock()
+        df = load_stock(copy=False)
         if df.empty:
             await message.reply("❌ No market data available.")
             return
         
-        my_stones = df[df["SUPPLIER"].str.lower() == supplier_key.lower()]
+        mine = np.flatnonzero((df["SUPPLIER"].astype(str).str.lower() == supplier_key.lower()).to_numpy())
         
-        if my_stones.empty:
+        if len(mine) == 0:
             await message.reply("❌ You have no stones in the market.")
             return
         
-        results = []
+        counts, market_avg = get_market_table(df).comparables(mine)
+        has_market = counts > 1
         
-        for _, stone in my_stones.iterrows():
-            similar = df[
-                (df["Shape"] == stone["Shape"]) &
-                (df["Color"] == stone["Color"]) &
-                (df["Clarity"] == stone["Clarity"]) &
-                (df["Diamond Type"] == stone.get("Diamond Type", "")) &
-                (abs(df["Weight"] - stone["Weight"]) <= 0.2)
-            ]
-            
-            if len(similar) > 1:
-                market_avg = similar["Price Per Carat"].mean()
-                my_price = stone["Price Per Carat"]
-                price_diff = my_price - market_avg
-                price_diff_pct = (price_diff / market_avg * 100) if market_avg > 0 else 0
-                
-                results.append({
-                    "Stock #": stone["Stock #"],
-                    "Weight": stone["Weight"],
-                    "Shape": stone["Shape"],
-                    "Color": stone["Color"],
-                    "Clarity": stone["Clarity"],
-                    "Your Price": my_price,
-                    "Market Avg": market_avg,
-                    "Price Diff": price_diff,
-                    "Diff %": price_diff_pct,
-                    "Status": "Above Market" if price_diff > 0 else "Below Market" if price_diff < 0 else "Market Average"
-                })
-        
-        if not results:
+        if not has_market.any():
             await message.reply("ℹ️ No comparable stones found in market for analysis.")
             return
         
-        results_df = pd.DataFrame(results)
-        results_df = results_df.sort_values("Diff %", ascending=False)
+        stones = widen_stock_frame(df.iloc[mine[has_market]])
+        market_avg = market_avg[has_market]
+        my_price = pd.to_numeric(stones["Price Per Carat"], errors="coerce").to_numpy(dtype=float)
+        price_diff = my_price - market_avg
+        with np.errstate(divide="ignore", invalid="ignore"):
+            price_diff_pct = np.where(market_avg > 0, price_diff / market_avg * 100, 0)
+        
+        results_df = pd.DataFrame({
+            "Stock #": stones["Stock #"].to_numpy(),
+            "Weight": stones["Weight"].to_numpy(),
+            "Shape": stones["Shape"].to_numpy(),
+            "Color": stones["Color"].to_numpy(),
+            "Clarity": stones["Clarity"].to_numpy(),
+            "Your Price": stones["Price Per Carat"].to_numpy(),
+            "Market Avg": market_avg,
+            "Price Diff": price_diff,
+            "Diff %": price_diff_pct,
+            "Status": np.select(
+                [price_diff > 0, price_diff < 0], ["Above Market", "Below Market"], default="Market Average"
+            )
+        })
+        results_df = results_df.sort_values("Diff %", ascending=False, kind="stable")
         
         above_market = len(results_df[results_df["Diff %"] > 5])
         below_market = len(results_df[results_df["Diff %"] < -5])
@@ -3100,26 +5668,22 @@ async def search_diamonds_start(message: types.Message, user: Dict):
 async def smart_deals(message: types.Message, user: Dict):
     """Client: Find smart deals (discounted diamonds)"""
     try:
-        df = load_stock()
+        df = load_stock(copy=False)
         
         if df.empty:
             await message.reply("❌ No diamonds available.")
             return
         
-        df["Price Per Carat"] = pd.to_numeric(df["Price Per Carat"], errors="coerce")
-        df["Weight"] = pd.to_numeric(df["Weight"], errors="coerce")
-        
-        group_cols = ["Shape", "Color", "Clarity", "Diamond Type"]
-        df["Market_Avg"] = df.groupby(group_cols)["Price Per Carat"].transform("median")
-        
-        df["Discount_%"] = ((df["Market_Avg"] - df["Price Per Carat"]) / df["Market_Avg"] * 100).round(1)
-        
-        good_deals = df[df["Discount_%"] >= 10].sort_values("Discount_%", ascending=False)
+        market = get_market_table(df)
+        rows = market.top_deals()
         
-        if good_deals.empty:
+        if len(rows) == 0:
             await message.reply("😔 No strong deals found right now.")
             return
         
+        good_deals = widen_stock_frame(df.iloc[rows])
+        good_deals["Discount_%"] = market.discount[rows]
+        
         top_deals = good_deals.head(5)
         
         deals_msg = "🔥 **Smart Deals Found**\n\n"
@@ -3202,7 +5766,7 @@ async def request_deal_start(message: types.Message, user: Dict):
                 "last_updated": time.time()
             }
             
-            available_stones = df[df["LOCKED"] != "YES"].head(5)
+            available_stones = widen_stock_frame(df[df["LOCKED"] != "YES"].head(5))
             
             if available_stones.empty:
                 await message.reply("❌ No stones available for deals at the moment.")
@@ -3237,69 +5801,23 @@ async def view_deals(message: types.Message, user: Dict):
             await message.reply("❌ AWS connection not available.")
             return
         
-        def _list_objects():
-            return s3.list_objects_v2(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Prefix=DEALS_FOLDER
-            )
-        
-        objs = safe_s3_operation(_list_objects, fallback={})
-        
-        if "Contents" not in objs:
-            await message.reply("ℹ️ No deals found.")
-            return
-        
-        deals = []
-        for obj in objs["Contents"]:
-            if not obj["Key"].endswith(".json"):
-                continue
-            
-            try:
-                def _get_object():
-                    return s3.get_object(
-                        Bucket=CONFIG["AWS_BUCKET"],
-                        Key=obj["Key"]
-                    )["Body"].read().decode("utf-8")
-                
-                deal_data = safe_s3_operation(_get_object, fallback="")
-                if deal_data:
-                    deal = json.loads(deal_data)
-                    deals.append(deal)
-            except Exception as e:
-                logger.error(f"Failed to load deal {obj['Key']}: {e}")
-                continue
-        
-        if not deals:
-            await message.reply("ℹ️ No deals available.")
-            return
-        
-        deals.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-        
         user_role = user["ROLE"]
-        username = user["USERNAME"].lower()
         
         if user_role == "admin":
-            filtered_deals = deals
             title = "All Deals"
             kb = admin_kb
         elif user_role == "supplier":
-            filtered_deals = [
-                d for d in deals 
-                if d.get("supplier_username", "").lower() == username
-            ]
             title = "Your Deals"
             kb = supplier_kb
         elif user_role == "client":
-            filtered_deals = [
-                d for d in deals 
-                if d.get("client_username", "").lower() == username
-            ]
             title = "Your Deal Requests"
             kb = client_kb
         else:
             await message.reply("❌ Unauthorized access.")
             return
         
+        filtered_deals = await asyncio.to_thread(deal_listing.for_user, user_role, user["USERNAME"])
+        
         if not filtered_deals:
             await message.reply(f"ℹ️ No {title.lower()} found.")
             return
@@ -3360,15 +5878,16 @@ async def approve_user_callback(callback: types.CallbackQuery):
         
         username = callback.data.split(":")[1]
         
-        df = load_accounts()
+        def _approve(df: pd.DataFrame) -> Optional[pd.DataFrame]:
+            if df[df["USERNAME"] == username].empty:
+                return None
+            df.loc[df["USERNAME"] == username, "APPROVED"] = "YES"
+            return df
         
-        if df[df["USERNAME"] == username].empty:
+        if not update_accounts(_approve):
             await callback.answer("❌ User not found", show_alert=True)
             return
         
-        df.loc[df["USERNAME"] == username, "APPROVED"] = "YES"
-        save_accounts(df)
-        
         save_notification(username, "client", "✅ Your account has been approved by admin!")
         
         log_activity(admin, "APPROVE_USER", {"username": username})
@@ -3395,15 +5914,15 @@ async def reject_user_callback(callback: types.CallbackQuery):
         
         username = callback.data.split(":")[1]
         
-        df = load_accounts()
+        def _reject(df: pd.DataFrame) -> Optional[pd.DataFrame]:
+            if df[df["USERNAME"] == username].empty:
+                return None
+            return df[df["USERNAME"] != username]
         
-        if df[df["USERNAME"] == username].empty:
+        if not update_accounts(_reject):
             await callback.answer("❌ User not found", show_alert=True)
             return
         
-        df = df[df["USERNAME"] != username]
-        save_accounts(df)
-        
         log_activity(admin, "REJECT_USER", {"username": username})
         
         await callback.message.edit_text(
@@ -3430,24 +5949,30 @@ async def confirm_delete_stock(callback: types.CallbackQuery):
             await callback.answer("❌ AWS connection not available", show_alert=True)
             return
         
-        def _list_objects():
-            return s3.list_objects_v2(
+        def _delete_all() -> int:
+            deleted = 0
+            # One DeleteObjects call per listed page (both cap at 1000 keys)
+            for page in iter_s3_pages(SUPPLIER_STOCK_FOLDER):
+                s3.delete_objects(
+                    Bucket=CONFIG["AWS_BUCKET"],
+                    Delete={"Objects": [{"Key": obj["Key"]} for obj in page], "Quiet": True}
+                )
+                deleted += len(page)
+            
+            # The snapshot and summary would otherwise keep serving the deleted stock
+            s3.delete_objects(
                 Bucket=CONFIG["AWS_BUCKET"],
-                Prefix=SUPPLIER_STOCK_FOLDER
+                Delete={"Objects": [
+                    {"Key": COMBINED_STOCK_KEY},
+                    {"Key": COMBINED_STOCK_SNAPSHOT_KEY},
+                    {"Key": STOCK_SUMMARY_KEY}
+                ], "Quiet": True}
             )
+            supplier_frame_cache.clear()
+            stock_cache.invalidate()
+            return deleted
         
-        objs = safe_s3_operation(_list_objects, fallback={})
-        
-        deleted_count = 0
-        if "Contents" in objs:
-            for obj in objs["Contents"]:
-                s3.delete_object(Bucket=CONFIG["AWS_BUCKET"], Key=obj["Key"])
-                deleted_count += 1
-        
-        try:
-            s3.delete_object(Bucket=CONFIG["AWS_BUCKET"], Key=COMBINED_STOCK_KEY)
-        except:
-            pass
+        deleted_count = await asyncio.to_thread(_delete_all)
         
         log_activity(admin, "DELETE_ALL_STOCK", {"deleted_files": deleted_count})
         
@@ -3561,10 +6086,11 @@ async def handle_supplier_stock_upload(message: types.Message, user: Dict, df: p
                 def _upload():
                     s3.upload_file(temp_supplier_path, CONFIG["AWS_BUCKET"], supplier_file)
                 
-                safe_s3_operation(_upload)
+                async with stock_locks.supplier(supplier_name, timeout=STOCK_LOCK_TIMEOUT):
+                    await asyncio.to_thread(safe_s3_operation, _upload)
         
         # Rebuild combined stock
-        rebuild_combined_stock()
+        await asyncio.to_thread(rebuild_combined_stock)
         
         # Calculate statistics
         total_stones = len(cleaned_df)
@@ -3618,71 +6144,11 @@ async def handle_bulk_deal_requests(message: types.Message, user: Dict, df: pd.D
             await message.reply("❌ No valid deal requests found.")
             return
         
-        stock_df = load_stock()
-        
-        successful_deals = 0
-        failed_deals = []
+        offers = list(zip(df["Stock #"].astype(str).str.strip(), df["Offer Price ($/ct)"]))
+        results = await request_deals_bulk(user, offers)
         
-        for _, row in df.iterrows():
-            stone_id = str(row["Stock #"]).strip()
-            
-            try:
-                offer_price = float(row["Offer Price ($/ct)"])
-                if offer_price <= 0:
-                    failed_deals.append(f"{stone_id}: Invalid price")
-                    continue
-            except:
-                failed_deals.append(f"{stone_id}: Invalid price format")
-                continue
-            
-            stone_row = stock_df[stock_df["Stock #"] == stone_id]
-            
-            if stone_row.empty:
-                failed_deals.append(f"{stone_id}: Not found")
-                continue
-            
-            if stone_row.iloc[0].get("LOCKED") == "YES":
-                failed_deals.append(f"{stone_id}: Already locked")
-                continue
-            
-            deal_id = f"DEAL-{uuid.uuid4().hex[:10].upper()}"
-            stone_data = stone_row.iloc[0]
-            
-            deal = {
-                "deal_id": deal_id,
-                "stone_id": stone_id,
-                "supplier_username": stone_data.get("SUPPLIER", "").replace("supplier_", ""),
-                "client_username": user["USERNAME"],
-                "actual_stock_price": float(stone_data.get("Price Per Carat", 0)),
-                "client_offer_price": offer_price,
-                "supplier_action": "PENDING",
-                "admin_action": "PENDING",
-                "final_status": "OPEN",
-                "created_at": datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
-            }
-            
-            if not atomic_lock_stone(stone_id):
-                failed_deals.append(f"{stone_id}: Lock failed")
-                continue
-            
-            if s3:
-                deal_key = f"{DEALS_FOLDER}{deal_id}.json"
-                s3.put_object(
-                    Bucket=CONFIG["AWS_BUCKET"],
-                    Key=deal_key,
-                    Body=json.dumps(deal, indent=2),
-                    ContentType="application/json"
-                )
-            
-            log_deal_history(deal)
-            
-            save_notification(
-                deal["supplier_username"],
-                "supplier",
-                f"📩 New bulk deal offer for Stone {stone_id}"
-            )
-            
-            successful_deals += 1
+        successful_deals = sum(1 for result in results if result["ok"])
+        failed_deals = [f"{result['stone_id']}: {result['error']}" for result in results if not result["ok"]]
         
         result_msg = f"📊 **Bulk Deal Results**\n\n"
         result_msg += f"✅ Successful: {successful_deals}\n"
@@ -3718,81 +6184,58 @@ async def handle_admin_deal_approvals(message: types.Message, user: Dict, df: pd
                 await message.reply(f"❌ Missing column: {col}")
                 return
         
-        processed = 0
-        for _, row in df.iterrows():
-            if pd.isna(row["Deal ID"]):
-                continue
-            
-            deal_id = str(row["Deal ID"]).strip()
-            action = str(row["Admin Action (YES/NO)"]).strip().upper()
-            
-            if action not in ["YES", "NO"]:
+        decisions: Dict[str, str] = {}
+        for deal_id, action in zip(df["Deal ID"], df["Admin Action (YES/NO)"]):
+            if pd.isna(deal_id):
                 continue
-            
-            try:
-                if not s3:
-                    continue
-                    
-                deal_key = f"{DEALS_FOLDER}{deal_id}.json"
-                
-                def _get_deal():
-                    return s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=deal_key)
-                
-                deal_response = safe_s3_operation(_get_deal, fallback=None)
-                if not deal_response:
-                    continue
-                    
-                deal = json.loads(deal_response["Body"].read())
-                
-                if deal.get("final_status") in ["COMPLETED", "CLOSED"]:
-                    continue
-                
+            action = str(action).strip().upper()
+            if action in ["YES", "NO"]:
+                decisions.setdefault(str(deal_id).strip(), action)
+        
+        def _decide(action: str) -> Callable[[Optional[Dict]], Optional[Dict]]:
+            def _apply(deal: Optional[Dict]) -> Optional[Dict]:
+                if deal is None or deal.get("final_status") in ["COMPLETED", "CLOSED"]:
+                    return None
                 if action == "YES":
                     deal["admin_action"] = "APPROVED"
                     deal["final_status"] = "COMPLETED"
-                    
-                    remove_stone_from_supplier_and_combined(deal["stone_id"])
-                    
-                    save_notification(
-                        deal["client_username"],
-                        "client",
-                        f"✅ Deal {deal_id} approved for Stone {deal['stone_id']}"
-                    )
-                    
-                    save_notification(
-                        deal["supplier_username"],
-                        "supplier",
-                        f"✅ Deal {deal_id} approved. Please deliver Stone {deal['stone_id']}"
-                    )
-                    
                 else:
                     deal["admin_action"] = "REJECTED"
                     deal["final_status"] = "CLOSED"
-                    
-                    unlock_stone(deal["stone_id"])
-                    
-                    save_notification(
-                        deal["client_username"],
-                        "client",
-                        f"❌ Deal {deal_id} rejected for Stone {deal['stone_id']}"
-                    )
-                
-                def _save_deal():
-                    s3.put_object(
-                        Bucket=CONFIG["AWS_BUCKET"],
-                        Key=deal_key,
-                        Body=json.dumps(deal, indent=2),
-                        ContentType="application/json"
-                    )
-                
-                safe_s3_operation(_save_deal)
-                
-                log_deal_history(deal)
-                processed += 1
-                
-            except Exception as e:
-                logger.error(f"Failed to process deal {deal_id}: {e}")
-                continue
+                return deal
+            return _apply
+        
+        deals = await update_deals_batch({
+            deal_id: _decide(action) for deal_id, action in decisions.items()
+        }) if s3 else []
+        
+        # Stock and notifications follow only the decisions that were actually saved
+        approved = [deal for deal in deals if deal["admin_action"] == "APPROVED"]
+        rejected = [deal for deal in deals if deal["admin_action"] == "REJECTED"]
+        await settle_deal_stones([deal["stone_id"] for deal in approved], [deal["stone_id"] for deal in rejected])
+        
+        notifications = []
+        for deal in approved:
+            notifications.append((
+                deal["client_username"], "client",
+                f"✅ Deal {deal['deal_id']} approved for Stone {deal['stone_id']}"
+            ))
+            notifications.append((
+                deal["supplier_username"], "supplier",
+                f"✅ Deal {deal['deal_id']} approved. Please deliver Stone {deal['stone_id']}"
+            ))
+        for deal in rejected:
+            notifications.append((
+                deal["client_username"], "client",
+                f"❌ Deal {deal['deal_id']} rejected for Stone {deal['stone_id']}"
+            ))
+        
+        await asyncio.gather(
+            send_notifications(notifications),
+            asyncio.to_thread(log_deals_history, deals),
+            asyncio.to_thread(index_deals, deals)
+        )
+        processed = len(deals)
         
         await message.reply(f"✅ Processed {processed} deal approvals.", reply_markup=admin_kb)
         log_activity(user, "PROCESS_DEAL_APPROVALS", {"count": processed})
@@ -3808,86 +6251,59 @@ async def handle_supplier_deal_responses(message: types.Message, user: Dict, df:
             await message.reply("❌ Invalid format. Need 'Deal ID' and 'Supplier Action (ACCEPT/REJECT)' columns.")
             return
         
-        processed = 0
-        for _, row in df.iterrows():
-            if pd.isna(row["Deal ID"]):
-                continue
-            
-            deal_id = str(row["Deal ID"]).strip()
-            action = str(row["Supplier Action (ACCEPT/REJECT)"]).strip().upper()
-            
-            if action not in ["ACCEPT", "REJECT"]:
+        responses: Dict[str, str] = {}
+        for deal_id, action in zip(df["Deal ID"], df["Supplier Action (ACCEPT/REJECT)"]):
+            if pd.isna(deal_id):
                 continue
-            
-            try:
-                if not s3:
-                    continue
-                    
-                deal_key = f"{DEALS_FOLDER}{deal_id}.json"
-                
-                def _get_deal():
-                    return s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=deal_key)
-                
-                deal_response = safe_s3_operation(_get_deal, fallback=None)
-                if not deal_response:
-                    continue
-                    
-                deal = json.loads(deal_response["Body"].read())
-                
+            action = str(action).strip().upper()
+            if action in ["ACCEPT", "REJECT"]:
+                responses.setdefault(str(deal_id).strip(), action)
+        
+        def _respond(action: str) -> Callable[[Optional[Dict]], Optional[Dict]]:
+            def _apply(deal: Optional[Dict]) -> Optional[Dict]:
+                if deal is None:
+                    return None
                 if deal.get("supplier_username", "").lower() != user["USERNAME"].lower():
-                    continue
-                
+                    return None
                 if deal.get("final_status") in ["COMPLETED", "CLOSED"]:
-                    continue
-                
+                    return None
                 if action == "ACCEPT":
                     deal["supplier_action"] = "ACCEPTED"
                     deal["admin_action"] = "PENDING"
-                    
-                    save_notification(
-                        deal["client_username"],
-                        "client",
-                        f"✅ Supplier accepted deal {deal_id} for Stone {deal['stone_id']}"
-                    )
-                    
-                    admin_df = load_accounts()
-                    admins = admin_df[admin_df["ROLE"].str.lower() == "admin"]["USERNAME"].tolist()
-                    for admin in admins:
-                        save_notification(
-                            admin,
-                            "admin",
-                            f"📝 Deal {deal_id} awaiting admin approval"
-                        )
-                        
                 else:
                     deal["supplier_action"] = "REJECTED"
                     deal["admin_action"] = "REJECTED"
                     deal["final_status"] = "CLOSED"
-                    
-                    unlock_stone(deal["stone_id"])
-                    
-                    save_notification(
-                        deal["client_username"],
-                        "client",
-                        f"❌ Supplier rejected deal {deal_id} for Stone {deal['stone_id']}"
-                    )
-                
-                def _save_deal():
-                    s3.put_object(
-                        Bucket=CONFIG["AWS_BUCKET"],
-                        Key=deal_key,
-                        Body=json.dumps(deal, indent=2),
-                        ContentType="application/json"
-                    )
-                
-                safe_s3_operation(_save_deal)
-                
-                log_deal_history(deal)
-                processed += 1
-                
-            except Exception as e:
-                logger.error(f"Failed to process deal {deal_id}: {e}")
-                continue
+                return deal
+            return _apply
+        
+        deals = await update_deals_batch({
+            deal_id: _respond(action) for deal_id, action in responses.items()
+        }) if s3 else []
+        
+        accepted = [deal for deal in deals if deal["supplier_action"] == "ACCEPTED"]
+        rejected = [deal for deal in deals if deal["supplier_action"] == "REJECTED"]
+        await settle_deal_stones([], [deal["stone_id"] for deal in rejected])
+        
+        notifications = []
+        for deal in accepted:
+            notifications.append((
+                deal["client_username"], "client",
+                f"✅ Supplier accepted deal {deal['deal_id']} for Stone {deal['stone_id']}"
+            ))
+            notifications.append((None, "admin", f"📝 Deal {deal['deal_id']} awaiting admin approval"))
+        for deal in rejected:
+            notifications.append((
+                deal["client_username"], "client",
+                f"❌ Supplier rejected deal {deal['deal_id']} for Stone {deal['stone_id']}"
+            ))
+        
+        await asyncio.gather(
+            send_notifications(notifications),
+            asyncio.to_thread(log_deals_history, deals),
+            asyncio.to_thread(index_deals, deals)
+        )
+        processed = len(deals)
         
         await message.reply(f"✅ Processed {processed} deal responses.", reply_markup=supplier_kb)
         log_activity(user, "PROCESS_DEAL_RESPONSES", {"count": processed})
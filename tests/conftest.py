@@ -0,0 +1,22 @@
+"""Shared fixtures: main.py imported against an in-memory S3 (moto)"""
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+os.environ.setdefault("AWS_BUCKET", "test-bucket")
+os.environ.setdefault("AWS_REGION", "us-east-1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+moto = pytest.importorskip("moto")
+
+
+@pytest.fixture(scope="session")
+def main():
+    with moto.mock_aws():
+        import main
+        main.s3.create_bucket(Bucket=main.CONFIG["AWS_BUCKET"])
+        yield main
@@ -0,0 +1,107 @@
+"""Conditional (ETag) writes against an in-memory S3
+
+    pip install "moto[s3]" pytest
+    python -m pytest tests
+"""
+import json
+import threading
+
+import pytest
+import pandas as pd
+
+
+@pytest.fixture
+def no_backoff(main, monkeypatch):
+    monkeypatch.setattr(main, "wait_after_conflict", lambda key, attempt: None)
+
+
+def read_json(main, key, default):
+    try:
+        obj = main.s3.get_object(Bucket=main.CONFIG["AWS_BUCKET"], Key=key)
+    except main.botocore.exceptions.ClientError as e:
+        if main.is_missing_key_error(e):
+            return default, None
+        raise
+    return json.loads(obj["Body"].read()), obj["ETag"]
+
+
+def test_conditional_put_rejects_stale_etag(main):
+    key = "tests/conditional_put.json"
+    etag = main.conditional_put(key, "1", None, "application/json")
+    main.conditional_put(key, "2", etag, "application/json")
+
+    with pytest.raises(main.WriteConflict):
+        main.conditional_put(key, "3", etag, "application/json")
+    with pytest.raises(main.WriteConflict):
+        main.conditional_put(key, "3", None, "application/json")
+    assert read_json(main, key, None)[0] == 2
+
+
+def test_racing_writers_both_land(main, no_backoff):
+    key = "tests/race.json"
+    # Both writers read the same version before either writes
+    barrier = threading.Barrier(2)
+    mutations = []
+
+    def writer(item):
+        first_read = [True]
+
+        def _read():
+            value = read_json(main, key, [])
+            if first_read[0]:
+                first_read[0] = False
+                barrier.wait(timeout=10)
+            return value
+
+        def _mutate(items):
+            mutations.append(item)
+            return items + [item]
+
+        main.compare_and_swap(key, _read, _mutate, json.dumps)
+
+    threads = [threading.Thread(target=writer, args=(item,)) for item in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(read_json(main, key, [])[0]) == ["a", "b"]
+    # The loser re-applied its change to the winner's version exactly once
+    assert len(mutations) == 3
+
+
+def test_compare_and_swap_gives_up(main, no_backoff):
+    key = "tests/contended.json"
+    main.conditional_put(key, "0", None, "application/json")
+
+    # Always hands out a version that someone else has already replaced
+    with pytest.raises(main.WriteConflict):
+        main.compare_and_swap(key, lambda: (0, '"stale"'), lambda value: value + 1, json.dumps)
+    assert read_json(main, key, None)[0] == 0
+
+
+def test_losing_publisher_leaves_summary_of_winner(main):
+    def stock(n):
+        return pd.DataFrame({
+            "Stock #": [f"S-{i}" for i in range(n)],
+            "Shape": "Round",
+            "Weight": 1.0,
+            "Price Per Carat": 1000.0,
+            "SUPPLIER": "supplier_test",
+            "LOCKED": "NO"
+        })
+
+    etag = main.get_object_etag(main.COMBINED_STOCK_SNAPSHOT_KEY)
+    assert main.save_combined_stock(stock(3), expected_etag=etag, conditional=True)
+    with pytest.raises(main.WriteConflict):
+        main.save_combined_stock(stock(5), expected_etag=etag, conditional=True)
+
+    # A summary written late by another publisher does not match the snapshot
+    main.s3.put_object(
+        Bucket=main.CONFIG["AWS_BUCKET"],
+        Key=main.STOCK_SUMMARY_KEY,
+        Body=json.dumps({**main.build_stock_summary(stock(5)), "snapshot_etag": '"older"'})
+    )
+    summary = main.load_stock_summary()
+    assert summary["total_diamonds"] == 3
+    assert summary["snapshot_etag"] == main.get_object_etag(main.COMBINED_STOCK_SNAPSHOT_KEY)
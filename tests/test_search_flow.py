@@ -0,0 +1,107 @@
+"""Client search conversation: carat -> shape -> color -> clarity -> diamond type"""
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import pandas as pd
+
+UID = 4242
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.from_user = SimpleNamespace(id=UID)
+        self.replies = []
+        self.documents = []
+
+    async def reply(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_document(self, document, **kwargs):
+        self.documents.append(kwargs.get("caption"))
+
+
+@pytest.fixture
+def stock(main):
+    df = pd.DataFrame({
+        "Stock #": ["NAT-1", "NAT-2", "LGD-1", "LGD-2", "FY-1", "FP-1"],
+        "Shape": ["Round", "Oval", "Round", "Round", "Cushion", "Cushion"],
+        "Weight": [1.0, 1.2, 1.1, 2.5, 0.8, 0.9],
+        "Color": ["E", "F", "D", "H", "Fancy Yellow", "Fancy Pink"],
+        "Clarity": ["VS1", "VVS2", "VS2", "SI1", "VS1", "SI2"],
+        "Lab": "GIA",
+        "Price Per Carat": [5000.0, 6000.0, 1500.0, 1200.0, 7000.0, 30000.0],
+        "SUPPLIER": "supplier_test",
+        "LOCKED": "NO",
+        "Diamond Type": ["Natural", "Natural", "LGD", "LGD", "Natural", "Natural"]
+    })
+    assert main.save_combined_stock(main.add_grade_codes(df))
+    main.logged_in_users[UID] = {"USERNAME": "buyer", "ROLE": "client", "last_active": time.time()}
+    yield df
+    main.logged_in_users.pop(UID, None)
+    main.user_state.pop(UID, None)
+
+
+def converse(main, answers):
+    state = main.user_state[UID] = {"step": "search_carat", "search": {}, "last_updated": time.time()}
+    messages = []
+    for answer in answers:
+        message = FakeMessage(answer)
+        asyncio.run(main.handle_search_flow(message, state))
+        messages.append(message)
+    return state, messages
+
+
+def found(messages):
+    return sorted(
+        reply.split("**")[1] for reply in messages[-1].replies if reply.startswith("💎 **")
+    )
+
+
+def test_prompts_walk_through_every_step(main, stock):
+    state, messages = converse(main, ["any", "any", "any", "any"])
+
+    assert state["step"] == "search_type"
+    assert "Shape" in messages[0].replies[0]
+    assert "Color" in messages[1].replies[0]
+    assert "Clarity" in messages[2].replies[0]
+    assert "Diamond Type" in messages[3].replies[0]
+
+
+def test_type_filter_narrows_results(main, stock):
+    _, messages = converse(main, ["any", "round", "any", "any", "natural"])
+    assert found(messages) == ["NAT-1"]
+
+    _, messages = converse(main, ["any", "round", "any", "any", "lgd, natural"])
+    assert found(messages) == ["LGD-1", "LGD-2", "NAT-1"]
+
+
+def test_any_type_keeps_the_other_filters(main, stock):
+    _, messages = converse(main, ["1-1.5", "any", "d-f", "vs2+", "any"])
+    assert found(messages) == ["LGD-1", "NAT-1", "NAT-2"]
+    assert UID not in main.user_state
+
+
+def test_fancy_colors_match_by_name(main, stock):
+    _, messages = converse(main, ["any", "any", "fancy yellow", "any", "any"])
+    assert found(messages) == ["FY-1"]
+
+    _, messages = converse(main, ["any", "any", "e, fancy pink", "any", "any"])
+    assert found(messages) == ["FP-1", "NAT-1"]
+
+    # Not a range: every fancy color shares one grade code
+    _, messages = converse(main, ["any", "any", "d-fancy", "any", "any"])
+    assert found(messages) == []
+
+
+def test_search_is_logged_with_the_type(main, stock, monkeypatch):
+    logged = []
+    monkeypatch.setattr(main, "log_activity", lambda user, action, details=None: logged.append((action, details)))
+
+    converse(main, ["any", "any", "any", "any", "lgd"])
+    assert logged == [("SEARCH", {
+        "filters": {"carat": "any", "shape": "any", "color": "any", "clarity": "any", "type": "lgd"},
+        "results": 2
+    })]